@@ -7,16 +7,30 @@
 # This is a version of myOfflineAi-ChatHistory with chat history saving disabled.
 #----------------------
 
-from flask import Flask, render_template_string, request, jsonify, Response
+from flask import Flask, Request, render_template_string, request, jsonify, Response
 import json
 import os
 import sys
-import base64
-import fitz  # PyMuPDF
-from PIL import Image
+from PIL import Image, ImageOps
 import io
 from datetime import datetime, timezone
 
+import re
+import math
+import time
+import hashlib
+import uuid
+import heapq
+import itertools
+import threading
+import queue
+import tempfile
+import contextlib
+import shutil
+import atexit
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import requests
 import subprocess
 
@@ -24,6 +38,14 @@ import ollama
 from ollama import chat as ollama_chat, ChatResponse
 from urllib.parse import urlparse
 
+import numpy as np
+
+from pdf_engine import PdfEngine, RenderCache, PdfTimeoutError, PdfWorkerError, PAGE_TEXT, IMAGE_MIMETYPES
+from vector_index import VectorIndex
+from bm25_index import BM25Index
+from streaming import ChunkCoalescer
+from conversation_store import ConversationStore, SequenceConflictError
+
 
 
 # The context size of all Ollama models is set to 4096 tokens.
@@ -35,7 +57,12 @@ from urllib.parse import urlparse
 
 # Here we set a custom context size.
 # Note: Setting large context sizes will slow down inference.
+# NUM_CTX is the largest context that will be used. Each request uses the
+# smallest bucket below that fits the prompt plus room for the reply.
+# Only a few sizes are used because Ollama reloads the model whenever
+# num_ctx changes.
 NUM_CTX = 16000
+NUM_CTX_BUCKETS = (4096, 8192, 16384, 32768)
 
 
 TEMPERATURE = 0.4
@@ -45,18 +72,124 @@ FREQUENCY_PENALTY = 0
 REPEAT_PENALTY = 0
 
 
-# Max number of pdf pages allowed per pdf file
+# Max number of pdf pages that can be sent as images per pdf file
 MAX_PAGES = 15
 
+# Pdf pages that have a text layer are sent to the model as text, which
+# uses far fewer tokens than an image of the page. Only scanned pages and
+# pages that are mostly figures are sent as images.
+# A page with fewer than PDF_TEXT_MIN_CHARS characters, or where images and
+# drawings cover more than PDF_FIGURE_MIN_AREA of the page, is sent as an image.
+# Set PDF_TEXT_PAGES to False to send every page as an image.
+PDF_TEXT_PAGES = True
+PDF_TEXT_MIN_CHARS = 200
+PDF_FIGURE_MIN_AREA = 0.4
+
+# Max number of pages per pdf file when text pages are used.
+# Without retrieval, the text of a document that does not fit into the
+# context is cut off at a page break and the user is told which pages
+# were left out.
+MAX_TEXT_PAGES = 300
+
+# Agents with "retrieval": true do not get the whole text of an attached pdf.
+# Instead the RAG_TOP_K passages that best match each question are added to
+# the prompt, with their page numbers. Passages are up to RAG_CHUNK_CHARS long.
+# RAG_EMBED_MODEL = None picks a downloaded Ollama embedding model (such as
+# nomic-embed-text) automatically. Without one, passages are found by BM25
+# word search. With one, RAG_FUSION = True combines both rankings (with
+# reciprocal rank fusion), which helps with names, numbers and rare terms.
+RAG_EMBED_MODEL = None
+RAG_FUSION = True
+RAG_CHUNK_CHARS = 1200
+RAG_TOP_K = 6
+RAG_MAX_DOCUMENTS = 20
+
+# The chunk embeddings are stored as int8 (or "float16") vectors.
+# VECTOR_INDEX_DIR = None keeps them in RAM, so nothing is written to disk.
+# Set it to a folder to store them there instead and read them through a
+# memory map (less RAM for many large documents). The folder is cleared
+# when the app starts, because the documents themselves are not saved.
+VECTOR_INDEX_DIR = None
+VECTOR_INDEX_DTYPE = "int8"
+
+# The Summarize button on an attached pdf works for documents of any length.
+# The text is split into parts of up to SUMMARY_PART_TOKENS (None = as much as
+# fits the model's context). Each part is summarized, then the part summaries
+# are combined, in several rounds for long documents. The calls run in
+# parallel up to OLLAMA_PARALLEL_SLOTS, after waiting chat requests.
+# Results are kept in RAM by content hash, so summarizing again after a
+# change only redoes the parts that changed.
+SUMMARY_PART_TOKENS = None
+SUMMARY_PART_MAX_TOKENS = 512
+SUMMARY_FINAL_MAX_TOKENS = 1500
+SUMMARY_PRIORITY = 10
+SUMMARY_CACHE_LIMIT = 16 * 1024 * 1024
+
 # Each pdf page is converted into an image.
-# The image resolution is set here.
-# Use moderate DPI for balance of quality/size
+# Pages are rendered so that their longest side matches the image size of
+# the model (see IMAGE_PROFILES). PDF_IMAGE_RES is only used for a profile
+# without a long_edge.
 # 1.5x scale provides good readability while reducing file size
 PDF_IMAGE_RES = 1.5 # 150 dpi
 
-# Max pdf upload size
+# Vision models resize every image to their own input size, so sending
+# larger images only costs time (encoding, upload and decoding in Ollama).
+# Uploaded images and pdf pages are resized so that their longest side is
+# long_edge pixels, and saved with the given format and quality.
+# patch is the number of pixels per image token along each side, so an
+# image is counted as (long_edge / patch)^2 tokens in the context.
+# The first profile whose name is part of the model name is used.
+IMAGE_PROFILES = [
+    ("gemma3", {"long_edge": 896, "patch": 56, "format": "JPEG", "quality": 85}),
+    ("llama3.2-vision", {"long_edge": 1120, "patch": 35, "format": "JPEG", "quality": 85}),
+    ("llava", {"long_edge": 672, "patch": 14, "format": "JPEG", "quality": 85}),
+    ("qwen2.5vl", {"long_edge": 1024, "patch": 28, "format": "JPEG", "quality": 85}),
+    ("minicpm-v", {"long_edge": 1344, "patch": 56, "format": "JPEG", "quality": 85}),
+    ("moondream", {"long_edge": 756, "patch": 28, "format": "JPEG", "quality": 85}),
+]
+DEFAULT_IMAGE_PROFILE = {"long_edge": 1024, "patch": 28, "format": "JPEG", "quality": 85}
+
+# Pdf pages are rendered in parallel by a pool of worker processes,
+# so a broken pdf cannot crash or hang the app.
+# A pdf that takes longer than PDF_JOB_TIMEOUT seconds is stopped.
+# Each worker is limited to PDF_WORKER_MEMORY_LIMIT (not on Windows).
+PDF_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))
+PDF_JOB_TIMEOUT = 60
+PDF_WORKER_MEMORY_LIMIT = 2 * 1024 * 1024 * 1024 # (2GB)
+
+# When a pdf is streamed to the browser, a small preview of page 1 is
+# sent first so that something is shown right away. Set to None to disable.
+PDF_PREVIEW_RES = 0.5
+PDF_PREVIEW_QUALITY = 60
+
+# Rendered pages (and the text found on each page) are cached by the
+# content hash of the pdf, the page and the render settings, so a pdf
+# that is attached again does not need to be rendered again.
+# RENDER_CACHE_DIR is None by default, which keeps the cache in RAM only
+# and nothing is written to disk. Set it to a folder path to keep the
+# cache on disk between restarts.
+RENDER_CACHE_DIR = None
+RENDER_CACHE_LIMIT = 256 * 1024 * 1024 # (256MB)
+
+# Max pdf upload size (for one request)
 MAX_UPLOAD_FILE_SIZE = 20 * 1024 * 1024 # (20MB)
 
+# UPLOAD_SPOOL_DIR is None by default, which keeps uploaded files in RAM
+# only and nothing is written to disk. Set it to a folder path to write
+# uploads larger than UPLOAD_SPOOL_THRESHOLD to temp files there instead,
+# and pdfs are opened from there. Each file is deleted as soon as it has
+# been processed.
+UPLOAD_SPOOL_DIR = None
+UPLOAD_SPOOL_THRESHOLD = 1024 * 1024 # (1MB)
+
+# Larger pdfs are sent by the browser in parts of UPLOAD_CHUNK_SIZE, and an
+# interrupted upload can be resumed. Unfinished uploads are deleted after
+# UPLOAD_TTL_SECONDS. Uploads kept in RAM (no UPLOAD_SPOOL_DIR) are limited
+# to MAX_UPLOAD_FILE_SIZE, and MAX_CHUNKED_UPLOAD_SIZE applies to spooled ones.
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024 # (4MB)
+MAX_CHUNKED_UPLOAD_SIZE = 200 * 1024 * 1024 # (200MB)
+UPLOAD_TTL_SECONDS = 60 * 60 # (1 hour)
+
 # The name of the last model selected
 # is stored in this file
 LAST_MODEL_FILE = "last_model.txt"
@@ -64,9 +197,72 @@ LAST_MODEL_FILE = "last_model.txt"
 # All agents, including the default, are stored in this file
 AGENTS_FILE = "agents.json"
 
-# File to store conversation histories
+# Chat histories are not saved by default.
+# Set this to a file name (e.g. "conversations.db") to save chats on this
+# computer in a SQLite database. Images and documents of saved chats go to a
+# folder next to it (<CONVERSATIONS_DB>.blobs). A conversations.json file
+# (CONVERSATIONS_FILE) from an older version is imported once, on startup.
+CONVERSATIONS_DB = None
 CONVERSATIONS_FILE = "conversations.json"
 
+# Saved chats are listed in pages of this many chats per agent
+# (only the titles, the messages are fetched when a chat is opened)
+CONVERSATIONS_PAGE_SIZE = 50
+
+# Chat sessions are cached in RAM so that the browser only needs to
+# send the newest message on each turn. Sessions are never written to disk.
+# Idle sessions expire after SESSION_TTL_SECONDS and the least recently
+# used session is evicted when there are more than MAX_SESSIONS.
+SESSION_TTL_SECONDS = 2 * 60 * 60 # (2 hours)
+MAX_SESSIONS = 50
+
+# Uploaded images and rendered pdf pages are kept on the server and
+# the browser only holds a short handle (the sha256 of the content).
+# Least recently used attachments are evicted when the limit is reached.
+ATTACHMENT_MEMORY_LIMIT = 512 * 1024 * 1024 # (512MB)
+
+# Set this to a folder path to move evicted attachments to disk instead of
+# dropping them. It is None by default so that nothing is written to disk.
+ATTACHMENT_SPILL_DIR = None
+ATTACHMENT_SPILL_LIMIT = 2 * 1024 * 1024 * 1024 # (2GB)
+
+# Before each request the chat history is trimmed to fit into the context.
+# Tokens are estimated from the number of characters, and each image is
+# counted by the image profile of the model (see IMAGE_PROFILES).
+# A session's context never shrinks below the tokens Ollama actually counted.
+CHARS_PER_TOKEN = 4
+MESSAGE_TOKEN_OVERHEAD = 4
+
+# Tokens kept free in the context for the model's reply
+RESPONSE_TOKEN_RESERVE = 2048
+
+# Max length of the rolling summary of trimmed messages.
+# Summaries are only made for agents that have "summarizeHistory": true
+SUMMARY_MAX_TOKENS = 512
+
+# Streamed tokens are grouped into one SSE message every STREAM_FLUSH_INTERVAL
+# seconds or every STREAM_FLUSH_MAX_TOKENS tokens, whichever comes first.
+# Fast models produce hundreds of tokens per second and the browser re-renders
+# the reply for every message it receives. Set both to 0 to send every token.
+STREAM_FLUSH_INTERVAL = 0.05
+STREAM_FLUSH_MAX_TOKENS = 32
+
+# Number of chat generations that are sent to Ollama at the same time.
+# This should match the number of parallel slots that Ollama is using
+# (the OLLAMA_NUM_PARALLEL setting). Other requests wait in a queue.
+OLLAMA_PARALLEL_SLOTS = int(os.environ.get("OLLAMA_NUM_PARALLEL") or 1)
+
+# Max number of requests that can wait in the queue.
+# When the queue is full new requests are rejected with a 429 error.
+MAX_QUEUED_REQUESTS = 8
+
+# How often (in seconds) a waiting request tells the browser its queue position
+QUEUE_UPDATE_INTERVAL = 1.0
+
+# A chat request can send a "priority" from 0 (the default, served first)
+# to MAX_REQUEST_PRIORITY. Values outside that range are clamped.
+MAX_REQUEST_PRIORITY = 9
+
 
 
 # -----------------------------------------
@@ -167,14 +363,1433 @@ else:
 
 
 
+# -----------------------------------------
+# RAM-only chat sessions:
+# Each open chat tab has a session id. The server keeps the Ollama
+# formatted messages for that session in memory, so the browser only
+# sends the new user message on each turn instead of the full history
+# (including every image from earlier turns).
+# Nothing in here is ever written to disk.
+# -----------------------------------------
+
+class SessionStore:
+    """Thread-safe in-memory store of chat sessions with TTL and LRU eviction."""
+
+    def __init__(self, ttl_seconds, max_sessions):
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        expired = [sid for sid, s in self._sessions.items() if now - s["last_used"] > self.ttl_seconds]
+        for sid in expired:
+            del self._sessions[sid]
+        while len(self._sessions) > self.max_sessions:
+            evicted_id, _ = self._sessions.popitem(last=False)
+            print(f"[INFO] Evicted chat session {evicted_id} from memory.")
+
+    def get(self, session_id):
+        """Returns the session dict, or None if it does not exist or has expired."""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session["last_used"] = now
+                self._sessions.move_to_end(session_id)
+            return session
+
+    def reset(self, session_id, system_prompt=""):
+        """Creates (or replaces) an empty session."""
+        now = time.monotonic()
+        session = {
+            "system": system_prompt, "messages": [], "summary": "", "summarized_count": 0, "num_ctx": 0,
+            "last_used": now, "lock": threading.Lock(),
+        }
+        with self._lock:
+            self._sessions[session_id] = session
+            self._sessions.move_to_end(session_id)
+            self._expire(now)
+        return session
+
+    def delete(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+
+session_store = SessionStore(SESSION_TTL_SECONDS, MAX_SESSIONS)
+
+
+# -----------------------------------------
+# Attachment store:
+# Images and pdf pages are stored once, keyed by the sha256 of their bytes.
+# The browser gets a url like /attachments/<sha256> that it can use both
+# for previews and inside chat messages. stream_chat() swaps the handles
+# for the raw bytes when it builds the Ollama request, so an image is
+# uploaded once instead of being re-sent as base64 on every turn.
+# -----------------------------------------
+
+ATTACHMENT_URL_PREFIX = "/attachments/"
+
+
+class AttachmentMissingError(Exception):
+    """Raised when a message refers to an attachment that is no longer stored."""
+
+
+class AttachmentStore:
+    """Size-capped LRU store of byte blobs, in RAM with an optional spill directory."""
+
+    def __init__(self, max_bytes, spill_dir=None, max_spill_bytes=0):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes
+        # Called with the key of an unknown attachment; may return
+        # (data, mimetype) from elsewhere (the images of saved chats).
+        self.fallback = None
+        self._memory = OrderedDict()  # key -> (data, mimetype)
+        self._memory_bytes = 0
+        self._spilled = OrderedDict()  # key -> (size, mimetype)
+        self._spilled_bytes = 0
+        self._lock = threading.Lock()
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def add(self, data, mimetype):
+        """Stores the bytes and returns their content hash."""
+        key = hashlib.sha256(data).hexdigest()
+        self.put(key, data, mimetype)
+        return key
+
+    def put(self, key, data, mimetype):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return
+            self._remove_spilled(key)
+            self._memory[key] = (data, mimetype)
+            self._memory_bytes += len(data)
+            self._evict()
+
+    def get(self, key):
+        """Returns (data, mimetype), or None if the key is unknown."""
+        entry = self._get(key)
+        if entry is None and self.fallback:
+            entry = self.fallback(key)
+            if entry is not None:
+                self.put(key, *entry)
+        return entry
+
+    def _get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+            if key not in self._spilled:
+                return None
+            _, mimetype = self._spilled[key]
+            try:
+                with open(self._spill_path(key), "rb") as f:
+                    data = f.read()
+            except IOError:
+                self._remove_spilled(key)
+                return None
+            self._remove_spilled(key)
+            self._memory[key] = (data, mimetype)
+            self._memory_bytes += len(data)
+            self._evict()
+            return data, mimetype
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, key)
+
+    def _remove_spilled(self, key):
+        entry = self._spilled.pop(key, None)
+        if entry is None:
+            return
+        self._spilled_bytes -= entry[0]
+        try:
+            os.remove(self._spill_path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        # Always keep the newest item, even if it is larger than the limit.
+        while self._memory_bytes > self.max_bytes and len(self._memory) > 1:
+            key, (data, mimetype) = self._memory.popitem(last=False)
+            self._memory_bytes -= len(data)
+            if self.spill_dir and len(data) <= self.max_spill_bytes:
+                try:
+                    with open(self._spill_path(key), "wb") as f:
+                        f.write(data)
+                    self._spilled[key] = (len(data), mimetype)
+                    self._spilled_bytes += len(data)
+                except IOError as e:
+                    print(f"[ERROR] Could not spill attachment to disk: {e}", file=sys.stderr)
+        while self._spilled_bytes > self.max_spill_bytes and self._spilled:
+            self._remove_spilled(next(iter(self._spilled)))
+
+
+attachment_store = AttachmentStore(ATTACHMENT_MEMORY_LIMIT, ATTACHMENT_SPILL_DIR, ATTACHMENT_SPILL_LIMIT)
+pdf_renderer = PdfEngine(PDF_WORKERS, PDF_JOB_TIMEOUT, PDF_WORKER_MEMORY_LIMIT,
+                         cache=RenderCache(RENDER_CACHE_LIMIT, RENDER_CACHE_DIR))
+
+
+# -----------------------------------------
+# Stream cancellation:
+# Every /stream_chat request gets an id that is sent to the browser as the
+# first SSE event. The Stop button calls /stream_chat/<request_id>/cancel,
+# and the streaming loop closes the HTTP stream to Ollama as soon as it
+# sees the cancel flag. Closing the stream makes Ollama stop decoding.
+# A browser disconnect (e.g. closing the tab) closes the stream too.
+# Ollama sends nothing while it processes the prompt, which can take long,
+# and a blocking read cannot be interrupted. So the stream is read in a
+# thread (CancellableStream) and the reply ends as soon as Stop is pressed.
+# The thread closes the connection when the first chunk arrives, and
+# until then Ollama is still busy, so the request keeps its scheduler slot
+# until the thread has finished (on_done).
+# -----------------------------------------
+
+class StreamRegistry:
+    """Tracks in-flight /stream_chat requests so that they can be cancelled."""
+
+    def __init__(self):
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def register(self):
+        request_id = uuid.uuid4().hex
+        state = {"cancel": threading.Event(), "cancel_requested_at": None}
+        with self._lock:
+            self._streams[request_id] = state
+        return request_id, state
+
+    def cancel(self, request_id):
+        with self._lock:
+            state = self._streams.get(request_id)
+        if state is None:
+            return False
+        if not state["cancel"].is_set():
+            state["cancel_requested_at"] = time.perf_counter()
+            state["cancel"].set()
+        return True
+
+    def unregister(self, request_id):
+        """Removes the request and returns the cancel latency in seconds, if it was cancelled."""
+        with self._lock:
+            state = self._streams.pop(request_id, None)
+        if state is None or state["cancel_requested_at"] is None:
+            return None
+        return time.perf_counter() - state["cancel_requested_at"]
+
+
+stream_registry = StreamRegistry()
+
+
+class CancellableStream:
+    """
+    Reads an Ollama stream in a thread and yields its chunks until it ends
+    or cancel is set. on_done is called by the thread once the connection
+    to Ollama is closed.
+    """
+
+    _END = object()
+
+    def __init__(self, stream, cancel, on_done=None, poll_interval=0.05):
+        self.cancel = cancel
+        self.on_done = on_done
+        self.poll_interval = poll_interval
+        self._chunks = queue.Queue()
+        self._closed = threading.Event()
+        threading.Thread(target=self._read, args=(stream,), name="ollama-stream", daemon=True).start()
+
+    def _read(self, stream):
+        try:
+            for chunk in stream:
+                if self._closed.is_set() or self.cancel.is_set():
+                    break
+                self._chunks.put(chunk)
+        except Exception as e:
+            self._chunks.put(e)
+        finally:
+            # Closing the iterator closes the HTTP connection to Ollama
+            if hasattr(stream, "close"):
+                stream.close()
+            self._chunks.put(self._END)
+            if self.on_done:
+                self.on_done()
+
+    def __iter__(self):
+        while not self.cancel.is_set():
+            try:
+                item = self._chunks.get(timeout=self.poll_interval)
+            except queue.Empty:
+                continue
+            if item is self._END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        self._closed.set()
+
+
+# -----------------------------------------
+# Request scheduler:
+# Flask runs with threaded=True, so without this every open tab would start
+# its own generation on the same Ollama server and they would all slow down
+# together. Requests are admitted in priority order (lower number first,
+# FIFO within a priority) up to OLLAMA_PARALLEL_SLOTS at a time.
+# -----------------------------------------
+
+class QueueFullError(Exception):
+    """Raised when the scheduler queue has no room for another request."""
+
+
+class RequestScheduler:
+    """Admits requests to Ollama in priority/FIFO order, up to a fixed number of slots."""
+
+    def __init__(self, slots, max_queued):
+        self.slots = max(1, slots)
+        self.max_queued = max_queued
+        self._active = 0
+        self._waiting = []  # heap of (priority, seq, ticket)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def submit(self, priority=0):
+        """Returns a ticket. Raises QueueFullError if the request cannot be queued."""
+        ticket = {"priority": priority, "admitted": False, "released": False, "queued_at": time.perf_counter()}
+        with self._cond:
+            if self._active < self.slots and not self._waiting:
+                self._active += 1
+                ticket["admitted"] = True
+                return ticket
+            if len(self._waiting) >= self.max_queued:
+                raise QueueFullError("The server is busy. Please try again in a moment.")
+            heapq.heappush(self._waiting, (priority, next(self._seq), ticket))
+        return ticket
+
+    def wait(self, ticket, timeout):
+        """Waits up to timeout seconds for a slot. Returns True once the ticket is admitted."""
+        with self._cond:
+            return self._cond.wait_for(lambda: ticket["admitted"], timeout)
+
+    def position(self, ticket):
+        """Returns the 1-based position of a waiting ticket, or 0 if it has been admitted."""
+        with self._cond:
+            if ticket["admitted"]:
+                return 0
+            for position, (_, _, waiting_ticket) in enumerate(sorted(self._waiting, key=lambda w: w[:2]), 1):
+                if waiting_ticket is ticket:
+                    return position
+            return 0
+
+    def release(self, ticket):
+        """Frees the ticket's slot, or removes it from the queue if it never got one. Safe to call twice."""
+        with self._cond:
+            if ticket["released"]:
+                return
+            ticket["released"] = True
+            if ticket["admitted"]:
+                self._active -= 1
+            else:
+                self._waiting = [w for w in self._waiting if w[2] is not ticket]
+                heapq.heapify(self._waiting)
+            while self._active < self.slots and self._waiting:
+                _, _, next_ticket = heapq.heappop(self._waiting)
+                next_ticket["admitted"] = True
+                self._active += 1
+            self._cond.notify_all()
+
+
+scheduler = RequestScheduler(OLLAMA_PARALLEL_SLOTS, MAX_QUEUED_REQUESTS)
+
+
+# -----------------------------------------
+# Context window management:
+# Ollama silently drops the oldest tokens when a prompt is larger than
+# num_ctx. Instead, the history is trimmed here before it is sent:
+# the system persona is always kept, then as many of the newest messages
+# as fit into the agent's token budget. Agents with "summarizeHistory": true
+# also get a rolling summary of the messages that were trimmed.
+# An agent can set a smaller budget with "contextBudget" in agents.json.
+# -----------------------------------------
+
+def image_token_estimate(model):
+    """Returns the number of context tokens one image uses for the model (square images, the worst case)."""
+    profile = get_image_profile(model)
+    return math.ceil(profile["long_edge"] / profile["patch"]) ** 2
+
+
+def estimate_tokens(message, model=None):
+    """Roughly estimates the number of tokens a message will use, including its images."""
+    text_tokens = math.ceil(len(message.get('content') or '') / CHARS_PER_TOKEN)
+    image_count = len(message.get('images', [])) + len(message.get('attachments', []))
+    return MESSAGE_TOKEN_OVERHEAD + text_tokens + (image_count and image_count * image_token_estimate(model))
+
+
+_model_info_cache = {}
+_model_info_lock = threading.Lock()
+
+
+def get_model_info(model):
+    """Returns the model's max context length and capabilities from Ollama (cached)."""
+    with _model_info_lock:
+        if model in _model_info_cache:
+            return _model_info_cache[model]
+    info = {"context_length": None, "capabilities": []}
+    try:
+        shown = ollama.show(model)
+        for key, value in (shown.modelinfo or {}).items():
+            if key.endswith(".context_length"):
+                info["context_length"] = int(value)
+        info["capabilities"] = list(shown.capabilities or [])
+    except Exception as e:
+        # Don't cache failures, Ollama may just not be running yet
+        print(f"[ERROR] Could not read model info for '{model}': {e}", file=sys.stderr)
+        return info
+    with _model_info_lock:
+        _model_info_cache[model] = info
+    return info
+
+
+def max_context(model):
+    """Returns the largest num_ctx that will be used for the model."""
+    model_max = get_model_info(model)["context_length"]
+    return min(NUM_CTX, model_max) if model_max else NUM_CTX
+
+
+def choose_num_ctx(prompt_tokens, model, minimum=0):
+    """Picks the smallest context bucket that fits the prompt plus the reply reserve."""
+    needed = prompt_tokens + RESPONSE_TOKEN_RESERVE
+    bucket = next((b for b in NUM_CTX_BUCKETS if b >= needed), NUM_CTX_BUCKETS[-1])
+    return min(max(bucket, minimum), max_context(model))
+
+
+def context_budget(agent, model):
+    """Returns the number of prompt tokens allowed for an agent."""
+    budget = max_context(model) - RESPONSE_TOKEN_RESERVE
+    try:
+        if agent and agent.get("contextBudget"):
+            budget = min(budget, int(agent["contextBudget"]))
+    except (TypeError, ValueError):
+        pass
+    return budget
+
+
+def fit_messages_to_budget(messages, budget, model=None):
+    """Returns the index of the oldest message to keep so that the newest messages fit in budget.
+
+    The newest message is always kept, even if it is larger than the budget.
+    """
+    used = 0
+    start = len(messages)
+    for i in range(len(messages) - 1, -1, -1):
+        cost = estimate_tokens(messages[i], model)
+        if used + cost > budget and start < len(messages):
+            break
+        used += cost
+        start = i
+    # Don't start the window with a reply whose question was trimmed
+    while start < len(messages) - 1 and messages[start]['role'] == 'assistant':
+        start += 1
+    return start
+
+
+def summarize_messages(model, previous_summary, messages):
+    """Folds messages into the rolling summary of a conversation."""
+    lines = []
+    for msg in messages:
+        image_count = len(msg.get('images', [])) + len(msg.get('attachments', []))
+        images_note = f" [{image_count} image(s)]" if image_count else ""
+        lines.append(f"{msg['role']}: {msg.get('content', '')}{images_note}")
+    # Keep the summary request itself well inside the context
+    max_chars = (max_context(model) - SUMMARY_MAX_TOKENS) * CHARS_PER_TOKEN // 2
+    transcript = "\n".join(lines)[-max_chars:]
+
+    prompt = "Write a concise summary of the conversation below. Keep names, numbers, decisions and open questions.\n\n"
+    if previous_summary:
+        prompt += f"Summary of the conversation so far:\n{previous_summary}\n\n"
+    prompt += f"New messages:\n{transcript}"
+
+    num_ctx = choose_num_ctx(math.ceil(len(prompt) / CHARS_PER_TOKEN), model)
+    response = ollama_chat(
+        model=model,
+        messages=[{'role': 'user', 'content': prompt}],
+        options={"num_ctx": num_ctx, "num_predict": SUMMARY_MAX_TOKENS, "temperature": 0.2},
+    )
+    return re.sub(r"<think>[\s\S]*?</think>", "", response['message']['content']).strip()
+
+
+# -----------------------------------------
+# Thinking (reasoning) output:
+# Models with Ollama's "thinking" capability return their reasoning in a
+# separate field, and it can be switched off per agent with "think": false
+# in agents.json, which saves all the decoding time spent on reasoning.
+# Older models write their reasoning inline between <think> tags. Both are
+# sent to the browser as 'thinking' SSE events, separate from the answer.
+# -----------------------------------------
+
+class ThinkTagSplitter:
+    """Splits streamed text into thinking and content parts using <think> tags."""
+
+    OPEN_TAG = "<think>"
+    CLOSE_TAG = "</think>"
+
+    def __init__(self):
+        self.in_think = False
+        self._pending = ""
+
+    def feed(self, text):
+        """Returns a list of (field, text) pairs, where field is 'thinking' or 'chunk'."""
+        parts = []
+        buffer = self._pending + text
+        self._pending = ""
+        while buffer:
+            tag = self.CLOSE_TAG if self.in_think else self.OPEN_TAG
+            field = "thinking" if self.in_think else "chunk"
+            index = buffer.find(tag)
+            if index != -1:
+                if index:
+                    parts.append((field, buffer[:index]))
+                buffer = buffer[index + len(tag):]
+                self.in_think = not self.in_think
+                continue
+            # Hold back a possible partial tag at the end of the text
+            keep = next((n for n in range(len(tag) - 1, 0, -1) if buffer.endswith(tag[:n])), 0)
+            if len(buffer) > keep:
+                parts.append((field, buffer[:len(buffer) - keep]))
+            self._pending = buffer[len(buffer) - keep:]
+            break
+        return parts
+
+    def flush(self):
+        parts = [("thinking" if self.in_think else "chunk", self._pending)] if self._pending else []
+        self._pending = ""
+        return parts
+
+
+def think_option(model, agent):
+    """Returns the value for Ollama's think parameter, or None if the model can't think."""
+    if "thinking" not in get_model_info(model)["capabilities"]:
+        return None
+    return bool(agent.get("think", True)) if agent else True
+
+
+# -----------------------------------------
+# Metrics:
+# A small Prometheus-style registry. GET /metrics returns the text
+# exposition format, so the numbers can be read in a browser or scraped by
+# a local Prometheus. Nothing is sent anywhere. Chat and pdf metrics are
+# labeled by model and agent, so a model swap via /change_model shows up
+# as a new series.
+# -----------------------------------------
+
+DEFAULT_SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape_label_value(v)}"' for k, v in labels) + "}"
+
+
+class Metric:
+    """A counter or gauge with labels."""
+
+    def __init__(self, name, help_text, metric_type):
+        self.name = name
+        self.help_text = help_text
+        self.metric_type = metric_type
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=None, value=1):
+        key = tuple(sorted((labels or {}).items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def dec(self, labels=None, value=1):
+        self.inc(labels, -value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Histogram(Metric):
+    """A histogram with labels and fixed bucket bounds."""
+
+    def __init__(self, name, help_text, buckets=DEFAULT_SECONDS_BUCKETS):
+        super().__init__(name, help_text, "histogram")
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, labels, value):
+        key = tuple(sorted((labels or {}).items()))
+        with self._lock:
+            entry = self._values.setdefault(key, {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry["counts"][i] += 1
+            entry["sum"] += value
+            entry["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, entry in self._values.items():
+                for bound, count in zip(self.buckets, entry["counts"]):
+                    lines.append(f"{self.name}_bucket{_format_labels(key + (('le', bound),))} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {entry['count']}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {entry['sum']}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {entry['count']}")
+        return lines
+
+
+METRICS = {
+    "requests": Metric("myofflineai_chat_requests_total", "Chat requests by outcome.", "counter"),
+    "active_streams": Metric("myofflineai_active_streams", "Chat responses currently being generated by Ollama.", "gauge"),
+    "ttft": Histogram("myofflineai_time_to_first_token_seconds", "Time from receiving a chat request to the first streamed token (includes queue wait)."),
+    "tokens_per_second": Histogram("myofflineai_tokens_per_second", "Decode speed from Ollama's eval_count / eval_duration.", (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 250)),
+    "prompt_eval": Histogram("myofflineai_prompt_eval_seconds", "Prompt processing (prefill) time reported by Ollama."),
+    "queue_wait": Histogram("myofflineai_queue_wait_seconds", "Time a chat request waited for a free Ollama slot."),
+    "cancel_latency": Histogram("myofflineai_cancel_latency_seconds", "Time from a cancel request to closing the Ollama stream.", (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)),
+    "tokens": Metric("myofflineai_tokens_total", "Prompt and completion tokens reported by Ollama.", "counter"),
+    "request_bytes": Histogram("myofflineai_request_bytes", "Size of request bodies.", (1e3, 1e4, 1e5, 1e6, 5e6, 1e7, 2e7, 5e7)),
+    "pdf_render": Histogram("myofflineai_pdf_page_render_seconds", "Time to rasterize one pdf page.", (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)),
+    "pdf_encode": Histogram("myofflineai_pdf_page_encode_seconds", "Time to encode one rendered pdf page.", (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)),
+    "retrieval": Histogram("myofflineai_retrieval_seconds", "Time to find the document excerpts for a question (includes indexing).", (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)),
+    "pdf_pages": Metric("myofflineai_pdf_pages_total", "Pdf pages processed, by path (text or image).", "counter"),
+    "pdf_cache": Metric("myofflineai_pdf_render_cache_total", "Rendered pdf pages found (hit) or not found (miss) in the render cache.", "counter"),
+}
+
+
+def metric_labels(model, agent_id):
+    """
+    The model and agent id come from the browser, so models that are not in
+    model_list and ids that are not in agents.json are counted as "other"
+    (every label value is a new series, kept forever).
+    """
+    if agent_ids is None:
+        load_agents()
+    if model and model not in model_list:
+        model = "other"
+    if agent_id and agent_id not in agent_ids:
+        agent_id = "other"
+    return {"model": model or "none", "agent": agent_id or "none"}
+
+
+# -----------------------------------------
+# Chunked uploads:
+# A large file is sent in parts with PUT /uploads/<id>?offset=N.
+# Each part is appended to a temp file, or written into a buffer of the
+# size of the file, and the sha256 is updated as the parts arrive. If a part fails, the browser asks for the offset the server
+# has and continues from there. A finished upload is passed to the pdf
+# endpoints by its upload_id.
+# -----------------------------------------
+
+class UploadError(Exception):
+    def __init__(self, message, status, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+class UploadStore:
+    """
+    Tracks chunked uploads. They are kept in memory, or written to temp
+    files in spool_dir if it is set and they are larger than spool_threshold.
+    Uploads kept in memory are limited to max_memory_size.
+    """
+
+    def __init__(self, spool_dir, spool_threshold, max_size, max_memory_size, ttl_seconds):
+        self.spool_dir = spool_dir
+        self.spool_threshold = spool_threshold
+        self.max_size = max_size
+        self.max_memory_size = max_memory_size
+        self.ttl_seconds = ttl_seconds
+        self._uploads = {}
+        self._lock = threading.Lock()
+
+    def create(self, filename, size):
+        if size <= 0 or size > self.max_size:
+            raise UploadError(f"File size must be between 1 byte and {self.max_size // (1024 * 1024)}MB.", 413)
+        self._remove_expired()
+        path = data = None
+        if self.spool_dir is not None and size > self.spool_threshold:
+            fd, path = tempfile.mkstemp(suffix=".upload", dir=self.spool_dir)
+            os.close(fd)
+        elif size > self.max_memory_size:
+            raise UploadError(f"File size must be at most {self.max_memory_size // (1024 * 1024)}MB.", 413)
+        else:
+            data = bytearray(size)
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self._uploads[upload_id] = {
+                "filename": filename, "size": size, "offset": 0, "path": path, "data": data,
+                "sha256": hashlib.sha256(), "last_used": time.time(), "lock": threading.Lock(),
+            }
+        return upload_id
+
+    def _get(self, upload_id):
+        with self._lock:
+            upload = self._uploads.get(upload_id)
+        if upload is None:
+            raise UploadError("Upload not found. It may have expired.", 404)
+        return upload
+
+    def status(self, upload_id):
+        upload = self._get(upload_id)
+        return {"offset": upload["offset"], "size": upload["size"], "complete": upload["offset"] == upload["size"]}
+
+    def append(self, upload_id, offset, stream):
+        """Appends a part that starts at offset. Returns the new offset."""
+        upload = self._get(upload_id)
+        with upload["lock"]:
+            if offset != upload["offset"]:
+                raise UploadError("Offset does not match the data received so far.", 409, upload["offset"])
+            written = 0
+            with (open(upload["path"], "ab") if upload["path"] else contextlib.nullcontext()) as f:
+                for chunk in iter(lambda: stream.read(1024 * 1024), b""):
+                    written += len(chunk)
+                    if upload["offset"] + written > upload["size"]:
+                        if f is not None:
+                            f.truncate(upload["offset"])
+                        raise UploadError("More data was sent than the size of the file.", 413, upload["offset"])
+                    upload["sha256"].update(chunk)
+                    if f is not None:
+                        f.write(chunk)
+                    else:
+                        start = upload["offset"] + written - len(chunk)
+                        upload["data"][start:start + len(chunk)] = chunk
+            upload["offset"] += written
+            upload["last_used"] = time.time()
+            return upload["offset"]
+
+    def take(self, upload_id):
+        """
+        Removes a finished upload from the store and returns (pdf, filename, sha256).
+        pdf is the path of its temp file, which the caller is responsible for
+        deleting, or the bytearray of an upload kept in memory (not copied).
+        """
+        upload = self._get(upload_id)
+        with upload["lock"]:
+            if upload["offset"] != upload["size"]:
+                raise UploadError("Upload is not complete.", 409, upload["offset"])
+            with self._lock:
+                if self._uploads.pop(upload_id, None) is None:
+                    raise UploadError("Upload not found. It may have expired.", 404)
+        return upload["path"] or upload["data"], upload["filename"], upload["sha256"].hexdigest()
+
+    def delete(self, upload_id):
+        with self._lock:
+            upload = self._uploads.pop(upload_id, None)
+        if upload is None:
+            return False
+        self._remove_file(upload["path"])
+        return True
+
+    def _remove_expired(self):
+        now = time.time()
+        with self._lock:
+            expired = [k for k, u in self._uploads.items() if now - u["last_used"] > self.ttl_seconds]
+            paths = [self._uploads.pop(k)["path"] for k in expired]
+        for path in paths:
+            self._remove_file(path)
+
+    @staticmethod
+    def _remove_file(path):
+        if not isinstance(path, str):
+            return
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+upload_store = UploadStore(UPLOAD_SPOOL_DIR, UPLOAD_SPOOL_THRESHOLD, MAX_CHUNKED_UPLOAD_SIZE,
+                           MAX_UPLOAD_FILE_SIZE, UPLOAD_TTL_SECONDS)
+
+
+
+# -----------------------------------------
+# Document retrieval (RAG):
+# The text of a pdf (made by plan_pdf_pages) is split into chunks along
+# its layout blocks, so a chunk never cuts a paragraph, list or heading
+# in half and never spans two pages. Chunks are embedded with a local
+# Ollama embedding model. For each question the most similar chunks are
+# put into the prompt with page citations.
+# The chunk text is kept in RAM, the embeddings in a VectorIndex.
+# -----------------------------------------
+
+PAGE_HEADING_RE = re.compile(r"^## Page (\d+)$", re.MULTILINE)
+SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s+")
+EMBED_BATCH_SIZE = 32
+RRF_K = 60
+
+
+def _pack(pieces, limit, joiner):
+    """Joins pieces greedily into strings of at most limit characters (unless a piece is longer)."""
+    packed = []
+    for piece in pieces:
+        if packed and len(packed[-1]) + len(joiner) + len(piece) <= limit:
+            packed[-1] += joiner + piece
+        else:
+            packed.append(piece)
+    return packed
+
+
+def chunk_document(text):
+    """Splits a document into [{"page": n, "text": ...}] chunks of whole layout blocks."""
+    chunks = []
+    parts = PAGE_HEADING_RE.split(text)
+    for page, body in zip(parts[1::2], parts[2::2]):
+        blocks = []
+        for block in body.split("\n\n"):
+            block = block.strip()
+            if not block or block.startswith("(This page is"):
+                continue
+            if len(block) > RAG_CHUNK_CHARS:
+                blocks.extend(_pack(SENTENCE_END_RE.split(block), RAG_CHUNK_CHARS, " "))
+            else:
+                blocks.append(block)
+
+        # A heading starts a new chunk
+        groups = []
+        for block in blocks:
+            if block.startswith("#") or not groups:
+                groups.append([block])
+            else:
+                groups[-1].append(block)
+        for group in groups:
+            for chunk_text in _pack(group, RAG_CHUNK_CHARS, "\n\n"):
+                chunks.append({"page": int(page), "text": chunk_text})
+    return chunks
+
+
+_embed_model = {"checked": False, "name": None}
+_embed_model_lock = threading.Lock()
+
+
+def get_embed_model():
+    """Returns RAG_EMBED_MODEL, or the first downloaded model that can make embeddings (or None)."""
+    if RAG_EMBED_MODEL:
+        return RAG_EMBED_MODEL
+    with _embed_model_lock:
+        if not _embed_model["checked"]:
+            _embed_model["checked"] = True
+            _embed_model["name"] = next(
+                (m for m in model_list if "embedding" in get_model_info(m)["capabilities"]),
+                next((m for m in model_list if "embed" in m.lower()), None),
+            )
+            if _embed_model["name"]:
+                print(f"[INFO] Using '{_embed_model['name']}' for document search.")
+            else:
+                print("[INFO] No embedding model found. Documents are searched by words.")
+        return _embed_model["name"]
+
+
+def embed_texts(model, texts):
+    """Returns unit length embedding vectors for the texts, as a (len(texts), dim) array."""
+    vectors = []
+    for start in range(0, len(texts), EMBED_BATCH_SIZE):
+        response = ollama.embed(model=model, input=texts[start:start + EMBED_BATCH_SIZE])
+        vectors.extend(response["embeddings"])
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1.0, norms)
+
+
+def fuse_rankings(rankings, k):
+    """Reciprocal rank fusion of ranked lists of keys. Returns the k best (key, score) pairs."""
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (RRF_K + rank + 1)
+    return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+
+class DocumentIndex:
+    """
+    Chunks of documents, keyed by the document's attachment handle (LRU).
+    All chunks are in one BM25Index, always in RAM. The chunk embeddings
+    are kept in a VectorIndex per embedding model, in RAM or (with a
+    directory) on disk. Which rows belong to which document is only known
+    in RAM, so a model's folder is cleared when it is first opened.
+    """
+
+    def __init__(self, max_documents, directory=None, dtype="int8"):
+        self.max_documents = max_documents
+        self.directory = directory
+        self.dtype = dtype
+        self._stores = {}  # embedding model -> VectorIndex
+        self._words = BM25Index()
+        self._docs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def ensure(self, doc_id):
+        """
+        Returns the index of a document, building it first if needed.
+        Callers that ask while it is being built wait for it.
+        Raises AttachmentMissingError if the document is no longer stored.
+        """
+        with self._lock:
+            entry = self._docs.get(doc_id)
+            build = entry is None
+            if build:
+                entry = {"ready": threading.Event(), "error": None}
+                self._docs[doc_id] = entry
+                while len(self._docs) > self.max_documents:
+                    self._forget(self._docs.popitem(last=False)[1])
+            else:
+                self._docs.move_to_end(doc_id)
+
+        if build:
+            try:
+                self._build(doc_id, entry)
+            except Exception as e:
+                entry["error"] = e
+                with self._lock:
+                    if self._docs.get(doc_id) is entry:
+                        del self._docs[doc_id]
+            finally:
+                entry["ready"].set()
+        entry["ready"].wait()
+        if entry["error"]:
+            raise entry["error"]
+        return entry
+
+    def ensure_in_background(self, doc_id):
+        def run():
+            try:
+                self.ensure(doc_id)
+            except Exception as e:
+                print(f"[ERROR] Could not index document: {e}", file=sys.stderr)
+        threading.Thread(target=run, daemon=True).start()
+
+    def _store(self, embed_model, dim):
+        """Returns the vector index for an embedding model. Call with the lock held."""
+        if embed_model not in self._stores:
+            folder = None
+            if self.directory:
+                folder = os.path.join(self.directory, hashlib.sha256(embed_model.encode("utf-8")).hexdigest()[:16])
+                shutil.rmtree(folder, ignore_errors=True)  # rows of an earlier run that no document refers to
+            self._stores[embed_model] = VectorIndex(folder, dim, self.dtype)
+        return self._stores[embed_model]
+
+    def _forget(self, entry):
+        """Deletes the chunks and vectors of an evicted document. Call with the lock held."""
+        if entry.get("chunk_ids") is not None:
+            self._words.remove(entry["chunk_ids"])
+            entry["chunk_ids"] = None
+            if self._words.deleted_count > len(self._words):
+                self._words.compact()
+
+        store = self._stores.get(entry.get("embed_model"))
+        if store is None or entry.get("rows") is None:
+            return
+        store.delete(entry["rows"])
+        entry["rows"] = None
+        # Rewrite the index once most of it is deleted vectors
+        if store.deleted_count > len(store):
+            mapping = store.compact()
+            for other in self._docs.values():
+                if other.get("embed_model") == entry["embed_model"] and other.get("rows") is not None:
+                    other["rows"] = mapping[other["rows"]]
+
+    def _build(self, doc_id, entry):
+        start = time.perf_counter()
+        text = read_document(f"{ATTACHMENT_URL_PREFIX}{doc_id}")
+        name = text.split("\n", 1)[0].lstrip("# ").strip()
+        chunks = chunk_document(text)
+        vectors = None
+        embed_model = get_embed_model()
+        if embed_model and chunks:
+            try:
+                vectors = embed_texts(embed_model, [f"{name}, page {c['page']}: {c['text']}" for c in chunks])
+            except Exception as e:
+                print(f"[ERROR] Could not embed '{name}' with '{embed_model}', using word search: {e}", file=sys.stderr)
+
+        with self._lock:
+            entry.update(name=name, chunks=chunks, rows=None, embed_model=None)
+            entry["chunk_ids"] = self._words.add([f"{name} {c['text']}" for c in chunks])
+            if vectors is not None:
+                store = self._store(embed_model, vectors.shape[1])
+                entry.update(embed_model=embed_model, rows=store.append(vectors, [{"doc": doc_id, "page": c["page"]} for c in chunks]))
+            if self._docs.get(doc_id) is not entry:
+                # Evicted while it was being built
+                self._forget(entry)
+        method = f"embeddings from '{embed_model}'" if vectors is not None else "BM25 word search"
+        print(f"[INFO] Indexed '{name}': {len(chunks)} chunks, {method}, {time.perf_counter() - start:.2f} s")
+
+    def search(self, doc_ids, question, k):
+        """Returns the k best chunks of the documents as [{"name", "page", "text", "score"}]."""
+        entries = [self.ensure(doc_id) for doc_id in doc_ids]
+        with self._lock:
+            by_chunk_id = {}
+            for entry in entries:
+                if entry["chunk_ids"] is not None:
+                    by_chunk_id.update(zip(entry["chunk_ids"], ((entry, chunk) for chunk in entry["chunks"])))
+        if not by_chunk_id:
+            return []
+
+        hits = []
+        if question.strip():
+            embed_models = {entry["embed_model"] for entry in entries}
+            use_vectors = len(embed_models) == 1 and None not in embed_models
+            use_words = not use_vectors or RAG_FUSION
+            depth = k * 3 if use_vectors and use_words else k
+            rankings = []
+            if use_vectors:
+                embed_model = embed_models.pop()
+                query = embed_texts(embed_model, [question])[0]
+                with self._lock:
+                    by_row = {}
+                    for entry in entries:
+                        if entry["rows"] is not None:
+                            by_row.update((int(row), chunk_id) for row, chunk_id in zip(entry["rows"], entry["chunk_ids"]))
+                    rows = np.fromiter(by_row, dtype=np.int64, count=len(by_row))
+                    found = self._stores[embed_model].search(query, depth, rows=rows) if len(rows) else []
+                rankings.append([(by_row[row], score) for row, score in found])
+            if use_words:
+                rankings.append(self._words.search(question, depth, chunk_ids=list(by_chunk_id)))
+
+            if len(rankings) > 1:
+                hits = fuse_rankings([[chunk_id for chunk_id, _ in ranking] for ranking in rankings], k)
+            else:
+                hits = rankings[0][:k]
+        if not hits:
+            # Nothing matched (or nothing to search for), so use the beginning of the documents
+            hits = [(chunk_id, 0.0) for chunk_id in itertools.islice(by_chunk_id, k)]
+
+        return [
+            {"name": by_chunk_id[chunk_id][0]["name"], "page": by_chunk_id[chunk_id][1]["page"],
+             "text": by_chunk_id[chunk_id][1]["text"], "score": score}
+            for chunk_id, score in hits
+        ]
+
+    def close(self):
+        """Closes the vector indexes."""
+        with self._lock:
+            for store in self._stores.values():
+                store.close()
+            self._stores.clear()
+            self._docs.clear()
+
+
+def format_excerpts(excerpts, question):
+    """Puts the retrieved chunks in front of the user's question."""
+    if not excerpts:
+        return question
+    sections = [f"[{e['name']}, page {e['page']}]\n{e['text']}" for e in excerpts]
+    return (
+        "Excerpts from the attached documents. Answer using these excerpts and "
+        "cite the pages you use, like [document name, page 3].\n\n"
+        + "\n\n".join(sections)
+        + f"\n\nQuestion: {question}"
+    )
+
+
+document_index = DocumentIndex(RAG_MAX_DOCUMENTS, VECTOR_INDEX_DIR, VECTOR_INDEX_DTYPE)
+atexit.register(document_index.close)
+
+
+
+# -----------------------------------------
+# Document summarization (map-reduce):
+# A document that is larger than the context is split into parts along
+# its pages. Every part is summarized on its own (map). The part summaries
+# are then packed into groups that fit the context and each group is
+# summarized again (reduce), until one summary is left.
+# Every call is cached by a hash of its input, so after one page changes
+# only that part and the reduce calls above it are run again. The part
+# boundaries also depend only on nearby pages, so a change does not move
+# all the later parts.
+# -----------------------------------------
+
+SUMMARY_MAP_PROMPT = (
+    "Summarize the following part of a document ({label}). Keep the key facts, "
+    "names, numbers, decisions and conclusions. Write only the summary.\n\n{text}"
+)
+SUMMARY_REDUCE_PROMPT = (
+    "Below are summaries of consecutive parts of a document, in order. Combine "
+    "them into one summary that keeps the key facts, names, numbers, decisions "
+    "and conclusions. Write only the summary.\n\n{text}"
+)
+SUMMARY_FINAL_PROMPT = (
+    "{text}\n\nWrite a well structured summary of the document above ({label}). "
+    "Start with a short overview, then the main points as a list, and say "
+    "which pages they come from where you can."
+)
+
+summary_cache = RenderCache(SUMMARY_CACHE_LIMIT)
+
+
+class SummaryCancelledError(Exception):
+    """Raised in a summary worker when the browser has gone away."""
+
+
+def summary_part_tokens(model):
+    """Returns the max input tokens of one summary call."""
+    fit = max_context(model) - SUMMARY_FINAL_MAX_TOKENS - 256  # prompt text and message overhead
+    return min(SUMMARY_PART_TOKENS or fit, fit)
+
+
+def page_label(first, last):
+    return f"page {first}" if first == last else f"pages {first}-{last}"
+
+
+def split_summary_parts(text, part_tokens):
+    """Splits a document into [{"first": 1, "last": 4, "text": ...}] parts of at most part_tokens."""
+    max_chars = part_tokens * CHARS_PER_TOKEN
+    pages = []
+    parts_of_text = PAGE_HEADING_RE.split(text)
+    for page, body in zip(parts_of_text[1::2], parts_of_text[2::2]):
+        body = body.strip()
+        if not body or body.startswith("(This page is"):
+            continue
+        # A page larger than a part is split along its paragraphs
+        for piece in _pack(body.split("\n\n"), max_chars, "\n\n"):
+            for start in range(0, len(piece), max_chars):
+                pages.append((int(page), piece[start:start + max_chars]))
+
+    parts = []
+    current = []
+    for page, body in pages:
+        size = sum(len(b) for _, b in current)
+        if current and size + len(body) > max_chars:
+            parts.append(current)
+            current = []
+        current.append((page, body))
+        # End the part early after some pages (picked by their content) once
+        # it is half full. This keeps the boundaries stable when pages change.
+        anchor = int(hashlib.sha256(body.encode("utf-8")).hexdigest()[:8], 16) % 4 == 0
+        if anchor and size + len(body) >= max_chars // 2:
+            parts.append(current)
+            current = []
+    if current:
+        parts.append(current)
+
+    return [
+        {"first": part[0][0], "last": part[-1][0],
+         "text": "\n\n".join(f"[Page {page}]\n{body}" for page, body in part)}
+        for part in parts
+    ]
+
+
+def run_summary_call(model, prompt, max_tokens, cancel):
+    """
+    Runs one summary call through the request scheduler and returns
+    (text, cached). Waits behind chat requests (SUMMARY_PRIORITY).
+    """
+    key = RenderCache.key("summary", model, max_tokens, hashlib.sha256(prompt.encode("utf-8")).hexdigest())
+    cached = summary_cache.get(key)
+    if cached is not None:
+        return cached.decode("utf-8"), True
+
+    ticket = scheduler.submit(SUMMARY_PRIORITY)
+    try:
+        while not scheduler.wait(ticket, QUEUE_UPDATE_INTERVAL):
+            if cancel.is_set():
+                raise SummaryCancelledError()
+        if cancel.is_set():
+            raise SummaryCancelledError()
+        num_ctx = choose_num_ctx(math.ceil(len(prompt) / CHARS_PER_TOKEN) + max_tokens, model)
+        response = ollama_chat(
+            model=model,
+            messages=[{'role': 'user', 'content': prompt}],
+            think=think_option(model, {"think": False}),
+            options={"num_ctx": num_ctx, "num_predict": max_tokens, "temperature": 0.2},
+        )
+    finally:
+        scheduler.release(ticket)
+    text = re.sub(r"<think>[\s\S]*?</think>", "", response['message']['content']).strip()
+    summary_cache.put(key, text.encode("utf-8"))
+    return text, False
+
+
+def summarize_document_events(model, text, cancel):
+    """
+    Summarizes a document and yields progress events:
+      {"stage": "map" or "reduce", "round": n, "done": i, "total": n, "cached": c}
+      {"summary": "...", "parts": n, "calls": n, "cached": n}
+    """
+    name = text.split("\n", 1)[0].lstrip("# ").strip()
+    part_tokens = summary_part_tokens(model)
+    parts = split_summary_parts(text, part_tokens)
+    if not parts:
+        raise ValueError("The document has no text to summarize.")
+    stats = {"calls": 0, "cached": 0}
+
+    def run_round(stage, round_number, jobs):
+        """Runs (prompt, max_tokens) jobs in parallel and returns the results in order."""
+        results = [None] * len(jobs)
+        done = cached = 0
+        finished = False
+        yield {"stage": stage, "round": round_number, "done": 0, "total": len(jobs), "cached": 0}
+        pool = ThreadPoolExecutor(max_workers=scheduler.slots)
+        try:
+            futures = {pool.submit(run_summary_call, model, prompt, max_tokens, cancel): i
+                       for i, (prompt, max_tokens) in enumerate(jobs)}
+            for future in as_completed(futures):
+                results[futures[future]], was_cached = future.result()
+                done += 1
+                cached += was_cached
+                yield {"stage": stage, "round": round_number, "done": done, "total": len(jobs), "cached": cached}
+            finished = True
+        finally:
+            if not finished:
+                # An error or a disconnect: stop the calls that are still waiting
+                cancel.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+        stats["calls"] += len(jobs)
+        stats["cached"] += cached
+        return results
+
+    first, last = parts[0]["first"], parts[-1]["last"]
+    label = f"{name}, {page_label(first, last)}"
+    if len(parts) == 1:
+        # Short document, one call is enough
+        job = (SUMMARY_FINAL_PROMPT.format(text=parts[0]["text"], label=label), SUMMARY_FINAL_MAX_TOKENS)
+        results = yield from run_round("map", 1, [job])
+        yield {"summary": results[0], "parts": 1, **stats}
+        return
+
+    jobs = [(SUMMARY_MAP_PROMPT.format(label=page_label(part["first"], part["last"]), text=part["text"]), SUMMARY_PART_MAX_TOKENS)
+            for part in parts]
+    results = yield from run_round("map", 1, jobs)
+    items = [(part["first"], part["last"], summary) for part, summary in zip(parts, results)]
+
+    max_chars = part_tokens * CHARS_PER_TOKEN
+    round_number = 1
+    while True:
+        round_number += 1
+        # Pack consecutive summaries into groups that fit one call
+        groups = []
+        size = 0
+        for item in items:
+            item_size = len(item[2]) + 40
+            if groups and size + item_size <= max_chars:
+                groups[-1].append(item)
+                size += item_size
+            else:
+                groups.append([item])
+                size = item_size
+        if len(groups) == len(items) > 1:
+            # Each summary fills a group by itself, pair them up so the rounds get shorter
+            groups = [items[i:i + 2] for i in range(0, len(items), 2)]
+
+        texts = ["\n\n".join(f"Summary of {page_label(f, l)}:\n{summary}" for f, l, summary in group) for group in groups]
+        if len(groups) == 1:
+            results = yield from run_round("reduce", round_number, [(SUMMARY_FINAL_PROMPT.format(text=texts[0], label=label), SUMMARY_FINAL_MAX_TOKENS)])
+            yield {"summary": results[0], "parts": len(parts), **stats}
+            return
+        results = yield from run_round("reduce", round_number, [(SUMMARY_REDUCE_PROMPT.format(text=text), SUMMARY_PART_MAX_TOKENS) for text in texts])
+        items = [(group[0][0], group[-1][1], summary) for group, summary in zip(groups, results)]
+
+
+
+# -----------------------------------------
+# Image normalization:
+# Images are resized and re-encoded for the model before they are stored,
+# so only pixels that the vision encoder will use are kept.
+# -----------------------------------------
+
+def get_image_profile(model):
+    """Returns the image profile (long_edge, patch, format, quality) for a model."""
+    name = (model or "").lower()
+    for key, profile in IMAGE_PROFILES:
+        if key in name:
+            return profile
+    return DEFAULT_IMAGE_PROFILE
+
+
+def normalize_image(data, profile):
+    """
+    Resizes an image so that its longest side is at most the profile's
+    long_edge, and re-encodes it. Returns (data, mimetype).
+    Images that already fit, are in the right format and need no rotation
+    are returned unchanged so they are not re-compressed.
+    """
+    long_edge = profile.get("long_edge")
+    image_format = profile.get("format", "JPEG")
+    with Image.open(io.BytesIO(data)) as img:
+        too_large = long_edge and max(img.size) > long_edge
+        rotated = img.getexif().get(0x0112, 1) != 1  # EXIF orientation
+        if not too_large and not rotated and img.format == image_format:
+            return data, IMAGE_MIMETYPES[image_format]
+
+        if too_large:
+            # Lets the JPEG decoder skip pixels that would be thrown away
+            img.draft("RGB", (long_edge, long_edge))
+        img = ImageOps.exif_transpose(img)
+        if image_format == "JPEG" and img.mode != "RGB":
+            # JPEG has no transparency, so it is placed on white
+            rgba = img.convert("RGBA")
+            img = Image.new("RGB", rgba.size, "white")
+            img.paste(rgba, mask=rgba.getchannel("A"))
+        if too_large:
+            img.thumbnail((long_edge, long_edge), Image.LANCZOS)
+
+        byte_io = io.BytesIO()
+        img.save(byte_io, image_format, quality=profile.get("quality", 85), optimize=True)
+    return byte_io.getvalue(), IMAGE_MIMETYPES[image_format]
+
+
+def to_ollama_messages(client_messages, inline_documents=True, document_budget=None):
+    """Converts messages in the browser's OpenAI-like format into Ollama messages.
+
+    Images that refer to the attachment store are kept as handles under
+    'attachments'. Call resolve_attachments() before sending to Ollama.
+    Documents (the text pages of a pdf) are placed before the message text,
+    cut off so that the message fits into document_budget tokens, or, with
+    inline_documents=False, kept as handles under 'documents' so that only
+    retrieved excerpts are sent.
+    Returns (messages, notices), notices tell which documents were cut off.
+    """
+    ollama_messages = []
+    notices = []
+    for msg in client_messages:
+        role = msg.get('role')
+        content = msg.get('content')
+
+        if isinstance(content, list):
+            image_urls = [part.get('image_url', {}).get('url', '') for part in content if part.get('type') == 'image_url']
+            handles = [url[len(ATTACHMENT_URL_PREFIX):] for url in image_urls if url.startswith(ATTACHMENT_URL_PREFIX)]
+            image_parts = [url.split(',', 1)[1] for url in image_urls if url.startswith('data:') and ',' in url]
+            text_parts = [part.get('text', '') for part in content if part.get('type') == 'text']
+            document_urls = [part.get('document', {}).get('url', '') for part in content if part.get('type') == 'document']
+            document_texts = [read_document(url) for url in document_urls] if inline_documents else []
+
+            text = " ".join(text_parts)
+            if document_texts and document_budget is not None:
+                question_tokens = estimate_tokens({'content': text, 'images': image_parts + handles})
+                max_chars = max(0, document_budget - question_tokens) * CHARS_PER_TOKEN
+                for i, document_text in enumerate(document_texts):
+                    document_texts[i], notice = cut_document(document_text, max_chars)
+                    max_chars = max(0, max_chars - len(document_texts[i]))
+                    if notice:
+                        notices.append(notice)
+            ollama_msg = {'role': role, 'content': "\n\n".join(document_texts + [text]) if document_texts else text}
+            if document_urls and not inline_documents:
+                for url in document_urls:
+                    read_document(url)  # fail early if it is gone
+                ollama_msg['documents'] = [url[len(ATTACHMENT_URL_PREFIX):] for url in document_urls]
+            if image_parts:
+                ollama_msg['images'] = image_parts
+            if handles:
+                ollama_msg['attachments'] = handles
+            ollama_messages.append(ollama_msg)
+
+        elif isinstance(content, str):
+            ollama_messages.append({'role': role, 'content': content})
+    return ollama_messages, notices
+
+
+def cut_document(text, max_chars):
+    """
+    Cuts the text of a document (see plan_pdf_pages) at the last page break
+    before max_chars. Returns (text, notice), notice is None if it fits.
+    """
+    if len(text) <= max_chars:
+        return text, None
+    cut = text.rfind("\n\n## Page ", 0, max_chars)
+    kept = text[:cut] if cut > 0 else text[:max_chars]
+    pages = re.findall(r"^## Page (\d+)$", text, re.M)
+    kept_pages = re.findall(r"^## Page (\d+)$", kept, re.M)
+    name = text.split("\n", 1)[0].lstrip("# ")
+    notice = (
+        f"'{name}' is too long for the context: only {len(kept_pages)} of its {len(pages)} pages "
+        f"were sent to the AI. Use an agent with retrieval to ask about the whole document."
+    )
+    kept += "\n\n(The rest of this document was left out because it does not fit into the context.)"
+    return kept, notice
+
+
+def read_document(url):
+    """Returns the text of a document in the attachment store."""
+    entry = attachment_store.get(url[len(ATTACHMENT_URL_PREFIX):]) if url.startswith(ATTACHMENT_URL_PREFIX) else None
+    if entry is None:
+        raise AttachmentMissingError("An attached document is no longer in memory. Please attach it again.")
+    return entry[0].decode('utf-8')
+
+
+def resolve_attachments(ollama_messages):
+    """Returns a copy of the messages with attachment handles replaced by raw image bytes."""
+    resolved = []
+    for msg in ollama_messages:
+        images = list(msg.get('images', []))
+        for handle in msg.get('attachments', []):
+            entry = attachment_store.get(handle)
+            if entry is None:
+                raise AttachmentMissingError("An attached image is no longer in memory. Please attach it again.")
+            images.append(entry[0])
+        resolved_msg = {'role': msg['role'], 'content': msg['content']}
+        if images:
+            resolved_msg['images'] = images
+        resolved.append(resolved_msg)
+    return resolved
+
+
+
 # -----------------------------------------
 # Flask Code
 # -----------------------------------------
 
+class SpoolingRequest(Request):
+    """
+    Keeps uploaded files in memory, or, if UPLOAD_SPOOL_DIR is set and the
+    request is larger than UPLOAD_SPOOL_THRESHOLD, writes them to named temp
+    files so that a pdf can be handed to the pdf workers by path. The files
+    are deleted at the end of the request unless a view takes them over with
+    take_spooled_file().
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if UPLOAD_SPOOL_DIR is None or (total_content_length or 0) <= UPLOAD_SPOOL_THRESHOLD:
+            return io.BytesIO()
+        f = tempfile.NamedTemporaryFile("wb+", suffix=".upload", dir=UPLOAD_SPOOL_DIR, delete=False)
+        self.spooled_files = getattr(self, "spooled_files", []) + [f]
+        return f
+
+
 app = Flask(__name__)
+app.request_class = SpoolingRequest
 app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_FILE_SIZE
 
 
+@app.teardown_request
+def remove_spooled_files(exc):
+    for f in getattr(request, "spooled_files", []):
+        f.close()
+        try:
+            os.remove(f.name)
+        except OSError:
+            pass
+
+
+def take_spooled_file(file_storage):
+    """
+    Closes an uploaded file and returns the path of its temp file, which the
+    caller must delete, or its bytes if it was kept in memory.
+    """
+    f = file_storage.stream
+    if isinstance(f, io.BytesIO):
+        return f.getvalue()
+    f.close()
+    request.spooled_files.remove(f)
+    return f.name
+
+
 # --- HTML Template ---
 HTML_TEMPLATE = r"""
 <!DOCTYPE html>
@@ -602,6 +2217,22 @@ HTML_TEMPLATE = r"""
                         </select>
                     </div>
 
+                    <div>
+                        <label for="agent-think" class="block text-sm font-medium text-slate-700 mb-1">Reasoning (for thinking models)</label>
+                        <select id="agent-think" class="w-full p-2 border border-slate-300 rounded-lg focus:outline-none focus:ring-2 focus:ring-indigo-500 bg-white">
+                            <option value="on">On</option>
+                            <option value="off">Off (faster replies)</option>
+                        </select>
+                    </div>
+
+                    <div>
+                        <label for="agent-retrieval" class="block text-sm font-medium text-slate-700 mb-1">Attached pdf text</label>
+                        <select id="agent-retrieval" class="w-full p-2 border border-slate-300 rounded-lg focus:outline-none focus:ring-2 focus:ring-indigo-500 bg-white">
+                            <option value="off">Send the whole document</option>
+                            <option value="on">Send the passages that match each question (long documents)</option>
+                        </select>
+                    </div>
+
                     <div>
 						<p class="text-xs text-slate-400 mt-1">
 						 This information is saved in a local file. Do not include sensitive data. Deleting the Tool will permanently delete this data from the file.
@@ -664,7 +2295,12 @@ HTML_TEMPLATE = r"""
         let currentAgentId = null;
         let isTyping = false;
         let abortControllers = {};
+        // Saved chats are listed without their messages ({id, title,
+        // timestamp, message_count}). A chat's messages are fetched when it
+        // is opened: the last CHAT_MESSAGES_PAGE_SIZE first, earlier ones on request.
         let savedHistories = {};
+        let savedChatsHasMore = {};
+        const CHAT_MESSAGES_PAGE_SIZE = 40;
         // REMOVED: let sortable = null;
 
 
@@ -812,7 +2448,9 @@ HTML_TEMPLATE = r"""
                     history: [],
                     agent: agent,
                     showFullHistory: false,
-                    chatId: 'new'
+                    chatId: 'new',
+                    sessionId: newSessionId(),
+                    syncedCount: 0
                 };
             }
             tabBtn.classList.add('text-indigo-700', 'bg-indigo-100');
@@ -823,6 +2461,8 @@ HTML_TEMPLATE = r"""
 
 
         async function closeChatTab(agentId) {
+            const sessionId = activeChats[agentId]?.sessionId;
+            if (sessionId) fetch(`/sessions/${sessionId}`, { method: 'DELETE' }).catch(() => {});
             document.getElementById(`tab-btn-${agentId}`)?.remove();
             document.getElementById(`chat-view-${agentId}`)?.remove();
             delete activeChats[agentId];
@@ -864,6 +2504,7 @@ HTML_TEMPLATE = r"""
                         <h3 class="font-bold text-lg text-slate-700">Chat History</h3>
                         <button class="close-history-panel-btn text-slate-500 hover:text-slate-800 text-2xl" data-agent-id="${agent.id}">&times;</button>
                     </div>
+                    <input type="search" id="chat-search-${agent.id}" placeholder="Search saved chats..." autocomplete="off" class="chat-search-input w-full mb-3 p-2 text-sm border border-slate-300 rounded-lg focus:outline-none focus:ring-2 focus:ring-indigo-500">
                     <div id="chat-history-list-${agent.id}" class="space-y-2"></div>
                 </div>
                 <!-- END: History Panel -->
@@ -892,7 +2533,7 @@ HTML_TEMPLATE = r"""
 		                 <div class="typing-dot w-2 h-2 bg-slate-400 rounded-full"></div>
 		                 <div class="typing-dot w-2 h-2 bg-slate-400 rounded-full"></div>
 		                 <div class="typing-dot w-2 h-2 bg-slate-400 rounded-full"></div>
-		                 <span>${agent.name} is processing...</span>
+		                 <span class="loading-text">${agent.name} is processing...</span>
 		            </div>
 		            <form class="chat-form flex flex-col" data-agent-id="${agent.id}">
 		                <div id="image-preview-container-${agent.id}" class="mb-2 hidden flex flex-wrap gap-2"></div>
@@ -932,8 +2573,25 @@ HTML_TEMPLATE = r"""
                 historyPanel.classList.add('translate-x-full');
             };
 
-		    historyToggleBtn.onclick = () => {
-		        activeChats[agent.id].showFullHistory = !activeChats[agent.id].showFullHistory;
+            // Search the saved chats while typing (after a short pause)
+            const chatSearchInput = chatView.querySelector('.chat-search-input');
+            let chatSearchTimer = null;
+            chatSearchInput.oninput = () => {
+                clearTimeout(chatSearchTimer);
+                chatSearchTimer = setTimeout(() => {
+                    const query = chatSearchInput.value.trim();
+                    if (query) searchSavedChats(agent.id, query);
+                    else renderSavedChatsList(agent.id);
+                }, 250);
+            };
+
+		    historyToggleBtn.onclick = async () => {
+		        const chat = activeChats[agent.id];
+		        if (chat.showFullHistory && chat.historyStart > 0) {
+		            if (!await loadEarlierMessages(agent.id)) showError('Could not load the earlier messages.');
+		        } else {
+		            chat.showFullHistory = !chat.showFullHistory;
+		        }
 		        renderChatHistory(agent.id);
 		    };
 
@@ -995,65 +2653,67 @@ HTML_TEMPLATE = r"""
 		        const files = event.target.files;
 		        if (!files) return;
 
-		        const filePromises = Array.from(files).map(file => {
-		            return new Promise(async (resolve, reject) => {
-		                if (file.type === 'application/pdf') {
-		                    const formData = new FormData();
-		                    formData.append('pdf_file', file);
-		                    try {
-		                        const response = await fetch('/upload_pdf', {
-		                            method: 'POST',
-		                            body: formData
-		                        });
-		                        const result = await response.json();
-		                        if (response.ok) {
-		                            resolve(result.images);
-		                        } else {
-		                            reject(new Error(result.error || 'Failed to convert PDF to images.'));
-		                        }
-		                    } catch (error) {
-		                        reject(error);
-		                    }
-		                } else {
-		                    const reader = new FileReader();
-		                    reader.onload = () => resolve(reader.result);
-		                    reader.onerror = reject;
-		                    reader.readAsDataURL(file);
+		        const pending = chatView.pendingUploads || (chatView.pendingUploads = new Set());
+
+		        function addDocument(doc) {
+		            const existingDocs = JSON.parse(chatView.dataset.documentArray || '[]');
+		            chatView.dataset.documentArray = JSON.stringify(existingDocs.concat([doc]));
+		            updatePreviews(agent.id);
+		        }
+
+		        function addImages(urls) {
+		            const existingStrings = JSON.parse(chatView.dataset.imageBase64Array || '[]');
+		            chatView.dataset.imageBase64Array = JSON.stringify(existingStrings.concat(urls));
+		            updatePreviews(agent.id);
+		        }
+
+		        // Replaces (or removes, if newUrl is null) an image unless the user already removed it
+		        function replaceImage(oldUrl, newUrl) {
+		            const current = JSON.parse(chatView.dataset.imageBase64Array || '[]');
+		            const index = current.indexOf(oldUrl);
+		            if (index === -1) return;
+		            if (newUrl) current[index] = newUrl;
+		            else current.splice(index, 1);
+		            chatView.dataset.imageBase64Array = JSON.stringify(current);
+		            updatePreviews(agent.id);
+		        }
+
+		        // Text pages of a pdf arrive as one document, the other pages are
+		        // shown as they are rendered. Pdfs are uploaded one after another
+		        // so that their pages stay in order.
+		        let pdfQueue = Promise.resolve();
+		        const uploads = Array.from(files).map(file => {
+		            if (file.type !== 'application/pdf') {
+		                return uploadImage(file).then(url => addImages([url]));
+		            }
+		            let preview = null;
+		            let previewPage = null;
+		            const upload = pdfQueue.then(() => uploadPdf(file, agent.id, (event) => {
+		                if (event.document) {
+		                    addDocument(event.document);
+		                } else if (event.preview) {
+		                    preview = event.preview;
+		                    previewPage = event.page;
+		                    addImages([preview]);
+		                } else if (event.image && preview && event.page === previewPage) {
+		                    replaceImage(preview, event.image);
+		                    preview = null;
+		                } else if (event.image) {
+		                    addImages([event.image]);
 		                }
+		            })).catch(error => {
+		                if (preview) replaceImage(preview, null);
+		                throw error;
 		            });
+		            pdfQueue = upload.catch(() => {});
+		            return upload;
 		        });
 
-		        Promise.all(filePromises)
-		        .then(results => {
-		            const newStrings = results.flat();
-		            const existingStrings = JSON.parse(chatView.dataset.imageBase64Array || '[]');
-		            chatView.dataset.imageBase64Array = JSON.stringify(existingStrings.concat(newStrings));
-		            updatePreviews();
-		            fileInput.value = '';
-		        })
-		        .catch(error => {
-		            showError(error.message);
+		        uploads.forEach(upload => {
+		            pending.add(upload);
+		            upload.catch(error => showError(error.message)).finally(() => pending.delete(upload));
 		        });
-
-		        function updatePreviews() {
-		            previewContainer.innerHTML = '';
-		            const currentStrings = JSON.parse(chatView.dataset.imageBase64Array || '[]');
-		            previewContainer.classList.toggle('hidden', currentStrings.length === 0);
-		            currentStrings.forEach((base64String, index) => {
-		                const wrapper = document.createElement('div');
-		                wrapper.className = 'relative';
-		                wrapper.innerHTML = `
-		                    <img src="${base64String}" class="h-24 w-24 rounded-lg object-cover border-2 border-slate-300">
-		                    <button type="button" class="absolute -top-2 -right-2 bg-red-500 text-white rounded-full h-6 w-6 flex items-center justify-center text-xs font-bold shadow-md hover:bg-red-600">&times;</button>`;
-		                wrapper.querySelector('button').onclick = () => {
-		                    const current = JSON.parse(chatView.dataset.imageBase64Array || '[]');
-		                    current.splice(index, 1);
-		                    chatView.dataset.imageBase64Array = JSON.stringify(current);
-		                    updatePreviews();
-		                };
-		                previewContainer.appendChild(wrapper);
-		            });
-		        }
+		        fileInput.value = '';
 		    });
 		    form.addEventListener('submit', handleFormSubmit);
 		    return chatView;
@@ -1070,6 +2730,7 @@ HTML_TEMPLATE = r"""
             const chat = activeChats[agentId];
             if (!chat) return;
             const { history, agent, showFullHistory } = chat;
+            const historyStart = chat.historyStart || 0;
 
             if (history.length === 0) {
                  messagesEl.innerHTML = `<div class="text-center py-8">
@@ -1082,9 +2743,12 @@ HTML_TEMPLATE = r"""
                 </div>`;
                 historyToggleBtn.classList.add('hidden');
             } else {
-                if (history.length > 2) {
+                if (showFullHistory && historyStart > 0) {
                     historyToggleBtn.classList.remove('hidden');
-                    historyToggleBtn.textContent = showFullHistory ? 'Show Recent Only' : `Show Full History (${history.length} messages)`;
+                    historyToggleBtn.textContent = `Load Earlier Messages (${historyStart} more)`;
+                } else if (history.length > 2) {
+                    historyToggleBtn.classList.remove('hidden');
+                    historyToggleBtn.textContent = showFullHistory ? 'Show Recent Only' : `Show Full History (${historyStart + history.length} messages)`;
                 } else {
                     historyToggleBtn.classList.add('hidden');
                 }
@@ -1115,6 +2779,7 @@ HTML_TEMPLATE = r"""
 		    const part = msg.parts?.[0] || {};
 		    const rawText = part.text || '';
 		    const imageSources = part.images || [];
+		    const documents = part.documents || [];
 		    const thinkingContent = part.thinking || '';
 
 		    const msgEl = document.createElement('div');
@@ -1135,6 +2800,18 @@ HTML_TEMPLATE = r"""
 		        contentContainer.appendChild(imageContainer);
 		    }
 
+		    if (isUser && documents.length > 0) {
+		        const docContainer = document.createElement('div');
+		        docContainer.className = 'flex flex-wrap gap-2 mb-2 justify-end';
+		        documents.forEach(doc => {
+		            const docEl = document.createElement('div');
+		            docEl.className = 'px-3 py-2 rounded-lg border-2 border-slate-200 bg-white text-sm text-slate-600 shadow-sm';
+		            docEl.textContent = `📄 ${doc.name} (${doc.pages.length} text page${doc.pages.length === 1 ? '' : 's'})`;
+		            docContainer.appendChild(docEl);
+		        });
+		        contentContainer.appendChild(docContainer);
+		    }
+
 		    if (rawText.trim().length > 0 || !isUser) {
 		        if (!isUser && thinkingContent) {
 		            const thinkingEl = document.createElement("div");
@@ -1237,6 +2914,82 @@ HTML_TEMPLATE = r"""
 		}
 
 
+        // Renders a reply while it is being streamed. Markdown blocks that are
+        // finished (followed by a blank line or a closing code fence) are parsed,
+        // highlighted and then left alone. Only the last, still open block is
+        // re-rendered when more text arrives, so the cost per frame no longer
+        // grows with the length of the reply. Code blocks are highlighted only
+        // after their closing fence has arrived.
+        function createStreamingRenderer(container) {
+            const frozenEl = document.createElement('div');
+            const tailEl = document.createElement('div');
+            frozenEl.style.display = 'contents';
+            tailEl.style.display = 'contents';
+            container.innerHTML = '';
+            container.append(frozenEl, tailEl);
+            let frozenUpTo = 0;
+
+            // Returns the offset just after the last finished block in text.
+            // text always starts at a block boundary, outside of a code fence.
+            function findBlockBoundary(text) {
+                const lines = text.split('\n');
+                let boundary = 0;
+                let offset = 0;
+                let fence = null;
+                // The last line may still be incomplete, so it is never used
+                for (let i = 0; i < lines.length - 1; i++) {
+                    const line = lines[i];
+                    offset += line.length + 1;
+                    const fenceMatch = line.match(/^ {0,3}(`{3,}|~{3,})(.*)$/);
+                    if (fence === null) {
+                        if (fenceMatch) {
+                            fence = fenceMatch[1];
+                        } else if (line.trim() === '' && i + 1 < lines.length - 1 && /^\S/.test(lines[i + 1])) {
+                            // A blank line followed by an unindented line ends the block.
+                            // (An indented line could still belong to a list item.)
+                            boundary = offset;
+                        }
+                    } else if (fenceMatch && fenceMatch[1][0] === fence[0]
+                               && fenceMatch[1].length >= fence.length && fenceMatch[2].trim() === '') {
+                        fence = null;
+                        boundary = offset;
+                    }
+                }
+                return boundary;
+            }
+
+            function freeze(markdown) {
+                const block = document.createElement('div');
+                block.style.display = 'contents';
+                block.innerHTML = marked.parse(markdown);
+                enhanceCodeBlocks(block);
+                frozenEl.appendChild(block);
+            }
+
+            return {
+                update(text) {
+                    if (text.length < frozenUpTo) {
+                        // The text was replaced, start again
+                        frozenEl.innerHTML = '';
+                        frozenUpTo = 0;
+                    }
+                    const boundary = frozenUpTo + findBlockBoundary(text.slice(frozenUpTo));
+                    if (boundary > frozenUpTo) {
+                        freeze(text.slice(frozenUpTo, boundary));
+                        frozenUpTo = boundary;
+                    }
+                    tailEl.innerHTML = marked.parse(text.slice(frozenUpTo));
+                },
+                finish(text) {
+                    this.update(text);
+                    tailEl.innerHTML = '';
+                    if (text.length > frozenUpTo) freeze(text.slice(frozenUpTo));
+                    frozenUpTo = text.length;
+                }
+            };
+        }
+
+
         function scrollToBottom(agentId) {
             const container = document.getElementById(`chat-messages-container-${agentId}`);
             if (container) container.scrollTop = container.scrollHeight;
@@ -1244,17 +2997,63 @@ HTML_TEMPLATE = r"""
 
 
 
-        async function streamLlmResponse(chatHistory, systemInstruction, agentId, signal) {
-            const messages = [];
-            if (systemInstruction) messages.push({ role: "system", content: systemInstruction });
-
-            chatHistory.forEach(msg => {
-                const contentParts = [];
-                const part = msg.parts[0];
-                if (part.text) contentParts.push({ type: "text", text: part.text });
-                if (part.images) part.images.forEach(imgBase64 => contentParts.push({ type: "image_url", image_url: { url: imgBase64 } }));
-                messages.push({ role: msg.role, content: contentParts });
+        function newSessionId() {
+            if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+            return `session-${Date.now()}-${Math.random().toString(36).slice(2)}`;
+        }
+
+        function toApiMessage(msg) {
+            const contentParts = [];
+            const part = msg.parts[0];
+            if (part.text) contentParts.push({ type: "text", text: part.text });
+            if (part.images) part.images.forEach(imgBase64 => contentParts.push({ type: "image_url", image_url: { url: imgBase64 } }));
+            if (part.documents) part.documents.forEach(doc => contentParts.push({ type: "document", document: { url: doc.url } }));
+            return { role: msg.role, content: contentParts };
+        }
+
+        // The server keeps the chat history in RAM (keyed by sessionId), so
+        // normally only the messages it has not seen yet are sent.
+        // A full resend (reset) happens for a new chat, a loaded chat,
+        // single-turn agents, or if the server has lost the session.
+        function buildStreamRequest(chat, chatHistory, systemInstruction, forceReset) {
+            const synced = chat.syncedCount || 0;
+            const canSendDelta = !forceReset && synced > 0 && synced < chatHistory.length;
+            const body = {
+                model: currentModel,
+                agent_id: chat.agent.id,
+                session_id: chat.sessionId,
+                system: systemInstruction || ""
+            };
+            if (canSendDelta) {
+                body.base_len = synced;
+                body.messages = chatHistory.slice(synced).map(toApiMessage);
+            } else {
+                body.reset = true;
+                body.messages = chatHistory.map(toApiMessage);
+            }
+            return body;
+        }
+
+        // A 409 means the server has lost the session (restart, expiry) or
+        // it is out of sync, and then the full history is sent again.
+        async function postStreamRequest(chat, chatHistory, systemInstruction, signal) {
+            const post = (forceReset) => fetch("/stream_chat", {
+                method: "POST",
+                headers: { "Content-Type": "application/json" },
+                body: JSON.stringify(buildStreamRequest(chat, chatHistory, systemInstruction, forceReset)),
+                signal: signal
             });
+            let res = await post(false);
+            if (res.status === 409) {
+                chat.syncedCount = 0;
+                res = await post(true);
+            }
+            return res;
+        }
+
+        async function streamLlmResponse(chatHistory, systemInstruction, agentId, signal) {
+            const chat = activeChats[agentId];
+            const historyToSend = chatHistory.slice();
 
             const agentMessage = { role: "assistant", parts: [{ text: "", thinking: "" }] };
             activeChats[agentId].history.push(agentMessage);
@@ -1263,28 +3062,41 @@ HTML_TEMPLATE = r"""
             const chatContainer = document.getElementById(`chat-messages-container-${agentId}`);
 
             if (!contentDiv) return;
+            const renderer = createStreamingRenderer(contentDiv);
 
             try {
-                const res = await fetch("/stream_chat", {
-                    method: "POST",
-                    headers: { "Content-Type": "application/json" },
-                    body: JSON.stringify({ messages, model: currentModel }),
-                    signal: signal
-                });
-                if (!res.ok) throw new Error((await res.json()).reply || `Server error: ${res.status}`);
+                const res = await postStreamRequest(chat, historyToSend, systemInstruction, signal);
+                if (!res.ok) throw new Error((await res.json()).error || `Server error: ${res.status}`);
+                // The server now holds the sent messages plus this reply.
+                chat.syncedCount = historyToSend.length + 1;
 
                 const reader = res.body.getReader();
                 const decoder = new TextDecoder();
                 let buffer = '';
 
-                let inThinking = false;
                 let thinkingBuffer = "";
                 let finalBuffer = "";
                 let thinkingEl = null;
 
+                // Collapses the reasoning bubble once the answer starts
+                const finishThinking = () => {
+                    if (!thinkingEl || agentMessage.parts[0].thinking) return;
+                    agentMessage.parts[0].thinking = thinkingBuffer.trim();
+                    thinkingEl.textContent = "View reasoning";
+                    const hiddenPanel = document.createElement("div");
+                    hiddenPanel.className = "hidden hidden-reasoning mt-2 text-xs bg-slate-100 p-2 rounded";
+                    hiddenPanel.textContent = agentMessage.parts[0].thinking;
+                    thinkingEl.appendChild(hiddenPanel);
+                    thinkingEl.onclick = () => hiddenPanel.classList.toggle("hidden");
+                };
+
                 while (true) {
                     const { done, value } = await reader.read();
-                    if (done) break;
+                    if (done) {
+                        finishThinking();
+                        renderer.finish(agentMessage.parts[0].text);
+                        break;
+                    }
                     buffer += decoder.decode(value, { stream: true });
                     const lines = buffer.split('\n\n');
                     buffer = lines.pop();
@@ -1297,64 +3109,51 @@ HTML_TEMPLATE = r"""
                         if (!line.startsWith('data: ')) continue;
                         const jsonData = JSON.parse(line.substring(6));
 
+                        if (jsonData.request_id) {
+                            chat.requestId = jsonData.request_id;
+                            continue;
+                        }
+
+                        const loadingText = document.querySelector(`#loading-indicator-${agentId} .loading-text`);
+                        if (jsonData.queue) {
+                            if (loadingText) loadingText.textContent = `Waiting for the model (position ${jsonData.queue.position} in line)...`;
+                            continue;
+                        }
+                        if (jsonData.status) {
+                            if (loadingText) loadingText.textContent = jsonData.status;
+                            continue;
+                        }
+                        if (loadingText) loadingText.textContent = `${chat.agent.name} is processing...`;
+
                         if (jsonData.warning) {
                             showError(jsonData.warning);
                         }
 
                         if (jsonData.error) {
                             finalBuffer += `\n\n**Error:** ${jsonData.error}`;
-                        } else if (jsonData.chunk) {
-                            const chunk = jsonData.chunk;
-
-                            if (chunk.includes("<think>")) {
-                                inThinking = true;
-                                thinkingBuffer = "";
-                                if (!thinkingEl) {
-                                    thinkingEl = document.createElement("div");
-                                    thinkingEl.className = "thinking-bubble bg-slate-200 text-slate-600 italic rounded-xl p-2 mb-2 cursor-pointer";
-                                    thinkingEl.textContent = "Thinking...";
-                                    thinkingEl.onclick = () => {
-                                        const hidden = thinkingEl.querySelector(".hidden-reasoning");
-                                        if (hidden) hidden.classList.toggle("hidden");
-                                    };
-                                    const hiddenPanel = document.createElement("div");
-                                    hiddenPanel.className = "hidden-reasoning mt-2 text-xs bg-slate-100 p-2 rounded";
-                                    hiddenPanel.textContent = "";
-                                    thinkingEl.appendChild(hiddenPanel);
-                                    contentDiv.parentNode.insertBefore(thinkingEl, contentDiv);
-                                }
-                            }
-
-                            if (inThinking) {
-                                scrollToBottom(agentId);
-                                thinkingBuffer += chunk;
-                                const hiddenPanel = thinkingEl.querySelector(".hidden-reasoning");
-                                if (hiddenPanel) {
-                                    hiddenPanel.textContent = thinkingBuffer.replace("<think>", "").replace("</think>", "").trim();
-                                }
-                            }
-
-                            if (chunk.includes("</think>")) {
-                                inThinking = false;
-                                if (thinkingEl) {
-                                    thinkingEl.textContent = "View reasoning";
-                                    const hiddenPanel = document.createElement("div");
-                                    hiddenPanel.className = "hidden hidden-reasoning mt-2 text-xs bg-slate-100 p-2 rounded";
-                                    hiddenPanel.textContent = thinkingBuffer.replace("<think>", "").replace("</think>", "").trim();
-                                    thinkingEl.appendChild(hiddenPanel);
-                                    thinkingEl.onclick = () => hiddenPanel.classList.toggle("hidden");
-                                }
-                                agentMessage.parts[0].thinking = thinkingBuffer.replace("<think>", "").replace("</think>", "").trim();
-                            }
-
-                            if (!inThinking) {
-                                finalBuffer += chunk.replace(/<think>[\s\S]*?<\/think>/g, "");
+                        } else if (jsonData.thinking) {
+                            // The server sends reasoning as its own event type
+                            if (!thinkingEl) {
+                                thinkingEl = document.createElement("div");
+                                thinkingEl.className = "thinking-bubble bg-slate-200 text-slate-600 italic rounded-xl p-2 mb-2 cursor-pointer";
+                                thinkingEl.textContent = "Thinking...";
+                                const hiddenPanel = document.createElement("div");
+                                hiddenPanel.className = "hidden-reasoning mt-2 text-xs bg-slate-100 p-2 rounded";
+                                thinkingEl.appendChild(hiddenPanel);
+                                thinkingEl.onclick = () => hiddenPanel.classList.toggle("hidden");
+                                contentDiv.parentNode.insertBefore(thinkingEl, contentDiv);
                             }
+                            thinkingBuffer += jsonData.thinking;
+                            thinkingEl.querySelector(".hidden-reasoning").textContent = thinkingBuffer.trim();
+                            if (isScrolledToBottom) scrollToBottom(agentId);
+                            continue;
+                        } else if (jsonData.chunk) {
+                            finishThinking();
+                            finalBuffer += jsonData.chunk;
                         }
 
                         agentMessage.parts[0].text = finalBuffer.trim();
-                        contentDiv.innerHTML = marked.parse(agentMessage.parts[0].text);
-                        enhanceCodeBlocks(contentDiv);
+                        renderer.update(agentMessage.parts[0].text);
 
                         if (isScrolledToBottom) {
                             scrollToBottom(agentId);
@@ -1367,7 +3166,7 @@ HTML_TEMPLATE = r"""
                 } else {
                     agentMessage.parts[0].text += `\n\n*Stream stopped by user.*`;
                 }
-                contentDiv.innerHTML = marked.parse(agentMessage.parts[0].text);
+                renderer.finish(agentMessage.parts[0].text);
             }
         }
 
@@ -1381,16 +3180,25 @@ HTML_TEMPLATE = r"""
 		    const stopBtn = form.querySelector(".stop-btn");
 		    const chatView = document.getElementById(`chat-view-${agentId}`);
 
+		    // Wait for images and pdf pages that are still uploading
+		    if (!isTyping && chatView.pendingUploads && chatView.pendingUploads.size > 0) {
+		        submitBtn.disabled = true;
+		        await Promise.allSettled([...chatView.pendingUploads]);
+		        submitBtn.disabled = false;
+		    }
+
 		    const messageText = textInput.value.trim();
 		    const imageBase64Array = JSON.parse(chatView.dataset.imageBase64Array || '[]');
+		    const documents = JSON.parse(chatView.dataset.documentArray || '[]');
 
-		    if ((messageText === "" && imageBase64Array.length === 0) || !agentId || isTyping) return;
+		    if ((messageText === "" && imageBase64Array.length === 0 && documents.length === 0) || !agentId || isTyping) return;
 
 		    const chat = activeChats[agentId];
 
 		    textInput.value = "";
 		    textInput.style.height = 'auto';
 		    chatView.dataset.imageBase64Array = '[]';
+		    chatView.dataset.documentArray = '[]';
 		    document.getElementById(`image-preview-container-${agentId}`).innerHTML = '';
 		    document.getElementById(`image-preview-container-${agentId}`).classList.add('hidden');
 
@@ -1398,10 +3206,13 @@ HTML_TEMPLATE = r"""
 
 		    const userMessage = { role: "user", parts: [{ text: messageText }] };
 		    if (imageBase64Array.length > 0) userMessage.parts[0].images = imageBase64Array;
+		    if (documents.length > 0) userMessage.parts[0].documents = documents;
 		    chat.history.push(userMessage);
 
 		    if (chat.agent.type === 'single-turn') {
 		        chat.history = chat.history.slice(-1);
+		        chat.savedCount = null; // the saved chat is replaced, not appended to
+		        chat.historyStart = 0;
 		    }
 
 		    chat.showFullHistory = false;
@@ -1421,7 +3232,13 @@ HTML_TEMPLATE = r"""
 
 		    const controller = new AbortController();
 		    abortControllers[agentId] = controller;
-		    stopBtn.onclick = () => controller.abort();
+		    stopBtn.onclick = () => {
+		        // Ask the server to stop Ollama right away, then drop the connection.
+		        if (chat.requestId) {
+		            fetch(`/stream_chat/${chat.requestId}/cancel`, { method: 'POST' }).catch(() => {});
+		        }
+		        controller.abort();
+		    };
 
 		    try {
 		        await streamLlmResponse(chat.history, chat.agent.persona, agentId, controller.signal);
@@ -1441,12 +3258,108 @@ HTML_TEMPLATE = r"""
 		        }
 
 		        delete abortControllers[agentId];
+		        chat.requestId = null;
                 await saveOrUpdateCurrentChat(agentId);
 		    }
 		}
 
 
 
+        // Summarizes an attached pdf of any length on the server (map-reduce)
+        // and adds the request and the summary to the chat.
+        async function summarizeDocument(agentId, docIndex) {
+            const chat = activeChats[agentId];
+            const chatView = document.getElementById(`chat-view-${agentId}`);
+            if (!chat || isTyping) return;
+
+            const documents = JSON.parse(chatView.dataset.documentArray || '[]');
+            const doc = documents.splice(docIndex, 1)[0];
+            if (!doc) return;
+            chatView.dataset.documentArray = JSON.stringify(documents);
+            updatePreviews(agentId);
+
+            if (chat.history.length === 0) document.getElementById(`chat-messages-${agentId}`).innerHTML = "";
+            chat.history.push({ role: "user", parts: [{ text: `Summarize ${doc.name}`, documents: [doc] }] });
+            chat.showFullHistory = false;
+            renderChatHistory(agentId);
+            const agentMessage = { role: "assistant", parts: [{ text: "" }] };
+            chat.history.push(agentMessage);
+            const contentDiv = renderMessage(agentId, agentMessage).querySelector('.markdown-content');
+
+            const submitBtn = chatView.querySelector(".submit-btn");
+            const stopBtn = chatView.querySelector(".stop-btn");
+            const loadingIndicator = document.getElementById(`loading-indicator-${agentId}`);
+            const loadingText = loadingIndicator.querySelector('.loading-text');
+            isTyping = true;
+            submitBtn.disabled = true;
+            submitBtn.classList.add('hidden');
+            stopBtn.classList.remove('hidden');
+            loadingText.textContent = `Reading ${doc.name}...`;
+            loadingIndicator.classList.remove("hidden");
+
+            const controller = new AbortController();
+            abortControllers[agentId] = controller;
+            stopBtn.onclick = () => controller.abort();
+
+            try {
+                const res = await fetch("/summarize_document", {
+                    method: "POST",
+                    headers: { "Content-Type": "application/json" },
+                    body: JSON.stringify({ document_url: doc.url, model: currentModel }),
+                    signal: controller.signal
+                });
+                if (!res.ok) throw new Error((await res.json()).error || `Server error: ${res.status}`);
+
+                const reader = res.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
+                while (true) {
+                    const { done, value } = await reader.read();
+                    if (done) break;
+                    buffer += decoder.decode(value, { stream: true });
+                    const lines = buffer.split('\n\n');
+                    buffer = lines.pop();
+                    for (const line of lines) {
+                        if (!line.startsWith('data: ')) continue;
+                        const event = JSON.parse(line.substring(6));
+                        if (event.error) throw new Error(event.error);
+                        if (event.summary !== undefined) {
+                            agentMessage.parts[0].text = event.summary;
+                        } else if (event.stage === 'map') {
+                            loadingText.textContent = event.total === 1
+                                ? `Summarizing ${doc.name}...`
+                                : `Summarizing part ${Math.min(event.done + 1, event.total)} of ${event.total}...`;
+                        } else if (event.stage === 'reduce') {
+                            loadingText.textContent = event.total === 1
+                                ? 'Writing the summary...'
+                                : `Combining summaries (${event.done} of ${event.total})...`;
+                        }
+                    }
+                }
+                if (!agentMessage.parts[0].text) throw new Error("The summary was not finished.");
+            } catch (err) {
+                agentMessage.parts[0].text += err.name === 'AbortError'
+                    ? `\n\n*Summary stopped by user.*`
+                    : `\n\n**Error:** ${err.message}`;
+            } finally {
+                agentMessage.parts[0].text = agentMessage.parts[0].text.trim();
+                contentDiv.innerHTML = marked.parse(agentMessage.parts[0].text);
+                enhanceCodeBlocks(contentDiv);
+                scrollToBottom(agentId);
+
+                isTyping = false;
+                submitBtn.disabled = false;
+                submitBtn.classList.remove('hidden');
+                stopBtn.classList.add('hidden');
+                loadingIndicator.classList.add("hidden");
+                loadingText.textContent = `${chat.agent.name} is processing...`;
+                delete abortControllers[agentId];
+                await saveOrUpdateCurrentChat(agentId);
+            }
+        }
+
+
+
 		function openAgentEditorModal() {
             agentEditorModalEl.classList.remove('hidden');
             setTimeout(() => agentEditorModalContent.classList.remove('scale-95', 'opacity-0'), 10);
@@ -1473,6 +3386,8 @@ HTML_TEMPLATE = r"""
             document.getElementById('agent-title').value = agent.title;
             document.getElementById('agent-persona').value = agent.persona;
             document.getElementById('agent-type').value = agent.type;
+            document.getElementById('agent-think').value = agent.think === false ? 'off' : 'on';
+            document.getElementById('agent-retrieval').value = agent.retrieval ? 'on' : 'off';
             document.getElementById('agent-modal-title').innerHTML = `Edit Ai Tool`;
             document.getElementById('save-agent-btn').textContent = 'Save Changes';
             
@@ -1492,6 +3407,8 @@ HTML_TEMPLATE = r"""
             const title = document.getElementById('agent-title').value.trim();
             const persona = document.getElementById('agent-persona').value.trim();
             const type = document.getElementById('agent-type').value;
+            const think = document.getElementById('agent-think').value !== 'off';
+            const retrieval = document.getElementById('agent-retrieval').value === 'on';
 
             if (!name || !title || !persona) return showError("Please fill out all fields.");
 
@@ -1500,6 +3417,8 @@ HTML_TEMPLATE = r"""
                 title,
                 persona,
                 type,
+                think,
+                retrieval,
                 color: '#4f46e5'
             };
 
@@ -1554,6 +3473,7 @@ HTML_TEMPLATE = r"""
 
                 agents = agents.filter(a => a.id !== agentId);
                 delete savedHistories[agentId];
+                delete savedChatsHasMore[agentId];
                 closeChatTab(agentId);
                 renderAgents();
                 closeAgentEditorModal();
@@ -1587,8 +3507,15 @@ HTML_TEMPLATE = r"""
                         if (!savedHistories[agentId]) {
                             savedHistories[agentId] = [];
                         }
-                        savedHistories[agentId].unshift(newChatSession);
+                        savedHistories[agentId].unshift({
+                            id: newChatSession.id,
+                            title: newChatSession.title,
+                            timestamp: newChatSession.timestamp,
+                            message_count: chat.history.length
+                        });
                         activeChats[agentId].chatId = newChatSession.id;
+                        activeChats[agentId].historyStart = 0;
+                        activeChats[agentId].savedCount = chat.history.length;
                     } else {
                         console.error('Failed to save new chat session.');
                     }
@@ -1597,18 +3524,48 @@ HTML_TEMPLATE = r"""
                 }
             }
             else {
+                // Normally only the messages added since the last save are
+                // sent (PATCH). The full history is sent (PUT) if the saved
+                // chat was changed elsewhere or the history was replaced.
+                // savedCount counts the saved messages in chat.history, which
+                // starts at message number historyStart of the saved chat.
+                const savedCount = chat.savedCount;
+                const canAppend = Number.isInteger(savedCount) && savedCount <= chat.history.length;
+                if (canAppend && savedCount === chat.history.length) return;
+
                 try {
-                    const res = await fetch(`/conversations/${agentId}/${chat.chatId}`, {
-                        method: 'PUT',
-                        headers: { 'Content-Type': 'application/json' },
-                        body: JSON.stringify({ history: chat.history })
-                    });
+                    const putHistory = async () => {
+                        // The earlier messages are needed to replace the whole chat
+                        while (chat.historyStart > 0) {
+                            if (!await loadEarlierMessages(agentId)) throw new Error('Could not load the earlier messages.');
+                        }
+                        return fetch(`/conversations/${agentId}/${chat.chatId}`, {
+                            method: 'PUT',
+                            headers: { 'Content-Type': 'application/json' },
+                            body: JSON.stringify({ history: chat.history })
+                        });
+                    };
+                    let res;
+                    if (canAppend) {
+                        res = await fetch(`/conversations/${agentId}/${chat.chatId}`, {
+                            method: 'PATCH',
+                            headers: { 'Content-Type': 'application/json' },
+                            body: JSON.stringify({
+                                base_seq: (chat.historyStart || 0) + savedCount,
+                                messages: chat.history.slice(savedCount)
+                            })
+                        });
+                        if (res.status === 409) res = await putHistory();
+                    } else {
+                        res = await putHistory();
+                    }
 
                     if (res.ok) {
+                        chat.savedCount = chat.history.length;
                         const chatIndex = (savedHistories[agentId] || []).findIndex(c => c.id === chat.chatId);
                         if (chatIndex !== -1) {
                             const updatedChat = savedHistories[agentId][chatIndex];
-                            updatedChat.history = chat.history;
+                            updatedChat.message_count = (chat.historyStart || 0) + chat.history.length;
                             updatedChat.timestamp = new Date().toISOString();
                             savedHistories[agentId].splice(chatIndex, 1);
                             savedHistories[agentId].unshift(updatedChat);
@@ -1641,7 +3598,7 @@ HTML_TEMPLATE = r"""
                     <div class="flex justify-between items-start">
                         <div class="flex-grow overflow-hidden">
                             <p class="font-semibold text-slate-800 truncate">${chat.title}</p>
-                            <p class="text-xs text-slate-500">${new Date(chat.timestamp).toLocaleString()}</p>
+                            <p class="text-xs text-slate-500">${new Date(chat.timestamp).toLocaleString()} · ${chat.message_count} messages</p>
                         </div>
                         <button class="delete-history-btn text-red-500 hover:text-red-700 p-1 opacity-0 transition-opacity flex-shrink-0" data-chat-id="${chat.id}">
                             <svg xmlns="http://www.w3.org/2000/svg" class="h-4 w-4" viewBox="0 0 20 20" fill="currentColor"><path fill-rule="evenodd" d="M9 2a1 1 0 00-.894.553L7.382 4H4a1 1 0 000 2v10a2 2 0 002 2h8a2 2 0 002-2V6a1 1 0 100-2h-3.382l-.724-1.447A1 1 0 0011 2H9zM7 8a1 1 0 012 0v6a1 1 0 11-2 0V8zm5-1a1 1 0 00-1 1v6a1 1 0 102 0V8a1 1 0 00-1-1z" clip-rule="evenodd" /></svg>
@@ -1660,21 +3617,126 @@ HTML_TEMPLATE = r"""
                 };
                 listEl.appendChild(itemEl);
             });
+
+            if (savedChatsHasMore[agentId]) {
+                const moreBtn = document.createElement('button');
+                moreBtn.className = 'w-full text-sm font-medium text-slate-700 hover:text-indigo-600 py-2';
+                moreBtn.textContent = 'Load Older Chats';
+                moreBtn.onclick = () => loadMoreSavedChats(agentId);
+                listEl.appendChild(moreBtn);
+            }
         }
 
-        
-		function loadChatHistory(agentId, chatId) {
+        // Shows the saved messages that match the query, best match first.
+        // The server marks the matched words of a snippet with \x02 and \x03.
+        async function searchSavedChats(agentId, query) {
+            const listEl = document.getElementById(`chat-history-list-${agentId}`);
+            try {
+                const res = await fetch(`/conversations/search?agent_id=${encodeURIComponent(agentId)}&q=${encodeURIComponent(query)}`);
+                if (!res.ok) throw new Error(`Server error: ${res.status}`);
+                const { results } = await res.json();
+                if (document.getElementById(`chat-search-${agentId}`).value.trim() !== query) return; // a newer search is running
+
+                listEl.innerHTML = '';
+                if (results.length === 0) {
+                    listEl.innerHTML = `<p class="text-sm text-slate-500 italic">No saved messages match.</p>`;
+                    return;
+                }
+                results.forEach(result => {
+                    const itemEl = document.createElement('div');
+                    itemEl.className = 'history-item p-3 bg-white rounded-lg cursor-pointer hover:bg-indigo-50 border border-slate-200';
+                    const titleEl = document.createElement('p');
+                    titleEl.className = 'font-semibold text-slate-800 truncate';
+                    titleEl.textContent = result.title;
+                    const dateEl = document.createElement('p');
+                    dateEl.className = 'text-xs text-slate-500';
+                    dateEl.textContent = new Date(result.timestamp).toLocaleString();
+                    const snippetEl = document.createElement('p');
+                    snippetEl.className = 'text-sm text-slate-600 mt-1 break-words';
+                    result.snippet.split('\x02').forEach((piece, i) => {
+                        const [matched, rest] = i === 0 ? ['', piece] : piece.split('\x03');
+                        if (matched) {
+                            const markEl = document.createElement('mark');
+                            markEl.textContent = matched;
+                            snippetEl.appendChild(markEl);
+                        }
+                        if (rest) snippetEl.appendChild(document.createTextNode(rest));
+                    });
+                    itemEl.append(titleEl, dateEl, snippetEl);
+                    itemEl.onclick = () => loadChatHistory(agentId, result.chat_id, result.seq, result.message_count);
+                    listEl.appendChild(itemEl);
+                });
+            } catch (err) {
+                showError('Could not search the saved chats.');
+            }
+        }
+
+        async function loadMoreSavedChats(agentId) {
             const chats = savedHistories[agentId] || [];
-            const chatToLoad = chats.find(c => c.id === chatId);
+            const last = chats[chats.length - 1];
+            const params = last ? `?before_timestamp=${encodeURIComponent(last.timestamp)}&before_id=${encodeURIComponent(last.id)}` : '';
+            try {
+                const res = await fetch(`/conversations/${agentId}${params}`);
+                if (!res.ok) throw new Error(`Server error: ${res.status}`);
+                const page = await res.json();
+                const known = new Set(chats.map(c => c.id));
+                savedHistories[agentId] = chats.concat(page.chats.filter(c => !known.has(c.id)));
+                savedChatsHasMore[agentId] = page.has_more;
+                renderSavedChatsList(agentId);
+            } catch (err) {
+                showError('Could not load older chats.');
+            }
+        }
 
-            if (chatToLoad) {
-                activeChats[agentId].history = JSON.parse(JSON.stringify(chatToLoad.history));
+        
+		// seq (with the chat's messageCount) opens the chat at that message,
+		// e.g. a search result. Otherwise the last messages are loaded.
+		async function loadChatHistory(agentId, chatId, seq, messageCount) {
+            try {
+                const start = Number.isInteger(seq)
+                    ? Math.max(0, Math.min(seq, messageCount - CHAT_MESSAGES_PAGE_SIZE))
+                    : -CHAT_MESSAGES_PAGE_SIZE;
+                const res = await fetch(`/conversations/${agentId}/${chatId}?start=${start}`);
+                if (!res.ok) throw new Error(`Server error: ${res.status}`);
+                const chatToLoad = await res.json();
+
+                activeChats[agentId].history = chatToLoad.messages;
+                activeChats[agentId].historyStart = chatToLoad.start;
                 activeChats[agentId].chatId = chatToLoad.id;
+                activeChats[agentId].syncedCount = 0;
+                activeChats[agentId].savedCount = chatToLoad.messages.length;
                 activeChats[agentId].showFullHistory = true;
                 renderChatHistory(agentId);
+                if (Number.isInteger(seq)) {
+                    const messageEl = document.getElementById(`chat-messages-${agentId}`).children[seq - chatToLoad.start];
+                    if (messageEl) messageEl.scrollIntoView({ block: 'center' });
+                }
 
                 const historyPanel = document.getElementById(`chat-history-panel-${agentId}`);
                 if(historyPanel) historyPanel.classList.add('translate-x-full');
+            } catch (err) {
+                showError('Could not open the saved chat.');
+            }
+        }
+
+        // Adds the previous page of messages of a saved chat to the start of
+        // the open chat. Returns false if they could not be fetched.
+        async function loadEarlierMessages(agentId) {
+            const chat = activeChats[agentId];
+            if (!chat || !chat.historyStart) return true;
+            const start = Math.max(0, chat.historyStart - CHAT_MESSAGES_PAGE_SIZE);
+            try {
+                const res = await fetch(`/conversations/${agentId}/${chat.chatId}?start=${start}&end=${chat.historyStart}`);
+                if (!res.ok) throw new Error(`Server error: ${res.status}`);
+                const page = await res.json();
+                chat.history = page.messages.concat(chat.history);
+                chat.historyStart = page.start;
+                chat.savedCount = (chat.savedCount || 0) + page.messages.length;
+                chat.syncedCount = 0; // positions changed, resend the history on the next turn
+                return true;
+            } catch (err) {
+                console.error('Error loading earlier messages:', err);
+                return false;
             }
         }
 		
@@ -1689,6 +3751,8 @@ HTML_TEMPLATE = r"""
                     if (activeChats[agentId] && activeChats[agentId].chatId === chatId) {
                         activeChats[agentId].history = [];
                         activeChats[agentId].chatId = 'new';
+                        activeChats[agentId].historyStart = 0;
+                        activeChats[agentId].syncedCount = 0;
                         renderChatHistory(agentId);
                     }
                 } else {
@@ -1726,7 +3790,102 @@ HTML_TEMPLATE = r"""
             }
         }
 
-        function captureWebcamImage() {
+        // Images are stored on the server; the browser keeps only the returned url.
+        async function uploadImage(blob, filename) {
+            const formData = new FormData();
+            formData.append('image_file', blob, filename || blob.name || 'image');
+            formData.append('model', currentModel);
+            formData.append('agent_id', currentAgentId || '');
+            const response = await fetch('/upload_image', {
+                method: 'POST',
+                body: formData
+            });
+            const result = await response.json();
+            if (!response.ok) throw new Error(result.error || 'Failed to upload image.');
+            return result.url;
+        }
+
+        // Files larger than this are sent in parts that can be resumed
+        const CHUNKED_UPLOAD_THRESHOLD = 8 * 1024 * 1024;
+        const CHUNK_UPLOAD_RETRIES = 3;
+
+        // Sends a file in parts and returns the upload_id. If a part fails,
+        // the server is asked how much it has received and the upload continues from there.
+        async function uploadInChunks(file) {
+            const response = await fetch('/uploads', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ filename: file.name, size: file.size })
+            });
+            const upload = await response.json();
+            if (!response.ok) throw new Error(upload.error || 'Failed to start the upload.');
+
+            let offset = upload.offset;
+            let retries = 0;
+            while (offset < file.size) {
+                try {
+                    const chunkResponse = await fetch(`/uploads/${upload.upload_id}?offset=${offset}`, {
+                        method: 'PUT',
+                        body: file.slice(offset, offset + upload.chunk_size)
+                    });
+                    const result = await chunkResponse.json();
+                    // 409 means the server has a different offset, so continue from there
+                    if (!chunkResponse.ok && chunkResponse.status !== 409) {
+                        throw new Error(result.error || 'Failed to upload the file.');
+                    }
+                    offset = result.offset;
+                    retries = 0;
+                } catch (error) {
+                    if (++retries > CHUNK_UPLOAD_RETRIES) throw error;
+                    await new Promise(resolve => setTimeout(resolve, 1000 * retries));
+                    const statusResponse = await fetch(`/uploads/${upload.upload_id}`);
+                    if (statusResponse.ok) offset = (await statusResponse.json()).offset;
+                }
+            }
+            return upload.upload_id;
+        }
+
+        // Pdf pages are streamed back as newline delimited JSON, one line per page.
+        async function uploadPdf(file, agentId, onEvent) {
+            const formData = new FormData();
+            if (file.size > CHUNKED_UPLOAD_THRESHOLD) {
+                formData.append('upload_id', await uploadInChunks(file));
+            } else {
+                formData.append('pdf_file', file);
+            }
+            formData.append('model', currentModel);
+            formData.append('agent_id', agentId);
+            const response = await fetch('/upload_pdf_stream', {
+                method: 'POST',
+                body: formData
+            });
+            if (!response.ok) {
+                const result = await response.json();
+                throw new Error(result.error || 'Failed to convert PDF to images.');
+            }
+
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            let finished = false;
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+                const lines = buffer.split('\n');
+                buffer = lines.pop();
+                for (const line of lines) {
+                    if (!line.trim()) continue;
+                    const event = JSON.parse(line);
+                    if (event.error) throw new Error(event.error);
+                    if (event.done) finished = true;
+                    onEvent(event);
+                }
+            }
+            if (!finished) throw new Error('The PDF upload was interrupted.');
+        }
+
+        async function captureWebcamImage() {
             if (!currentAgentId) {
                 showError("Please open a chat tab before taking a picture.");
                 return;
@@ -1744,10 +3903,17 @@ HTML_TEMPLATE = r"""
             webcamCanvas.height = webcamFeed.videoHeight;
             context.drawImage(webcamFeed, 0, 0, webcamCanvas.width, webcamCanvas.height);
             
-            const dataUrl = webcamCanvas.toDataURL('image/jpeg');
+            const blob = await new Promise(resolve => webcamCanvas.toBlob(resolve, 'image/jpeg'));
+            let imageUrl;
+            try {
+                imageUrl = await uploadImage(blob, 'webcam.jpg');
+            } catch (err) {
+                showError(err.message);
+                return;
+            }
 
             const existingStrings = JSON.parse(chatView.dataset.imageBase64Array || '[]');
-            chatView.dataset.imageBase64Array = JSON.stringify(existingStrings.concat(dataUrl));
+            chatView.dataset.imageBase64Array = JSON.stringify(existingStrings.concat(imageUrl));
 
             // Call the same updatePreviews logic from the file input handler
             updatePreviews(currentAgentId);
@@ -1758,8 +3924,33 @@ HTML_TEMPLATE = r"""
             const previewContainer = document.getElementById(`image-preview-container-${agentId}`);
             previewContainer.innerHTML = '';
             const currentStrings = JSON.parse(chatView.dataset.imageBase64Array || '[]');
-            previewContainer.classList.toggle('hidden', currentStrings.length === 0);
-            
+            const documents = JSON.parse(chatView.dataset.documentArray || '[]');
+            previewContainer.classList.toggle('hidden', currentStrings.length === 0 && documents.length === 0);
+
+            // The text pages of a pdf are shown as one document card
+            documents.forEach((doc, index) => {
+                const wrapper = document.createElement('div');
+                wrapper.className = 'relative';
+                wrapper.innerHTML = `
+                    <div class="h-24 w-24 rounded-lg border-2 border-slate-300 bg-white p-2 flex flex-col justify-center text-xs text-slate-600">
+                        <span style="font-size: 1.5rem;">📄</span>
+                        <span class="doc-name truncate font-semibold"></span>
+                        <span>${doc.pages.length} text page${doc.pages.length === 1 ? '' : 's'}</span>
+                        <button type="button" class="summarize-btn mt-1 rounded bg-indigo-600 text-white hover:bg-indigo-700">Summarize</button>
+                    </div>
+                    <button type="button" class="absolute -top-2 -right-2 bg-red-500 text-white rounded-full h-6 w-6 flex items-center justify-center text-xs font-bold shadow-md hover:bg-red-600">&times;</button>`;
+                wrapper.querySelector('.doc-name').textContent = doc.name;
+                wrapper.title = `${doc.name}: pages ${doc.pages.join(', ')} (about ${doc.tokens} tokens)`;
+                wrapper.querySelector('.summarize-btn').onclick = () => summarizeDocument(agentId, index);
+                wrapper.querySelector('button.absolute').onclick = () => {
+                    const current = JSON.parse(chatView.dataset.documentArray || '[]');
+                    current.splice(index, 1);
+                    chatView.dataset.documentArray = JSON.stringify(current);
+                    updatePreviews(agentId);
+                };
+                previewContainer.appendChild(wrapper);
+            });
+
             currentStrings.forEach((base64String, index) => {
                 const wrapper = document.createElement('div');
                 wrapper.className = 'relative';
@@ -1803,6 +3994,7 @@ HTML_TEMPLATE = r"""
                     const historyPanel = document.getElementById(`chat-history-panel-${currentAgentId}`);
                     if (historyPanel) {
                         if (historyPanel.classList.contains('translate-x-full')) {
+                            document.getElementById(`chat-search-${currentAgentId}`).value = '';
                             renderSavedChatsList(currentAgentId);
                             historyPanel.classList.remove('translate-x-full');
                         } else {
@@ -1837,7 +4029,11 @@ HTML_TEMPLATE = r"""
 			try {
 				const res = await fetch("/conversations");
 				if (!res.ok) throw new Error("Failed to load histories");
-				savedHistories = await res.json();
+				const conversations = await res.json();
+				for (const [agentId, page] of Object.entries(conversations)) {
+					savedHistories[agentId] = page.chats;
+					savedChatsHasMore[agentId] = page.has_more;
+				}
 			} catch (err) {
 				console.error("Could not load saved conversations:", err);
 				showError("Could not load saved conversations. They may be lost.");
@@ -1867,10 +4063,17 @@ DEFAULT_AGENT = {
 
 
 
+# The ids of the agents in agents.json, updated when the file is read or
+# written, so metric_labels() does not read the file on every request.
+agent_ids = None
+
+
 def save_agents(all_agents):
     """Saves the full list of agents to agents.json."""
+    global agent_ids
     with open(AGENTS_FILE, "w") as f:
         json.dump(all_agents, f, indent=2)
+    agent_ids = {a.get("id") for a in all_agents}
 		
 		
 
@@ -1898,32 +4101,50 @@ def initialize_agents_file():
 
 def load_agents():
     """Loads all agents from agents.json, falling back to default if file is corrupt."""
+    global agent_ids
     try:
         with open(AGENTS_FILE, "r") as f:
-            return json.load(f)
+            all_agents = json.load(f)
     except (json.JSONDecodeError, IOError):
-        return [DEFAULT_AGENT]
+        all_agents = [DEFAULT_AGENT]
+    agent_ids = {a.get("id") for a in all_agents}
+    return all_agents
 
 
 
-def load_conversations():
-	# Stop conversations from being loaded
-    return {}
-    if not os.path.exists(CONVERSATIONS_FILE):
-        return {}
-    try:
-        with open(CONVERSATIONS_FILE, "r") as f:
-            return json.load(f)
-    except (json.JSONDecodeError, IOError):
-        return {}
-		
-		
+def get_agent(agent_id):
+    """Returns the agent with the given id, or None."""
+    if not agent_id:
+        return None
+    return next((a for a in load_agents() if a.get("id") == agent_id), None)
+
+
 
-def save_conversations(conversations):
-	# Stops the chat history from being saved
-    return
-    with open(CONVERSATIONS_FILE, "w") as f:
-        json.dump(conversations, f, indent=2)
+# -----------------------------------------
+# Saved chats
+# -----------------------------------------
+# Only used when CONVERSATIONS_DB is set. Each save writes the messages
+# that changed in one chat, not the whole file of every chat.
+# Saved images are stored once each, however many chats show them.
+# When it is None nothing is stored and the routes below behave as before:
+# the list of saved chats is always empty.
+
+conversation_store = None
+if CONVERSATIONS_DB:
+    # Images and documents are kept once in a blob folder next to the
+    # database, and come back as attachment urls when a chat is opened.
+    conversation_store = ConversationStore(
+        CONVERSATIONS_DB,
+        url_prefix=ATTACHMENT_URL_PREFIX,
+        resolve_url=lambda url: attachment_store.get(url[len(ATTACHMENT_URL_PREFIX):]),
+    )
+    attachment_store.fallback = conversation_store.read_blob
+    try:
+        migrated = conversation_store.migrate_json(CONVERSATIONS_FILE)
+        if migrated:
+            print(f"[INFO] Imported {migrated} chats from {CONVERSATIONS_FILE} into {CONVERSATIONS_DB}.")
+    except (json.JSONDecodeError, OSError) as e:
+        print(f"[ERROR] Could not import {CONVERSATIONS_FILE}: {e}")
 		
 		
 
@@ -2007,10 +4228,8 @@ def delete_agent(agent_id):
     all_agents = [a for a in all_agents if a["id"] != agent_id]
     save_agents(all_agents)
     
-    conversations = load_conversations()
-    if agent_id in conversations:
-        del conversations[agent_id]
-        save_conversations(conversations)
+    if conversation_store:
+        conversation_store.delete_agent_chats(agent_id)
         
     return jsonify({"status": "deleted"})
 	
@@ -2018,7 +4237,67 @@ def delete_agent(agent_id):
 
 @app.route("/conversations", methods=["GET"])
 def get_conversations():
-    return jsonify(load_conversations())
+    """The first page of saved chats of each agent: {agent_id: {chats, has_more}}."""
+    if not conversation_store:
+        return jsonify({})
+    limit = max(1, request.args.get("limit", CONVERSATIONS_PAGE_SIZE, type=int))
+    conversations = {}
+    for agent_id in conversation_store.agent_ids():
+        chats, has_more = conversation_store.list_chats(agent_id, limit)
+        conversations[agent_id] = {"chats": chats, "has_more": has_more}
+    return jsonify(conversations)
+	
+		
+
+@app.route("/conversations/search", methods=["GET"])
+def search_conversations():
+    """
+    Full-text search of the saved messages: ?q=words&agent_id=...&limit=...
+    Returns {"results": [{agent_id, chat_id, title, timestamp, message_count,
+    seq, snippet, score}]}, best match first. The matched words of a snippet
+    are between \x02 and \x03.
+    """
+    query = request.args.get("q", "")
+    if not conversation_store or not query.strip():
+        return jsonify({"results": []})
+    limit = min(max(1, request.args.get("limit", 20, type=int)), 100)
+    started = time.perf_counter()
+    results = conversation_store.search(query, limit, request.args.get("agent_id") or None)
+    print(f"[INFO] Chat search: {len(results)} results in {(time.perf_counter() - started) * 1000:.1f} ms")
+    return jsonify({"results": results})
+	
+		
+
+@app.route("/conversations/<agent_id>", methods=["GET"])
+def get_agent_conversations(agent_id):
+    """
+    The next page of saved chats of one agent. before_timestamp and
+    before_id are those of the last chat of the previous page.
+    """
+    if not conversation_store:
+        return jsonify({"chats": [], "has_more": False})
+    limit = max(1, request.args.get("limit", CONVERSATIONS_PAGE_SIZE, type=int))
+    before = None
+    if request.args.get("before_timestamp") and request.args.get("before_id"):
+        before = (request.args["before_timestamp"], request.args["before_id"])
+    chats, has_more = conversation_store.list_chats(agent_id, limit, before)
+    return jsonify({"chats": chats, "has_more": has_more})
+	
+		
+
+@app.route("/conversations/<agent_id>/<chat_id>", methods=["GET"])
+def get_conversation(agent_id, chat_id):
+    """
+    The messages of a saved chat, from start to end (like a Python slice,
+    so start=-40 gives the last 40). "start" in the reply is the position
+    of the first message returned.
+    """
+    start = request.args.get("start", 0, type=int)
+    end = request.args.get("end", None, type=int)
+    chat = conversation_store.get_messages(agent_id, chat_id, start, end) if conversation_store else None
+    if chat is None:
+        return jsonify({"error": "History not found"}), 404
+    return jsonify(chat)
 	
 		
 
@@ -2028,12 +4307,10 @@ def save_conversation(agent_id):
     if not all(k in new_chat_session for k in ['id', 'timestamp', 'title', 'history']):
         return jsonify({"error": "Invalid chat session format"}), 400
 
-    conversations = load_conversations()
-    if agent_id not in conversations:
-        conversations[agent_id] = []
+    if not conversation_store:
+        return jsonify({"status": "not saved"}), 200
 
-    conversations[agent_id].insert(0, new_chat_session)
-    save_conversations(conversations)
+    conversation_store.create_chat(agent_id, new_chat_session)
     return jsonify({"status": "saved"}), 200
 	
 		
@@ -2044,17 +4321,38 @@ def update_conversation(agent_id, chat_id):
     if 'history' not in updated_data:
         return jsonify({"error": "Invalid update format, missing history"}), 400
 
-    conversations = load_conversations()
-    if agent_id in conversations:
-        chat_index = next((i for i, chat in enumerate(conversations[agent_id]) if chat.get('id') == chat_id), -1)
+    # The chat moves to the top of the list (newest timestamp first)
+    timestamp = datetime.now(timezone.utc).isoformat()
+    if conversation_store and conversation_store.replace_history(agent_id, chat_id, updated_data['history'], timestamp):
+        return jsonify({"status": "updated"})
+
+    return jsonify({"error": "History not found"}), 404
+	
+		
 
-        if chat_index != -1:
-            conversations[agent_id][chat_index]['history'] = updated_data['history']
-            conversations[agent_id][chat_index]['timestamp'] = datetime.now(timezone.utc).isoformat()
-            updated_chat = conversations[agent_id].pop(chat_index)
-            conversations[agent_id].insert(0, updated_chat)
-            save_conversations(conversations)
-            return jsonify({"status": "updated"})
+@app.route("/conversations/<agent_id>/<chat_id>", methods=["PATCH"])
+def append_conversation(agent_id, chat_id):
+    """
+    Adds the new messages of a turn to a saved chat.
+    base_seq is the number of messages the browser knows are saved. If the
+    saved chat has a different number (e.g. it was saved from another tab),
+    the reply is a 409 with the saved count and the browser sends the full
+    history with PUT instead.
+    """
+    data = request.json or {}
+    messages = data.get("messages")
+    base_seq = data.get("base_seq")
+    if not isinstance(messages, list) or not isinstance(base_seq, int):
+        return jsonify({"error": "Invalid append format, need base_seq and messages"}), 400
+
+    if conversation_store:
+        timestamp = datetime.now(timezone.utc).isoformat()
+        try:
+            message_count = conversation_store.append_messages(agent_id, chat_id, messages, timestamp, base_seq)
+        except SequenceConflictError as e:
+            return jsonify({"error": str(e), "message_count": e.message_count}), 409
+        if message_count is not None:
+            return jsonify({"status": "appended", "message_count": message_count})
 
     return jsonify({"error": "History not found"}), 404
 	
@@ -2062,13 +4360,8 @@ def update_conversation(agent_id, chat_id):
 
 @app.route("/conversations/<agent_id>/<chat_id>", methods=["DELETE"])
 def delete_conversation(agent_id, chat_id):
-    conversations = load_conversations()
-    if agent_id in conversations:
-        initial_len = len(conversations[agent_id])
-        conversations[agent_id] = [chat for chat in conversations[agent_id] if chat.get('id') != chat_id]
-        if len(conversations[agent_id]) < initial_len:
-            save_conversations(conversations)
-            return jsonify({"status": "deleted"})
+    if conversation_store and conversation_store.delete_chat(agent_id, chat_id):
+        return jsonify({"status": "deleted"})
     return jsonify({"error": "History not found"}), 404
 
 
@@ -2100,110 +4393,649 @@ def change_model():
 
 
 
-@app.route("/upload_pdf", methods=["POST"])
-def upload_pdf():
-    if 'pdf_file' not in request.files:
-        return jsonify({"error": "No PDF file part in the request"}), 400
+class PdfTooLargeError(Exception):
+    pass
+
+
+def plan_pdf_pages(job, filename, labels):
+    """
+    Decides which pdf pages are sent as text and which as images.
+    Returns (paths, image_pages, document):
+    - paths: the path each page takes, e.g. {"page": 1, "kind": "text", "path": "text"}
+    - image_pages: indexes of the pages that must be rendered
+    - document: {"url", "name", "pages", "tokens"} for the text of the pdf,
+      or None if no page has usable text
+    """
+    page_count = job.page_count()
+    max_pages = MAX_TEXT_PAGES if PDF_TEXT_PAGES else MAX_PAGES
+    if page_count > max_pages:
+        raise PdfTooLargeError(f"PDF has {page_count} pages. Maximum allowed is {max_pages} pages.")
+
+    if not PDF_TEXT_PAGES:
+        paths = [{"page": i + 1, "kind": "image", "path": "image"} for i in range(page_count)]
+        return paths, list(range(page_count)), None
+
+    analyzed = list(job.analyze_pages(range(page_count), PDF_TEXT_MIN_CHARS, PDF_FIGURE_MIN_AREA))
+    image_pages = [p["page"] for p in analyzed if p["kind"] != PAGE_TEXT]
+    if len(image_pages) > MAX_PAGES:
+        raise PdfTooLargeError(
+            f"PDF has {len(image_pages)} scanned or figure pages that must be sent as images. "
+            f"Maximum allowed is {MAX_PAGES} pages."
+        )
+    paths = [
+        {"page": p["page"] + 1, "kind": p["kind"], "path": "text" if p["kind"] == PAGE_TEXT else "image"}
+        for p in analyzed
+    ]
+
+    text_pages = [p["page"] + 1 for p in analyzed if p["kind"] == PAGE_TEXT]
+    if not text_pages:
+        return paths, image_pages, None
+
+    # The pages that are sent as images keep their place in the text
+    sections = [f"# {filename}"]
+    for p in analyzed:
+        sections.append(f"## Page {p['page'] + 1}")
+        if p["kind"] != PAGE_TEXT:
+            sections.append("(This page is attached as an image.)")
+        else:
+            sections.append(p["text"] or "(This page is empty.)")
+    text = "\n\n".join(sections)
+    handle = attachment_store.add(text.encode("utf-8"), "text/markdown; charset=utf-8")
+    METRICS["pdf_pages"].inc(dict(labels, path="text"), len(text_pages))
+    document = {
+        "url": f"{ATTACHMENT_URL_PREFIX}{handle}",
+        "name": filename,
+        "pages": text_pages,
+        "tokens": estimate_tokens({"content": text}),
+    }
+    return paths, image_pages, document
+
+
+def index_for_retrieval(agent_id, document):
+    """Starts indexing the document in the background if the agent answers from excerpts."""
+    agent = get_agent(agent_id)
+    if document and agent and agent.get("retrieval"):
+        document_index.ensure_in_background(document["url"][len(ATTACHMENT_URL_PREFIX):])
+
+
+def store_pdf_page(page, labels):
+    """Stores a rendered pdf page as an attachment and records its timings."""
+    handle = attachment_store.add(page["data"], page["mimetype"])
+    if not page["preview"]:
+        METRICS["pdf_cache"].inc(dict(labels, result="hit" if page["cached"] else "miss"))
+        if not page["cached"]:
+            METRICS["pdf_render"].observe(labels, page["render_seconds"])
+            METRICS["pdf_encode"].observe(labels, page["encode_seconds"])
+        METRICS["pdf_pages"].inc(dict(labels, path="image"))
+    return {
+        "page": page["page"] + 1,
+        "image": f"{ATTACHMENT_URL_PREFIX}{handle}",
+        "render_ms": round(page["render_seconds"] * 1000, 1),
+        "encode_ms": round(page["encode_seconds"] * 1000, 1),
+        "cached": page["cached"],
+    }
+
+
+def pdf_job_from_request():
+    """
+    Returns (job, filename) for the pdf of an upload request. The pdf is
+    either an uploaded file (pdf_file) or a finished chunked upload
+    (upload_id). Either way it is opened from memory or from its temp file,
+    which is deleted when the job is closed. Raises UploadError.
+    """
+    upload_id = request.form.get("upload_id")
+    if upload_id:
+        pdf, filename, sha256 = upload_store.take(upload_id)
+        if not filename.endswith('.pdf'):
+            UploadStore._remove_file(pdf)
+            raise UploadError("Invalid file type. Please upload a PDF file.", 400)
+        return pdf_renderer.job(pdf, doc_hash=sha256, delete_file=True), filename
 
+    if 'pdf_file' not in request.files:
+        raise UploadError("No PDF file part in the request", 400)
     pdf_file = request.files['pdf_file']
     if pdf_file.filename == '':
-        return jsonify({"error": "No selected file"}), 400
+        raise UploadError("No selected file", 400)
+    if not pdf_file.filename.endswith('.pdf'):
+        raise UploadError("Invalid file type. Please upload a PDF file.", 400)
+    return pdf_renderer.job(take_spooled_file(pdf_file), delete_file=True), pdf_file.filename
 
-    if pdf_file and pdf_file.filename.endswith('.pdf'):
-        try:
-            pdf_bytes = pdf_file.read()
-            doc = fitz.open(stream=pdf_bytes, filetype="pdf")
 
-            page_count = len(doc)
-            if page_count > MAX_PAGES:
-                doc.close()
-                error_msg = f"PDF has {page_count} pages. Maximum allowed is {MAX_PAGES} pages."
-                return jsonify({"error": error_msg}), 400
+@app.route("/upload_pdf", methods=["POST"])
+def upload_pdf():
+    labels = metric_labels(request.form.get("model", MODEL_NAME), request.form.get("agent_id"))
+    METRICS["request_bytes"].observe(dict(labels, endpoint="upload_pdf"), request.content_length or 0)
+
+    try:
+        job, filename = pdf_job_from_request()
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+
+    try:
+        with job:
+            paths, image_pages, document = plan_pdf_pages(job, filename, labels)
+            index_for_retrieval(request.form.get("agent_id"), document)
 
             images = []
-            for page in doc:
-                matrix = fitz.Matrix(PDF_IMAGE_RES, PDF_IMAGE_RES)
-                pix = page.get_pixmap(matrix=matrix)
-                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                byte_io = io.BytesIO()
-                img.save(byte_io, 'JPEG', quality=90, optimize=True)
-                base64_encoded = base64.b64encode(byte_io.getvalue()).decode('utf-8')
-                images.append(f"data:image/jpeg;base64,{base64_encoded}")
-
-            doc.close()
-            return jsonify({"images": images}), 200
+            timings = []
+            profile = get_image_profile(request.form.get("model", MODEL_NAME))
+            pages = job.render_pages(image_pages, PDF_IMAGE_RES, profile["quality"],
+                                     codec=profile["format"], long_edge=profile.get("long_edge"))
+            for page in pages:
+                result = store_pdf_page(page, labels)
+                images.append(result.pop("image"))
+                timings.append(result)
+
+        return jsonify({"images": images, "document": document, "paths": paths, "timings": timings}), 200
+
+    except PdfTooLargeError as e:
+        return jsonify({"error": str(e)}), 400
+
+    except PdfTimeoutError as e:
+        print(f"[ERROR] PDF conversion timed out: {e}", file=sys.stderr)
+        return jsonify({"error": str(e)}), 504
+
+    except PdfWorkerError as e:
+        print(f"[ERROR] PDF worker failed: {e}", file=sys.stderr)
+        return jsonify({"error": str(e)}), 500
+
+    except Exception as e:
+        print(f"[ERROR] PDF conversion error: {e}", file=sys.stderr)
+        return jsonify({"error": f"Failed to process PDF: {str(e)}"}), 500
+
+
+
+@app.route("/upload_pdf_stream", methods=["POST"])
+def upload_pdf_stream():
+    """
+    Same as upload_pdf, but each page image is sent as soon as it is ready.
+    The response is newline delimited JSON:
+      {"pages": 12, "paths": [...], "document": {...} or null}
+      {"page": 3, "preview": "/attachments/..."}   (low resolution, optional)
+      {"page": 3, "image": "/attachments/...", "render_ms": ..., "encode_ms": ...}
+      ...
+      {"done": true}
+    If rendering fails part way, an {"error": "..."} line is sent instead of done.
+    """
+    labels = metric_labels(request.form.get("model", MODEL_NAME), request.form.get("agent_id"))
+    METRICS["request_bytes"].observe(dict(labels, endpoint="upload_pdf_stream"), request.content_length or 0)
+    profile = get_image_profile(request.form.get("model", MODEL_NAME))
+
+    try:
+        job, filename = pdf_job_from_request()
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status
 
+    try:
+        paths, image_pages, document = plan_pdf_pages(job, filename, labels)
+    except PdfTooLargeError as e:
+        job.close()
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        job.close()
+        print(f"[ERROR] PDF conversion error: {e}", file=sys.stderr)
+        status = 504 if isinstance(e, PdfTimeoutError) else 500
+        return jsonify({"error": f"Failed to process PDF: {str(e)}"}), status
+    index_for_retrieval(request.form.get("agent_id"), document)
+
+    def generate():
+        yield json.dumps({"pages": len(paths), "paths": paths, "document": document}) + "\n"
+        try:
+            preview_res = PDF_PREVIEW_RES if len(image_pages) > 1 else None
+            pages = job.render_pages(image_pages, PDF_IMAGE_RES, profile["quality"],
+                                     codec=profile["format"], long_edge=profile.get("long_edge"),
+                                     preview_scale=preview_res, preview_quality=PDF_PREVIEW_QUALITY)
+            for page in pages:
+                result = store_pdf_page(page, labels)
+                if page["preview"]:
+                    result = {"page": result["page"], "preview": result["image"]}
+                yield json.dumps(result) + "\n"
+            yield json.dumps({"done": True}) + "\n"
         except Exception as e:
             print(f"[ERROR] PDF conversion error: {e}", file=sys.stderr)
-            return jsonify({"error": f"Failed to process PDF: {str(e)}"}), 500
+            yield json.dumps({"error": f"Failed to process PDF: {str(e)}"}) + "\n"
+        finally:
+            job.close()
+
+    response = Response(generate(), mimetype="application/x-ndjson")
+    # Also frees the job if the browser leaves before the stream starts
+    response.call_on_close(job.close)
+    return response
+
+
+
+@app.route("/uploads", methods=["POST"])
+def create_upload():
+    """Starts a chunked upload. Expects JSON {"filename": ..., "size": ...}."""
+    data = request.json or {}
+    try:
+        size = int(data.get("size", 0))
+        upload_id = upload_store.create(data.get("filename", ""), size)
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid file size."}), 400
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+    return jsonify({"upload_id": upload_id, "offset": 0, "chunk_size": UPLOAD_CHUNK_SIZE}), 201
+
+
+@app.route("/uploads/<upload_id>", methods=["GET"])
+def upload_status(upload_id):
+    try:
+        return jsonify(upload_store.status(upload_id))
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+
+
+@app.route("/uploads/<upload_id>", methods=["PUT"])
+def upload_chunk(upload_id):
+    """Appends the request body to the upload. ?offset= must match the data received so far."""
+    METRICS["request_bytes"].observe(dict(metric_labels(None, None), endpoint="uploads"), request.content_length or 0)
+    try:
+        offset = int(request.args.get("offset", ""))
+    except ValueError:
+        return jsonify({"error": "Missing offset."}), 400
+    try:
+        offset = upload_store.append(upload_id, offset, request.stream)
+        return jsonify(dict(upload_store.status(upload_id), offset=offset))
+    except UploadError as e:
+        return jsonify({"error": str(e), "offset": e.offset}), e.status
+
+
+@app.route("/uploads/<upload_id>", methods=["DELETE"])
+def delete_upload(upload_id):
+    if upload_store.delete(upload_id):
+        return jsonify({"status": "deleted"})
+    return jsonify({"error": "Upload not found"}), 404
+
 
-    return jsonify({"error": "Invalid file type. Please upload a PDF file."}), 400
+
+@app.route("/upload_image", methods=["POST"])
+def upload_image():
+    if 'image_file' not in request.files:
+        return jsonify({"error": "No image file part in the request"}), 400
+
+    labels = metric_labels(request.form.get("model", MODEL_NAME), request.form.get("agent_id"))
+    METRICS["request_bytes"].observe(dict(labels, endpoint="upload_image"), request.content_length or 0)
+
+    image_file = request.files['image_file']
+    image_bytes = image_file.read()
+    if not image_bytes:
+        return jsonify({"error": "No selected file"}), 400
+
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            img.verify()
+        profile = get_image_profile(request.form.get("model", MODEL_NAME))
+        image_bytes, mimetype = normalize_image(image_bytes, profile)
+    except Exception as e:
+        print(f"[ERROR] Image upload error: {e}", file=sys.stderr)
+        return jsonify({"error": "Invalid file type. Please upload an image file."}), 400
+
+    handle = attachment_store.add(image_bytes, mimetype)
+    return jsonify({"handle": handle, "url": f"{ATTACHMENT_URL_PREFIX}{handle}"}), 200
+
+
+
+@app.route("/attachments/<handle>", methods=["GET"])
+def get_attachment(handle):
+    entry = attachment_store.get(handle)
+    if entry is None:
+        return jsonify({"error": "Attachment not found"}), 404
+    data, mimetype = entry
+    response = Response(data, mimetype=mimetype)
+    response.headers["Cache-Control"] = "no-store"
+    response.headers["X-Content-Type-Options"] = "nosniff"
+    return response
 
 
 
 @app.route("/stream_chat", methods=["POST"])
 def stream_chat():
+    received_at = time.perf_counter()
     data = request.json
     client_messages = data.get("messages", [])
     model_to_use = data.get("model", MODEL_NAME)
+    session_id = data.get("session_id")
+    labels = metric_labels(model_to_use, data.get("agent_id"))
+    METRICS["request_bytes"].observe(dict(labels, endpoint="stream_chat"), request.content_length or 0)
     print(f"\n[INFO] Received request for /stream_chat with model '{model_to_use}'.")
 
-    ollama_messages = []
-    for msg in client_messages:
-        role = msg.get('role')
-        content = msg.get('content')
+    priority = data.get("priority", 0)
+    if not isinstance(priority, int) or isinstance(priority, bool):
+        return jsonify({"error": "priority must be an integer."}), 400
+    priority = min(max(priority, 0), MAX_REQUEST_PRIORITY)
 
-        if isinstance(content, list):
-            image_parts = [part['image_url']['url'].split(',', 1)[1] for part in content if part.get('type') == 'image_url' and ',' in part.get('image_url', {}).get('url', '')]
-            text_parts = [part.get('text', '') for part in content if part.get('type') == 'text']
-            
-            ollama_msg = {'role': role, 'content': " ".join(text_parts)}
-            if image_parts:
-                ollama_msg['images'] = image_parts
-            ollama_messages.append(ollama_msg)
+    agent = get_agent(data.get("agent_id"))
+    retrieval = bool(agent and agent.get("retrieval"))
 
-        elif isinstance(content, str):
-            ollama_messages.append({'role': role, 'content': content})
+    # An inlined document may fill the prompt, but no more
+    document_budget = context_budget(agent, model_to_use) - estimate_tokens({'content': data.get("system") or ""})
+    if agent and agent.get("summarizeHistory"):
+        document_budget -= SUMMARY_MAX_TOKENS
+    try:
+        new_messages, notices = to_ollama_messages(client_messages, not retrieval, document_budget)
+    except AttachmentMissingError as e:
+        return jsonify({"error": str(e)}), 410
+    for notice in notices:
+        print(f"[WARNING] {notice}")
+
+    session = None
+    session_base_len = 0
+    if session_id:
+        # The browser sends the full history (reset) when it starts a new
+        # session, and only the new messages after that.
+        if data.get("reset"):
+            session = session_store.reset(session_id, data.get("system", ""))
+        else:
+            session = session_store.get(session_id)
+        if session is None:
+            return jsonify({"error": "Chat session not found.", "resync": True}), 409
+
+        with session["lock"]:
+            if not data.get("reset") and data.get("base_len") != len(session["messages"]):
+                return jsonify({"error": "Chat session is out of sync.", "resync": True}), 409
+            if "system" in data:
+                session["system"] = data.get("system") or ""
+            session_base_len = len(session["messages"])
+            session["messages"].extend(new_messages)
+            history = list(session["messages"])
+            system_prompt = session["system"]
+        print(f"[INFO] Session {session_id}: {len(client_messages)} new message(s), {len(history)} in history.")
+    else:
+        history = new_messages
+        system_prompt = "\n".join(m['content'] for m in history if m['role'] == 'system')
+        history = [m for m in history if m['role'] != 'system']
+
+    # Trim the history to the agent's token budget
+    summarize = session is not None and bool(agent and agent.get("summarizeHistory"))
+    budget = context_budget(agent, model_to_use)
+    budget -= estimate_tokens({'content': system_prompt}) if system_prompt else 0
+    if summarize:
+        budget -= SUMMARY_MAX_TOKENS
+
+    # Documents are searched across the whole chat, even if the message
+    # they were attached to has been trimmed.
+    document_ids = list(dict.fromkeys(d for m in history for d in m.get('documents', [])))
+    if retrieval and document_ids:
+        budget -= math.ceil(RAG_TOP_K * RAG_CHUNK_CHARS / CHARS_PER_TOKEN)
+    window_start = fit_messages_to_budget(history, budget, model_to_use)
+    if window_start > 0:
+        print(f"[INFO] Context: trimmed {window_start} old message(s) to fit a budget of {budget} tokens.")
+
+    try:
+        window = resolve_attachments(history[window_start:])
+    except AttachmentMissingError as e:
+        if session is not None:
+            session_store.delete(session_id)
+        return jsonify({"error": str(e)}), 410
+
+    try:
+        ticket = scheduler.submit(priority)
+    except QueueFullError as e:
+        print(f"[WARNING] Rejected request for '{model_to_use}': queue is full.")
+        METRICS["requests"].inc(dict(labels, outcome="rejected"))
+        if session is not None:
+            with session["lock"]:
+                del session["messages"][session_base_len:]
+        return jsonify({"error": str(e)}), 429
+
+    request_id, stream_state = stream_registry.register()
+    reader = {}  # the CancellableStream, once Ollama has been called
+
+    def release_ticket():
+        # Once Ollama has been called, the reader thread frees the slot
+        if "stream" not in reader:
+            scheduler.release(ticket)
 
     def generate_chunks():
+        reply_parts = []
+        coalescer = ChunkCoalescer(STREAM_FLUSH_INTERVAL, STREAM_FLUSH_MAX_TOKENS)
+        stream = None
+        outcome = "error"
+        first_token_at = None
+        counted_active = False
         try:
-            stream = ollama_chat(
+            yield f"data: {json.dumps({'request_id': request_id})}\n\n"
+            for notice in notices:
+                yield f"data: {json.dumps({'warning': notice})}\n\n"
+
+            # Wait for a free Ollama slot and keep the browser informed
+            while not scheduler.wait(ticket, QUEUE_UPDATE_INTERVAL):
+                if stream_state["cancel"].is_set():
+                    print(f"[INFO] Request {request_id} was cancelled while queued.")
+                    outcome = "cancelled"
+                    return
+                yield f"data: {json.dumps({'queue': {'position': scheduler.position(ticket)}})}\n\n"
+            queue_wait = time.perf_counter() - ticket["queued_at"]
+            if queue_wait > 0.01:
+                print(f"   [STATS] Queue wait:        {queue_wait:.2f} s")
+            METRICS["queue_wait"].observe(labels, queue_wait)
+            if stream_state["cancel"].is_set():
+                outcome = "cancelled"
+                return
+            METRICS["active_streams"].inc(labels)
+            counted_active = True
+
+            if retrieval and document_ids and window and window[-1]['role'] == 'user':
+                yield f"data: {json.dumps({'status': 'Searching the documents...'})}\n\n"
+                retrieval_start = time.perf_counter()
+                question = window[-1]['content']
+                excerpts = document_index.search(document_ids, question, RAG_TOP_K)
+                window[-1] = dict(window[-1], content=format_excerpts(excerpts, question))
+                retrieval_seconds = time.perf_counter() - retrieval_start
+                METRICS["retrieval"].observe(labels, retrieval_seconds)
+                cited = ", ".join(sorted({f"p. {e['page']}" for e in excerpts}, key=lambda c: int(c[3:])))
+                print(f"   [STATS] Retrieval:         {len(excerpts)} excerpt(s) in {retrieval_seconds:.2f} s ({cited})")
+
+            ollama_messages = []
+            if system_prompt:
+                ollama_messages.append({'role': 'system', 'content': system_prompt})
+            if summarize and window_start > 0:
+                summary = session["summary"]
+                if window_start > session["summarized_count"]:
+                    yield f"data: {json.dumps({'status': 'Summarizing earlier messages...'})}\n\n"
+                    try:
+                        summary = summarize_messages(model_to_use, summary, history[session["summarized_count"]:window_start])
+                        with session["lock"]:
+                            session["summary"] = summary
+                            session["summarized_count"] = window_start
+                    except Exception as e:
+                        # Fall back to plain trimming
+                        print(f"[ERROR] Could not summarize the chat history: {e}", file=sys.stderr)
+                if summary:
+                    ollama_messages.append({'role': 'system', 'content': f"Summary of the earlier conversation:\n{summary}"})
+            ollama_messages.extend(window)
+
+            # Size the context to the prompt. A session never drops to a
+            # smaller bucket, so the model is not reloaded on every turn.
+            prompt_estimate = sum(estimate_tokens(m, model_to_use) for m in ollama_messages)
+            num_ctx = choose_num_ctx(prompt_estimate, model_to_use, session["num_ctx"] if session else 0)
+            if session is not None:
+                session["num_ctx"] = num_ctx
+
+            think = think_option(model_to_use, agent)
+            stream = reader["stream"] = CancellableStream(ollama_chat(
 				model=model_to_use,
 				messages=ollama_messages,
 				stream=True,
+				think=think,
 				options={
-					"num_ctx": NUM_CTX, "temperature": TEMPERATURE,
+					"num_ctx": num_ctx, "temperature": TEMPERATURE,
 					"top_k": TOP_K, "top_p": TOP_P,
 					"frequency_penalty": FREQUENCY_PENALTY, "repeat_penalty": REPEAT_PENALTY,
 				}
-			)
+			), stream_state["cancel"], on_done=lambda: scheduler.release(ticket))
 
             print("[INFO] Started streaming response from Ollama.")
+            splitter = ThinkTagSplitter()
             for chunk in stream:
-                if 'content' in chunk.get('message', {}):
-                    sse_data = json.dumps({'chunk': chunk['message']['content']})
-                    yield f"data: {sse_data}\n\n"
+                message = chunk.get('message', {})
+                parts = [("thinking", message.get('thinking'))] if message.get('thinking') else []
+                if message.get('content'):
+                    parts.extend(splitter.feed(message['content']))
+                if chunk.get('done'):
+                    parts.extend(splitter.flush())
+
+                if parts and first_token_at is None:
+                    first_token_at = time.perf_counter()
+                    METRICS["ttft"].observe(labels, first_token_at - received_at)
+
+                for field, text in parts:
+                    if field == "chunk":
+                        reply_parts.append(text)
+                    for frame in coalescer.add(text, field):
+                        yield frame
 
                 if chunk.get('done'):
-                    prompt_tokens = chunk.get('prompt_eval_count', 0)
-                    completion_tokens = chunk.get('eval_count', 0)
+                    frame = coalescer.flush()
+                    if frame:
+                        yield frame
+
+                    outcome = "ok"
+                    prompt_tokens = chunk.get('prompt_eval_count') or 0
+                    completion_tokens = chunk.get('eval_count') or 0
                     total_tokens = prompt_tokens + completion_tokens
+                    METRICS["tokens"].inc(dict(labels, kind="prompt"), prompt_tokens)
+                    METRICS["tokens"].inc(dict(labels, kind="completion"), completion_tokens)
+                    if chunk.get('eval_duration'):
+                        METRICS["tokens_per_second"].observe(labels, completion_tokens / (chunk['eval_duration'] / 1e9))
+                    if chunk.get('prompt_eval_duration'):
+                        METRICS["prompt_eval"].observe(labels, chunk['prompt_eval_duration'] / 1e9)
 
                     print("[INFO] Finished streaming response.")
                     print(f"   [STATS] Prompt Tokens:     {prompt_tokens}")
                     print(f"   [STATS] Completion Tokens: {completion_tokens}")
                     print(f"   [STATS] Total Tokens:      {total_tokens}")
-
-                    if total_tokens >= (NUM_CTX * 0.9):
-                        warning_msg = f"Chat history is now {total_tokens} tokens. The maximum is {NUM_CTX}. The AI will lose track of the conversation. Please start a new chat."
+                    print(f"   [STATS] num_ctx:           {num_ctx} (estimated prompt {prompt_estimate})")
+                    print(f"   [STATS] SSE frames:        {coalescer.frames_sent}")
+
+                    # The estimate can be far off (other tokenizers, images),
+                    # so the next turn starts from what Ollama counted.
+                    if session is not None:
+                        session["num_ctx"] = max(num_ctx, choose_num_ctx(total_tokens, model_to_use))
+                    if total_tokens >= (num_ctx * 0.9):
+                        warning_msg = f"Chat history is now {total_tokens} tokens. The context window is {num_ctx}. The AI will lose track of the conversation. Please start a new chat."
                         print(f"[WARNING] {warning_msg}")
                         yield f"data: {json.dumps({'warning': warning_msg})}\n\n"
 
+            if outcome != "ok" and stream_state["cancel"].is_set():
+                print(f"[INFO] Request {request_id} was cancelled by the user.")
+                outcome = "cancelled"
+                # Send the buffered text too, so the browser shows the reply that is kept
+                frame = coalescer.flush()
+                if frame:
+                    yield frame
+
+        except GeneratorExit:
+            # Werkzeug closes the generator when the browser disconnects.
+            print(f"[INFO] Client disconnected from request {request_id}.")
+            outcome = "disconnected"
+            raise
+
+        except AttachmentMissingError as e:
+            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+
         except Exception as e:
             print(f"[ERROR] An error occurred during streaming: {e}", file=sys.stderr)
+            frame = coalescer.flush()
+            if frame:
+                yield frame
             yield f"data: {json.dumps({'error': f'Ollama API Error: {str(e)}'})}\n\n"
 
-    return Response(generate_chunks(), mimetype='text/event-stream')
+        finally:
+            # Closing the iterator closes the HTTP connection to Ollama,
+            # which stops generation on the Ollama side.
+            if stream is not None:
+                stream.close()
+            if counted_active:
+                METRICS["active_streams"].dec(labels)
+            release_ticket()
+            METRICS["requests"].inc(dict(labels, outcome=outcome))
+            cancel_latency = stream_registry.unregister(request_id)
+            if cancel_latency is not None:
+                print(f"   [STATS] Cancel latency:    {cancel_latency * 1000:.1f} ms")
+                METRICS["cancel_latency"].observe(labels, cancel_latency)
+
+            # Keep the session in step with the browser, which always adds
+            # an assistant message (even a partial or failed one).
+            if session is not None:
+                reply = "".join(reply_parts).strip()
+                with session["lock"]:
+                    session["messages"].append({'role': 'assistant', 'content': reply})
+
+    response = Response(generate_chunks(), mimetype='text/event-stream')
+    # The generator's finally does not run if the body is never iterated,
+    # e.g. when the client goes away before the response starts.
+    response.call_on_close(release_ticket)
+    response.call_on_close(lambda: stream_registry.unregister(request_id))
+    return response
+
+
+
+@app.route("/stream_chat/<request_id>/cancel", methods=["POST"])
+def cancel_stream(request_id):
+    if stream_registry.cancel(request_id):
+        return jsonify({"status": "cancelling"})
+    return jsonify({"error": "Request not found"}), 404
+
+
+
+@app.route("/summarize_document", methods=["POST"])
+def summarize_document():
+    """
+    Summarizes an attached document of any length (see summarize_document_events).
+    Expects JSON {"document_url": ..., "model": ...}. The response is SSE:
+    progress events, then {"summary": ...}, or {"error": ...}.
+    """
+    data = request.json or {}
+    model_to_use = data.get("model", MODEL_NAME)
+    try:
+        text = read_document(data.get("document_url", ""))
+    except AttachmentMissingError as e:
+        return jsonify({"error": str(e)}), 410
+    print(f"\n[INFO] Received request for /summarize_document with model '{model_to_use}'.")
+
+    cancel = threading.Event()
+
+    def generate():
+        start = time.perf_counter()
+        try:
+            for event in summarize_document_events(model_to_use, text, cancel):
+                if "summary" in event:
+                    print("[INFO] Finished the document summary.")
+                    print(f"   [STATS] Parts:             {event['parts']}")
+                    print(f"   [STATS] Calls:             {event['calls']} ({event['cached']} cached)")
+                    print(f"   [STATS] Time:              {time.perf_counter() - start:.1f} s")
+                yield f"data: {json.dumps(event)}\n\n"
+        except GeneratorExit:
+            print("[INFO] Client disconnected from the document summary.")
+            cancel.set()
+            raise
+        except SummaryCancelledError:
+            pass
+        except Exception as e:
+            print(f"[ERROR] Document summary failed: {e}", file=sys.stderr)
+            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+
+    return Response(generate(), mimetype='text/event-stream')
+
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    lines = []
+    for metric in METRICS.values():
+        lines.extend(metric.render())
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
+
+@app.route("/sessions/<session_id>", methods=["DELETE"])
+def delete_session(session_id):
+    """Frees the in-memory session when the browser closes a chat tab."""
+    if session_store.delete(session_id):
+        return jsonify({"status": "deleted"})
+    return jsonify({"error": "Session not found"}), 404
 
 
 
@@ -2213,6 +5045,9 @@ if __name__ == "__main__":
     # --- Initialize agents.json on startup ---
     initialize_agents_file()
 
+    # --- Start the pdf workers so the first upload does not wait ---
+    pdf_renderer.start()
+
     import webbrowser, threading
 
     def open_browser():
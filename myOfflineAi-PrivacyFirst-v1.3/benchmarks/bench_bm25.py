@@ -0,0 +1,100 @@
+#----------------------
+# Benchmark: BM25 word index
+#
+# Run from the app folder:
+#   python benchmarks/bench_bm25.py
+#   python benchmarks/bench_bm25.py --sizes 9000 90000 --words 200
+#
+# The chunks are made of random words with a Zipf distribution, which is
+# close to the word frequencies of real text. A chunk of RAG_CHUNK_CHARS
+# (1200) characters has about 200 words, and a 300 page pdf about 900 chunks.
+#
+# For each index size this prints:
+# - the time to add all the chunks (in batches, like document uploads)
+# - the memory the postings take
+# - the latency of one query over all chunks, and over the chunks of one
+#   document (chunk_ids), the median of QUERIES queries
+# - the time to remove one document and to compact the index
+#----------------------
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+from bm25_index import BM25Index  # noqa: E402
+
+
+DOCUMENT_CHUNKS = 900
+VOCABULARY = 50000
+QUERIES = 200
+QUERY_WORDS = 5
+TOP_K = 6
+
+
+def random_chunks(rng, count, words_per_chunk):
+    ranks = np.minimum(rng.zipf(1.2, size=(count, words_per_chunk)), VOCABULARY)
+    return [" ".join(f"w{rank}" for rank in row) for row in ranks]
+
+
+def postings_mb(index):
+    return sum(ids.itemsize * len(ids) + counts.itemsize * len(counts)
+               for ids, counts in index._postings.values()) / 1e6
+
+
+def median_ms(fn, queries):
+    times = []
+    for query in queries:
+        t = time.perf_counter()
+        fn(query)
+        times.append(time.perf_counter() - t)
+    return float(np.median(times)) * 1000
+
+
+def run(size, words_per_chunk, rng):
+    index = BM25Index()
+    documents = []
+    add_seconds = 0.0
+    for start in range(0, size, DOCUMENT_CHUNKS):
+        chunks = random_chunks(rng, min(DOCUMENT_CHUNKS, size - start), words_per_chunk)
+        t = time.perf_counter()
+        documents.append(index.add(chunks))
+        add_seconds += time.perf_counter() - t
+
+    queries = random_chunks(rng, QUERIES, QUERY_WORDS)
+    all_ms = median_ms(lambda q: index.search(q, TOP_K), queries)
+    one_document = documents[len(documents) // 2]
+    document_ms = median_ms(lambda q: index.search(q, TOP_K, one_document), queries)
+
+    t = time.perf_counter()
+    index.remove(documents[0])
+    remove_ms = (time.perf_counter() - t) * 1000
+    t = time.perf_counter()
+    index.compact()
+    compact_ms = (time.perf_counter() - t) * 1000
+    return add_seconds, postings_mb(index), all_ms, document_ms, remove_ms, compact_ms
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[9000, 90000])
+    parser.add_argument("--words", type=int, default=200, help="words per chunk")
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+
+    print(f"{args.words} words per chunk, {QUERY_WORDS} words per query, top {TOP_K}\n")
+    print(f"{'chunks':>9} {'add s':>7} {'postings MB':>12} {'query ms':>9} "
+          f"{'1 doc ms':>9} {'remove ms':>10} {'compact ms':>11}")
+    for size in args.sizes:
+        add_s, mb, all_ms, document_ms, remove_ms, compact_ms = run(size, args.words, rng)
+        print(f"{size:>9} {add_s:>7.2f} {mb:>12.1f} {all_ms:>9.2f} "
+              f"{document_ms:>9.2f} {remove_ms:>10.2f} {compact_ms:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#----------------------
+# Benchmark: one SSE frame per token vs coalesced SSE frames
+#
+# Run from the app folder:
+#   python benchmarks/bench_streaming.py
+#
+# A fake Ollama stream is passed through the ChunkCoalescer that
+# stream_chat() uses. For each setting this prints:
+# - the server CPU time spent framing the stream
+# - the number of SSE frames sent to the browser
+# - the client render time: the browser runs marked.parse() over the whole
+#   reply for every frame, so the same work is timed with static/marked.min.js
+#   in Node.js (skipped if node is not installed)
+#----------------------
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+from streaming import ChunkCoalescer  # noqa: E402
+
+
+REPLY_TOKENS = 1000
+TOKENS_PER_SECOND = (200, 1000)
+SETTINGS = (
+    ("per token", 0, 0),
+    ("50 ms / 32 tokens", 0.05, 32),
+    ("100 ms / 64 tokens", 0.1, 64),
+)
+
+SAMPLE_REPLY = """## Example
+
+Here is a list of steps:
+
+1. Read the **input** file.
+2. Parse each line and keep a running `total`.
+3. Print the result.
+
+```python
+def total(path):
+    with open(path) as f:
+        return sum(int(line) for line in f)
+```
+
+The function above reads the file *once* and uses constant memory.
+"""
+
+# Renders each snapshot of the reply the way the browser does on every frame
+NODE_RENDER_SCRIPT = """
+const { marked } = require(process.argv[1]);
+const snapshots = JSON.parse(require('fs').readFileSync(0, 'utf8'));
+const start = process.hrtime.bigint();
+for (const text of snapshots) marked.parse(text);
+console.log(Number(process.hrtime.bigint() - start) / 1e6);
+"""
+
+
+def fake_tokens(count, tokens_per_second):
+    words = SAMPLE_REPLY.replace("\n", " \n").split(" ")
+    delay = 1.0 / tokens_per_second
+    for i in range(count):
+        time.sleep(delay)
+        yield words[i % len(words)] + " "
+
+
+def client_render_ms(snapshots):
+    if not shutil.which("node"):
+        return None
+    marked_path = os.path.join(APP_DIR, "static", "marked.min.js")
+    result = subprocess.run(
+        ["node", "-e", NODE_RENDER_SCRIPT, marked_path],
+        input=json.dumps(snapshots), capture_output=True, text=True, check=True,
+    )
+    return float(result.stdout.strip())
+
+
+def run(tokens_per_second, interval, max_tokens):
+    coalescer = ChunkCoalescer(interval, max_tokens)
+    frames = []
+    cpu_start = time.process_time()
+    for token in fake_tokens(REPLY_TOKENS, tokens_per_second):
+        frames.extend(coalescer.add(token))
+    final = coalescer.flush()
+    if final:
+        frames.append(final)
+    cpu_ms = (time.process_time() - cpu_start) * 1000
+
+    reply = ""
+    snapshots = []
+    for frame in frames:
+        reply += json.loads(frame[len("data: "):])["chunk"]
+        snapshots.append(reply)
+    return cpu_ms, len(frames), client_render_ms(snapshots)
+
+
+def main():
+    print(f"{REPLY_TOKENS} tokens per reply\n")
+    print(f"{'tok/s':>6} {'setting':>20} {'server cpu ms':>14} {'frames':>7} {'client render ms':>17}")
+    for tokens_per_second in TOKENS_PER_SECOND:
+        for label, interval, max_tokens in SETTINGS:
+            cpu_ms, frames, render_ms = run(tokens_per_second, interval, max_tokens)
+            render = f"{render_ms:.1f}" if render_ms is not None else "n/a"
+            print(f"{tokens_per_second:>6} {label:>20} {cpu_ms:>14.1f} {frames:>7} {render:>17}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+#----------------------
+# BM25 word search index for document chunks
+#
+# Used when no Ollama embedding model is installed, and together with the
+# embeddings otherwise (see DocumentIndex in app.py). Needs only NumPy.
+#
+# The postings of each word are two compact arrays (chunk ids and word
+# counts, 4 bytes each). Chunk ids only grow, so adding chunks appends to
+# the postings and keeps them sorted. Removed chunks are marked deleted
+# and their postings are dropped by compact(); until then they still
+# count towards the document frequency of their words (like Lucene).
+#
+# The index is only kept in RAM. DocumentIndex rebuilds a document's
+# chunks after a restart anyway (which chunks belong to which document is
+# not saved), and adding the 900 chunks of a 300 page pdf takes about 0.1 s.
+#
+# See benchmarks/bench_bm25.py for indexing and query times.
+#----------------------
+
+import math
+import re
+import threading
+from array import array
+
+import numpy as np
+
+
+WORD_RE = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return WORD_RE.findall(text.lower())
+
+
+class BM25Index:
+    """Inverted index with BM25 ranking and incremental adds and removes."""
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings = {}  # word -> (array of chunk ids, array of counts)
+        self._lengths = array("I")  # words per chunk, by chunk id
+        self._deleted = bytearray()
+        self._live = 0
+        self._live_words = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._live
+
+    @property
+    def deleted_count(self):
+        return len(self._lengths) - self._live
+
+    def add(self, texts):
+        """Indexes the texts and returns their chunk ids."""
+        with self._lock:
+            first = len(self._lengths)
+            for chunk_id, text in enumerate(texts, first):
+                words = tokenize(text)
+                counts = {}
+                for word in words:
+                    counts[word] = counts.get(word, 0) + 1
+                for word, count in counts.items():
+                    posting = self._postings.get(word)
+                    if posting is None:
+                        posting = self._postings[word] = (array("I"), array("I"))
+                    posting[0].append(chunk_id)
+                    posting[1].append(count)
+                self._lengths.append(len(words))
+                self._deleted.append(0)
+                self._live += 1
+                self._live_words += len(words)
+            return list(range(first, len(self._lengths)))
+
+    def remove(self, chunk_ids):
+        """Marks chunks as deleted. Their postings stay until compact()."""
+        with self._lock:
+            for chunk_id in chunk_ids:
+                if chunk_id < len(self._deleted) and not self._deleted[chunk_id]:
+                    self._deleted[chunk_id] = 1
+                    self._live -= 1
+                    self._live_words -= self._lengths[chunk_id]
+
+    def compact(self):
+        """Drops the postings of deleted chunks. Chunk ids do not change."""
+        with self._lock:
+            deleted = np.frombuffer(bytes(self._deleted), dtype=np.uint8).astype(bool)
+            for word in list(self._postings):
+                ids, counts = self._postings[word]
+                ids_np = np.frombuffer(ids, dtype=np.uint32)
+                keep = ~deleted[ids_np]
+                if keep.all():
+                    continue
+                if not keep.any():
+                    del self._postings[word]
+                    continue
+                new_ids = array("I", ids_np[keep].tobytes())
+                new_counts = array("I", np.frombuffer(counts, dtype=np.uint32)[keep].tobytes())
+                del ids_np
+                self._postings[word] = (new_ids, new_counts)
+
+    def search(self, query, k, chunk_ids=None):
+        """
+        Returns the k best (chunk id, score) pairs for the query.
+        chunk_ids limits the search to those chunks.
+        """
+        words = set(tokenize(query))
+        with self._lock:
+            total = len(self._lengths)
+            if not total or not self._live:
+                return []
+            lengths = np.frombuffer(self._lengths, dtype=np.uint32).astype(np.float32)
+            norms = self.k1 * (1 - self.b + self.b * lengths / (self._live_words / self._live or 1.0))
+            scores = np.zeros(total, dtype=np.float32)
+            for word in words:
+                posting = self._postings.get(word)
+                if posting is None:
+                    continue
+                ids = np.frombuffer(posting[0], dtype=np.uint32)
+                counts = np.frombuffer(posting[1], dtype=np.uint32).astype(np.float32)
+                df = len(ids)
+                idf = math.log(1 + (max(self._live - df, 0) + 0.5) / (df + 0.5))
+                scores[ids] += idf * counts * (self.k1 + 1) / (counts + norms[ids])
+                del ids, counts  # release the buffers of the arrays
+            scores[np.frombuffer(bytes(self._deleted), dtype=np.uint8).astype(bool)] = 0
+
+        if chunk_ids is not None:
+            candidates = np.asarray(chunk_ids, dtype=np.int64)
+            candidates = candidates[candidates < total]
+        else:
+            candidates = np.arange(total)
+        candidates = candidates[scores[candidates] > 0]
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(int(i), float(scores[i])) for i in candidates]
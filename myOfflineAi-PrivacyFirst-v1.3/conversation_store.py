@@ -0,0 +1,476 @@
+#----------------------
+# Saved chat history in SQLite
+#
+# One row per chat and one row per message, so saving a turn writes only
+# that chat's new or changed messages, instead of rewriting every chat of
+# every agent like conversations.json did. The database runs in WAL mode:
+# readers (listing or opening chats) don't wait for a save in progress.
+#
+# Each message is stored as the JSON the browser sends, in the order of
+# its seq number within the chat, except for images and documents: the
+# data URLs and attachment urls in the "images" and "documents[].url" of
+# its parts are replaced by "blob:<sha256>" and the bytes are stored once
+# in the blob folder (<blob_dir>/ab/abcd...), however many messages and
+# chats use them. The blobs table counts the references
+# and a blob file is deleted when the last message using it is gone.
+# A string in a message that looks like a blob reference is stored with
+# the prefix twice ("blob:blob:<sha256>"), so it is never counted as one.
+#
+# The text of the messages is also kept in an FTS5 full-text index
+# (messages_fts), updated in the same transaction as the messages.
+# message_search_ids gives each (chat_id, seq) the rowid of its index row.
+#----------------------
+
+import base64
+import binascii
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    id TEXT PRIMARY KEY,
+    agent_id TEXT NOT NULL,
+    title TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS chats_by_agent_time ON chats (agent_id, timestamp DESC, id DESC);
+CREATE TABLE IF NOT EXISTS messages (
+    chat_id TEXT NOT NULL REFERENCES chats (id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    message TEXT NOT NULL,
+    PRIMARY KEY (chat_id, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT PRIMARY KEY,
+    mimetype TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    refs INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS message_search_ids (
+    id INTEGER PRIMARY KEY,
+    chat_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    UNIQUE (chat_id, seq)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (text, tokenize = 'unicode61 remove_diacritics 2');
+"""
+
+BLOB_PREFIX = "blob:"
+# A whole JSON string, not one inside a string (that quote would be \")
+BLOB_REF_RE = re.compile(r'(?<!\\)"blob:([0-9a-f]{64})"')
+ESCAPED_REF_RE = re.compile(r'(?<!\\)"blob:((?:blob:)+[0-9a-f]{64})"')
+LOOKS_LIKE_REF_RE = re.compile(r"(?:blob:)+[0-9a-f]{64}")
+HASH_RE = re.compile(r"[0-9a-f]{64}")
+SEARCH_WORD_RE = re.compile(r"\w+")
+# Marks the matched words in search snippets
+SNIPPET_START = "\x02"
+SNIPPET_END = "\x03"
+DATA_URL_RE = re.compile(r"data:([\w.+-]+/[\w.+-]+)?(;[^,;]*)*;base64,", re.ASCII)
+
+
+class SequenceConflictError(Exception):
+    """The chat has a different number of messages than the caller expected."""
+
+    def __init__(self, message_count):
+        super().__init__(f"The chat has {message_count} messages.")
+        self.message_count = message_count
+
+
+class ConversationStore:
+    """Chats and their messages in a SQLite database (one connection per thread)."""
+
+    def __init__(self, path, blob_dir=None, url_prefix=None, resolve_url=None):
+        """
+        blob_dir defaults to <path>.blobs. Strings in messages that are
+        url_prefix followed by a sha256 are stored as blobs too, with the
+        (data, mimetype) that resolve_url(url) returns. Messages are read
+        back with those urls in place of "blob:<sha256>".
+        """
+        self.path = path
+        self.blob_dir = blob_dir or f"{path}.blobs"
+        self.url_prefix = url_prefix
+        self.resolve_url = resolve_url
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._unlinked = []
+        self._created = []
+        os.makedirs(self.blob_dir, exist_ok=True)
+
+        conn = self._connect()
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < SCHEMA_VERSION:
+            conn.executescript(SCHEMA)  # every statement is IF NOT EXISTS, so this can run twice
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")  # safe with WAL, only the last commits can be lost on power failure
+            conn.execute("PRAGMA foreign_keys = ON")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _write(self):
+        """
+        A write transaction. BEGIN IMMEDIATE takes the write lock before the
+        first read, so that two saves to the same chat can't both read the
+        same message count. Blob files that lost their last reference are
+        deleted after the commit, before another save can add them again.
+        Blob files written in a transaction that is rolled back are deleted.
+        """
+        with self._write_lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                self._remove_blob_files(self._created)
+                self._unlinked.clear()
+                self._created.clear()
+                raise
+            conn.execute("COMMIT")
+            self._remove_blob_files(self._unlinked)
+            self._unlinked.clear()
+            self._created.clear()
+
+    def _remove_blob_files(self, keys):
+        for key in keys:
+            try:
+                os.remove(self._blob_path(key))
+            except OSError:
+                pass
+
+    # -----------------------------------------
+    # Blobs
+    # -----------------------------------------
+
+    def _blob_path(self, key):
+        return os.path.join(self.blob_dir, key[:2], key)
+
+    def read_blob(self, key):
+        """Returns (data, mimetype) of a stored blob, or None."""
+        if not HASH_RE.fullmatch(key):
+            return None
+        row = self._connect().execute("SELECT mimetype FROM blobs WHERE hash = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        try:
+            with open(self._blob_path(key), "rb") as f:
+                return f.read(), row["mimetype"]
+        except OSError:
+            return None
+
+    def _blob_ref(self, conn, value):
+        """Returns "blob:<sha256>" for a data URL or attachment url (storing the bytes if needed), or None."""
+        match = DATA_URL_RE.match(value)
+        if match:
+            try:
+                data = base64.b64decode(value[match.end():], validate=True)
+            except (binascii.Error, ValueError):
+                return None
+            mimetype = match.group(1) or "application/octet-stream"
+            key = hashlib.sha256(data).hexdigest()
+        elif self.url_prefix and value.startswith(self.url_prefix) and HASH_RE.fullmatch(value[len(self.url_prefix):]):
+            key = value[len(self.url_prefix):]
+            if conn.execute("SELECT 1 FROM blobs WHERE hash = ?", (key,)).fetchone():
+                return BLOB_PREFIX + key
+            entry = self.resolve_url(value) if self.resolve_url else None
+            if entry is None:
+                return None
+            data, mimetype = entry
+        else:
+            return None
+
+        if conn.execute("SELECT 1 FROM blobs WHERE hash = ?", (key,)).fetchone() is None:
+            path = self._blob_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "wb") as f:
+                f.write(data)
+            os.replace(path + ".tmp", path)
+            conn.execute("INSERT INTO blobs (hash, mimetype, size, refs) VALUES (?, ?, ?, 0)", (key, mimetype, len(data)))
+            if key in self._unlinked:
+                self._unlinked.remove(key)  # the row comes back on rollback, and so must the file
+            else:
+                self._created.append(key)
+        return BLOB_PREFIX + key
+
+    def _to_stored(self, conn, message):
+        """
+        Returns a copy of a message with the images and document urls of its
+        parts replaced by blob references. Other fields, like the text, are
+        kept as they are.
+        """
+        stored = self._escape_refs(message)
+        parts = stored.get("parts") if isinstance(stored, dict) else None
+        for part in parts if isinstance(parts, list) else []:
+            if not isinstance(part, dict):
+                continue
+            if isinstance(part.get("images"), list):
+                part["images"] = [self._attachment_ref(conn, image) for image in part["images"]]
+            for document in part.get("documents") or []:
+                if isinstance(document, dict) and "url" in document:
+                    document["url"] = self._attachment_ref(conn, document["url"])
+        return stored
+
+    def _attachment_ref(self, conn, value):
+        if isinstance(value, str) and (value.startswith("data:") or (self.url_prefix and value.startswith(self.url_prefix))):
+            return self._blob_ref(conn, value) or value
+        return value
+
+    @classmethod
+    def _escape_refs(cls, value):
+        """Returns a copy of value with the strings that look like blob references escaped."""
+        if isinstance(value, dict):
+            return {k: cls._escape_refs(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [cls._escape_refs(v) for v in value]
+        if isinstance(value, str) and LOOKS_LIKE_REF_RE.fullmatch(value):
+            return BLOB_PREFIX + value
+        return value
+
+    def _from_stored(self, message):
+        if self.url_prefix:
+            message = BLOB_REF_RE.sub(lambda m: f'"{self.url_prefix}{m.group(1)}"', message)
+        if "blob:blob:" in message:
+            message = ESCAPED_REF_RE.sub(r'"\1"', message)
+        return json.loads(message)
+
+    def _change_refs(self, conn, message, delta):
+        for key in BLOB_REF_RE.findall(message):
+            conn.execute("UPDATE blobs SET refs = refs + ? WHERE hash = ?", (delta, key))
+            # Messages saved before references were escaped may have text that looks like one
+            row = conn.execute("SELECT refs FROM blobs WHERE hash = ?", (key,)).fetchone()
+            if delta < 0 and row is not None and row["refs"] <= 0:
+                conn.execute("DELETE FROM blobs WHERE hash = ?", (key,))
+                self._unlinked.append(key)
+
+    def _write_messages(self, conn, chat_id, first_seq, messages):
+        rows = []
+        for seq, message in enumerate(messages, first_seq):
+            stored = json.dumps(self._to_stored(conn, message))
+            self._change_refs(conn, stored, +1)
+            self._index_text(conn, chat_id, seq, message)
+            rows.append((chat_id, seq, message.get("role", ""), stored))
+        conn.executemany("INSERT OR REPLACE INTO messages (chat_id, seq, role, message) VALUES (?, ?, ?, ?)", rows)
+
+    def _delete_messages(self, conn, where, params):
+        """Deletes message rows (a WHERE clause on messages) and releases their blobs."""
+        for (message,) in conn.execute(f"SELECT message FROM messages WHERE {where}", params).fetchall():
+            self._change_refs(conn, message, -1)
+        conn.execute(f"DELETE FROM messages WHERE {where}", params)
+        self._unindex_text(conn, where, params)
+
+    # -----------------------------------------
+    # Full-text search
+    # -----------------------------------------
+
+    @staticmethod
+    def _message_text(message):
+        parts = message.get("parts") or []
+        return "\n".join(part["text"] for part in parts if isinstance(part, dict) and isinstance(part.get("text"), str))
+
+    def _index_text(self, conn, chat_id, seq, message):
+        text = self._message_text(message)
+        if not text.strip():
+            return
+        rowid = conn.execute("INSERT INTO message_search_ids (chat_id, seq) VALUES (?, ?)", (chat_id, seq)).lastrowid
+        conn.execute("INSERT INTO messages_fts (rowid, text) VALUES (?, ?)", (rowid, text))
+
+    def _unindex_text(self, conn, where, params):
+        """Removes the index rows of the messages matching a WHERE clause on (chat_id, seq)."""
+        conn.execute(f"DELETE FROM messages_fts WHERE rowid IN (SELECT id FROM message_search_ids WHERE {where})", params)
+        conn.execute(f"DELETE FROM message_search_ids WHERE {where}", params)
+
+    def search(self, query, limit=20, agent_id=None):
+        """
+        Returns the best matching messages for the words of the query, as
+        dicts with agent_id, chat_id, title, timestamp, message_count, seq,
+        snippet and score (BM25, lower is better). The matched words in the
+        snippet are between SNIPPET_START and SNIPPET_END. The last word
+        also matches as a prefix, so results show up while typing.
+        """
+        words = SEARCH_WORD_RE.findall(query)
+        if not words:
+            return []
+        match = " ".join(f'"{word}"' for word in words) + "*"
+        sql = f"""
+            SELECT c.agent_id, c.id AS chat_id, c.title, c.timestamp, c.message_count, s.seq,
+                   snippet(messages_fts, 0, '{SNIPPET_START}', '{SNIPPET_END}', '...', 16) AS snippet,
+                   bm25(messages_fts) AS score
+            FROM messages_fts
+            JOIN message_search_ids s ON s.id = messages_fts.rowid
+            JOIN chats c ON c.id = s.chat_id
+            WHERE messages_fts MATCH ?"""
+        params = [match]
+        if agent_id:
+            sql += " AND c.agent_id = ?"
+            params.append(agent_id)
+        sql += " ORDER BY score LIMIT ?"
+        return [dict(row) for row in self._connect().execute(sql, params + [limit])]
+
+    # -----------------------------------------
+    # Chats
+    # -----------------------------------------
+
+    @staticmethod
+    def _chat_info(row):
+        return {"id": row["id"], "title": row["title"], "timestamp": row["timestamp"], "message_count": row["message_count"]}
+
+    def agent_ids(self):
+        return [row[0] for row in self._connect().execute("SELECT DISTINCT agent_id FROM chats")]
+
+    def list_chats(self, agent_id, limit, before=None):
+        """
+        Returns (chats, has_more): up to limit chats of the agent, newest
+        first, without their messages. before=(timestamp, id) of the last
+        chat of the previous page gives the next page.
+        """
+        query = "SELECT id, title, timestamp, message_count FROM chats WHERE agent_id = ?"
+        params = [agent_id]
+        if before:
+            query += " AND (timestamp < ? OR (timestamp = ? AND id < ?))"
+            params += [before[0], before[0], before[1]]
+        query += " ORDER BY timestamp DESC, id DESC LIMIT ?"
+        rows = self._connect().execute(query, params + [limit + 1]).fetchall()
+        return [self._chat_info(row) for row in rows[:limit]], len(rows) > limit
+
+    def get_messages(self, agent_id, chat_id, start=0, end=None):
+        """
+        Returns the chat info with the messages start to end (slice rules,
+        so start=-20 gives the last 20) and the position of the first one,
+        or None if the chat does not exist.
+        """
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT id, title, timestamp, message_count FROM chats WHERE id = ? AND agent_id = ?", (chat_id, agent_id)
+        ).fetchone()
+        if row is None:
+            return None
+        chat = self._chat_info(row)
+        start, end, _ = slice(start, end).indices(chat["message_count"])
+        chat["start"] = start
+        chat["messages"] = [
+            self._from_stored(message) for (message,) in conn.execute(
+                "SELECT message FROM messages WHERE chat_id = ? AND seq >= ? AND seq < ? ORDER BY seq",
+                (chat_id, start, end),
+            )
+        ]
+        return chat
+
+    def create_chat(self, agent_id, chat):
+        """Saves a new chat ({id, timestamp, title, history})."""
+        history = chat.get("history") or []
+        with self._write() as conn:
+            self._delete_messages(conn, "chat_id = ?", (chat["id"],))
+            conn.execute(
+                "INSERT OR REPLACE INTO chats (id, agent_id, title, timestamp, message_count) VALUES (?, ?, ?, ?, ?)",
+                (chat["id"], agent_id, chat.get("title") or "", chat["timestamp"], len(history)),
+            )
+            self._write_messages(conn, chat["id"], 0, history)
+
+    def replace_history(self, agent_id, chat_id, history, timestamp):
+        """
+        Stores the full history of a chat. Only the messages that are new or
+        have changed are written. Returns False if the chat does not exist.
+        """
+        with self._write() as conn:
+            if conn.execute("SELECT 1 FROM chats WHERE id = ? AND agent_id = ?", (chat_id, agent_id)).fetchone() is None:
+                return False
+            stored = dict(conn.execute("SELECT seq, message FROM messages WHERE chat_id = ?", (chat_id,)).fetchall())
+            for seq, message in enumerate(history):
+                new = json.dumps(self._to_stored(conn, message))
+                if stored.get(seq) == new:
+                    continue
+                # Count the new references first, so a blob used by both
+                # the old and the new message is not deleted in between.
+                self._change_refs(conn, new, +1)
+                if seq in stored:
+                    self._change_refs(conn, stored[seq], -1)
+                    self._unindex_text(conn, "chat_id = ? AND seq = ?", (chat_id, seq))
+                self._index_text(conn, chat_id, seq, message)
+                conn.execute(
+                    "INSERT OR REPLACE INTO messages (chat_id, seq, role, message) VALUES (?, ?, ?, ?)",
+                    (chat_id, seq, message.get("role", ""), new),
+                )
+            self._delete_messages(conn, "chat_id = ? AND seq >= ?", (chat_id, len(history)))
+            conn.execute(
+                "UPDATE chats SET timestamp = ?, message_count = ? WHERE id = ?",
+                (timestamp, len(history), chat_id),
+            )
+        return True
+
+    def append_messages(self, agent_id, chat_id, messages, timestamp, base_seq=None):
+        """
+        Adds messages to the end of a chat. Returns the new message count, or
+        None if the chat does not exist. If base_seq is given, the chat must
+        have exactly that many messages, or SequenceConflictError is raised
+        and nothing is written.
+        """
+        with self._write() as conn:
+            row = conn.execute("SELECT message_count FROM chats WHERE id = ? AND agent_id = ?", (chat_id, agent_id)).fetchone()
+            if row is None:
+                return None
+            count = row["message_count"]
+            if base_seq is not None and base_seq != count:
+                raise SequenceConflictError(count)
+            self._write_messages(conn, chat_id, count, messages)
+            conn.execute(
+                "UPDATE chats SET timestamp = ?, message_count = ? WHERE id = ?",
+                (timestamp, count + len(messages), chat_id),
+            )
+        return count + len(messages)
+
+    def delete_chat(self, agent_id, chat_id):
+        """Returns True if the chat existed."""
+        with self._write() as conn:
+            self._delete_messages(conn, "chat_id IN (SELECT id FROM chats WHERE id = ? AND agent_id = ?)", (chat_id, agent_id))
+            return conn.execute("DELETE FROM chats WHERE id = ? AND agent_id = ?", (chat_id, agent_id)).rowcount > 0
+
+    def delete_agent_chats(self, agent_id):
+        with self._write() as conn:
+            self._delete_messages(conn, "chat_id IN (SELECT id FROM chats WHERE agent_id = ?)", (agent_id,))
+            conn.execute("DELETE FROM chats WHERE agent_id = ?", (agent_id,))
+
+    def migrate_json(self, json_path):
+        """
+        Imports a conversations.json file ({agent_id: [chat, ...]}) once.
+        The file is renamed to <name>.migrated afterwards. Returns the number
+        of chats that were imported.
+        """
+        if not os.path.exists(json_path):
+            return 0
+        with open(json_path, "r", encoding="utf-8") as f:
+            conversations = json.load(f)
+
+        imported = 0
+        with self._write() as conn:
+            for agent_id, chats in conversations.items():
+                for chat in chats:
+                    if not chat.get("id"):
+                        continue
+                    if conn.execute("SELECT 1 FROM chats WHERE id = ?", (chat["id"],)).fetchone():
+                        continue
+                    history = chat.get("history") or []
+                    conn.execute(
+                        "INSERT INTO chats (id, agent_id, title, timestamp, message_count) VALUES (?, ?, ?, ?, ?)",
+                        (chat["id"], agent_id, chat.get("title") or "", chat.get("timestamp") or "", len(history)),
+                    )
+                    self._write_messages(conn, chat["id"], 0, history)
+                    imported += 1
+        os.replace(json_path, json_path + ".migrated")
+        return imported
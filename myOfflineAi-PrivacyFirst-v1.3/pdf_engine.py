@@ -0,0 +1,612 @@
+#----------------------
+# PDF rendering engine
+#
+# Pdf pages are rendered and JPEG encoded in a pool of worker processes:
+# - pages of one document are rendered in parallel
+# - each document has a time limit, after which the workers are killed
+# - each worker has a memory limit (POSIX only)
+# - a crash inside PyMuPDF only takes down a worker, not the web server
+#
+# A pdf is either a file on disk, which the workers open by path, or
+# bytes, which are placed in shared memory once per document so they are
+# not copied into every page task. Workers keep the shared memory
+# documents they have opened recently, so each is only parsed once.
+#
+# Pages can also be analyzed before rendering. Pages with a text layer
+# are extracted as markdown-like text, so only scanned pages and pages
+# that are mostly figures need to be rendered as images.
+#
+# Results are cached by the pdf's content hash, the page and the settings,
+# so a pdf that is attached again is answered from the cache without
+# starting any work in the pool.
+#----------------------
+
+import io
+import os
+import json
+import hashlib
+import sys
+import time
+import uuid
+import threading
+import signal
+import contextlib
+import multiprocessing
+from collections import OrderedDict, Counter
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError, wait as wait_futures
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import fitz  # PyMuPDF
+from PIL import Image
+
+
+# Image.MIME is only filled in once PIL has loaded its plugins, which
+# happens in the workers (they save images) but not always in the web
+# server process, so the mimetypes are listed here.
+IMAGE_MIMETYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+
+class PdfTimeoutError(Exception):
+    """The document took longer than the time limit to render."""
+
+
+class PdfWorkerError(Exception):
+    """A worker process crashed or ran out of memory."""
+
+
+#----------------------
+# Worker side
+#----------------------
+
+# Documents opened by this worker, most recently used last
+_open_documents = OrderedDict()
+OPEN_DOCUMENTS_PER_WORKER = 2
+
+
+def _init_worker(memory_limit):
+    """Limits the address space of the worker. Not available on Windows."""
+    if not memory_limit:
+        return
+    try:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def _warm_up():
+    return os.getpid()
+
+
+@contextlib.contextmanager
+def _document(source):
+    """
+    Opens the document of a task. Files are closed after each task so that
+    they can be deleted; documents in shared memory stay open in the worker.
+    """
+    if "path" not in source:
+        yield _open_shared_document(source)
+        return
+    doc = fitz.open(source["path"], filetype="pdf")
+    try:
+        yield doc
+    finally:
+        doc.close()
+
+
+def _open_shared_document(source):
+    doc = _open_documents.get(source["key"])
+    if doc is not None:
+        _open_documents.move_to_end(source["key"])
+        return doc
+
+    shm = shared_memory.SharedMemory(name=source["shm"])
+    try:
+        pdf_bytes = bytes(shm.buf[:source["size"]])
+    finally:
+        shm.close()
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+
+    _open_documents[source["key"]] = doc
+    while len(_open_documents) > OPEN_DOCUMENTS_PER_WORKER:
+        _, old_doc = _open_documents.popitem(last=False)
+        old_doc.close()
+    return doc
+
+
+def _page_count(source):
+    with _document(source) as doc:
+        return len(doc)
+
+
+# Page kinds returned by _analyze_page()
+PAGE_TEXT = "text"
+PAGE_SCANNED = "scanned"
+PAGE_FIGURE = "figure"
+
+BULLETS = ("•", "◦", "▪", "‣", "●", "○", "■", "–")
+
+
+def _graphics_coverage(page):
+    """Returns the share of the page (0 to 1) covered by images and drawings."""
+    page_area = abs(page.rect) or 1
+    image_area = sum(abs(fitz.Rect(info["bbox"]) & page.rect) for info in page.get_image_info())
+    drawing_area = sum(abs(rect & page.rect) for rect in page.cluster_drawings())
+    return min(1.0, image_area / page_area), min(1.0, drawing_area / page_area)
+
+
+def _page_markdown(page):
+    """Extracts the text of a page, marking headings and list items in markdown."""
+    blocks = [b for b in page.get_text("dict", flags=fitz.TEXT_DEHYPHENATE)["blocks"] if b["type"] == 0]
+
+    # The most common font size is taken to be the body text
+    sizes = Counter()
+    for block in blocks:
+        for line in block["lines"]:
+            for span in line["spans"]:
+                sizes[round(span["size"], 1)] += len(span["text"].strip())
+    body_size = sizes.most_common(1)[0][0] if sizes else 0
+
+    paragraphs = []
+    for block in blocks:
+        lines = []
+        for line in block["lines"]:
+            spans = [span for span in line["spans"] if span["text"].strip()]
+            if spans:
+                text = "".join(span["text"] for span in line["spans"]).strip()
+                bold = all(span["flags"] & fitz.TEXT_FONT_BOLD for span in spans)
+                lines.append((text, max(span["size"] for span in spans), bold))
+        if not lines:
+            continue
+
+        text = " ".join(text for text, _, _ in lines)
+        size = max(size for _, size, _ in lines)
+        if len(text) < 200 and size >= body_size * 1.15:
+            paragraphs.append(f"### {text}")
+        elif len(text) < 100 and all(bold for _, _, bold in lines):
+            paragraphs.append(f"#### {text}")
+        elif lines[0][0].startswith(BULLETS):
+            # Lines that do not start with a bullet continue the previous item
+            items = []
+            for line_text, _, _ in lines:
+                if line_text.startswith(BULLETS) or not items:
+                    items.append(line_text.lstrip("".join(BULLETS)).strip())
+                else:
+                    items[-1] += " " + line_text
+            paragraphs.append("\n".join(f"- {item}" for item in items))
+        else:
+            paragraphs.append(text)
+    return "\n\n".join(paragraphs)
+
+
+def _analyze_page(source, page_index, min_chars, figure_min_area):
+    """
+    Decides whether a page can be sent as text:
+    - text: enough text and few graphics, the text is returned
+    - scanned: little or no text, mostly an image
+    - figure: graphics cover a large part of the page
+    """
+    with _document(source) as doc:
+        page = doc[page_index]
+        char_count = len(page.get_text("text").strip())
+        image_share, drawing_share = _graphics_coverage(page)
+
+        if char_count >= min_chars:
+            kind = PAGE_FIGURE if image_share + drawing_share >= figure_min_area else PAGE_TEXT
+        elif image_share >= 0.5:
+            kind = PAGE_SCANNED
+        elif image_share + drawing_share > 0:
+            kind = PAGE_FIGURE
+        else:
+            kind = PAGE_TEXT  # short or empty page
+
+        return {
+            "page": page_index,
+            "kind": kind,
+            "text": _page_markdown(page) if kind == PAGE_TEXT else "",
+        }
+
+
+def _render_page(source, page_index, scale, quality, codec="JPEG", long_edge=None):
+    """
+    Renders one page and returns the image bytes with the time spent.
+    With long_edge, the scale is chosen so that the longest side of the
+    image is long_edge pixels.
+    """
+    render_start = time.perf_counter()
+    with _document(source) as doc:
+        page = doc[page_index]
+        if long_edge:
+            scale = long_edge / max(page.rect.width, page.rect.height)
+        pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale))
+    encode_start = time.perf_counter()
+    img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+    byte_io = io.BytesIO()
+    img.save(byte_io, codec, quality=quality, optimize=True)
+    return {
+        "page": page_index,
+        "data": byte_io.getvalue(),
+        "mimetype": IMAGE_MIMETYPES[codec],
+        "render_seconds": encode_start - render_start,
+        "encode_seconds": time.perf_counter() - encode_start,
+        "cached": False,
+    }
+
+
+#----------------------
+# Web server side
+#----------------------
+
+class RenderCache:
+    """
+    Size-capped LRU cache of byte values.
+    With cache_dir=None everything stays in RAM. With a cache_dir each value
+    is a file in that folder, and the cache is kept between restarts.
+    """
+
+    def __init__(self, max_bytes, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict()  # name -> value (RAM) or size (disk)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._load_index()
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha256(":".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+    def _load_index(self):
+        files = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith(".tmp"):
+                os.remove(path)
+            elif os.path.isfile(path):
+                stat = os.stat(path)
+                files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self._bytes += size
+        self._evict()
+
+    def _path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def get(self, name):
+        """Returns the cached bytes, or None."""
+        with self._lock:
+            if name not in self._entries:
+                return None
+            self._entries.move_to_end(name)
+            if not self.cache_dir:
+                return self._entries[name]
+            try:
+                with open(self._path(name), "rb") as f:
+                    data = f.read()
+                os.utime(self._path(name))  # keeps the LRU order across restarts
+                return data
+            except OSError:
+                self._bytes -= self._entries.pop(name)
+                return None
+
+    def put(self, name, data):
+        with self._lock:
+            if name in self._entries:
+                self._entries.move_to_end(name)
+                return
+            if self.cache_dir:
+                try:
+                    tmp_path = self._path(name) + ".tmp"
+                    with open(tmp_path, "wb") as f:
+                        f.write(data)
+                    os.replace(tmp_path, self._path(name))
+                except OSError as e:
+                    print(f"[ERROR] Could not write to the render cache: {e}", file=sys.stderr)
+                    return
+                self._entries[name] = len(data)
+            else:
+                self._entries[name] = data
+            self._bytes += len(data)
+            self._evict()
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            name, value = self._entries.popitem(last=False)
+            self._bytes -= value if self.cache_dir else len(value)
+            if self.cache_dir:
+                try:
+                    os.remove(self._path(name))
+                except OSError:
+                    pass
+
+@contextlib.contextmanager
+def _this_module_as_main():
+    """
+    Spawned workers import the parent's __main__ module before they start.
+    For app.py that would re-run the whole startup (model check, prints...)
+    in every worker, so this module stands in for __main__ while they start.
+    """
+    main_module = sys.modules["__main__"]
+    sys.modules["__main__"] = sys.modules[__name__]
+    try:
+        yield
+    finally:
+        sys.modules["__main__"] = main_module
+
+
+class PdfEngine:
+    """A warm pool of worker processes that render pdf pages."""
+
+    def __init__(self, workers, job_timeout, memory_limit=None, cache=None):
+        self.workers = workers
+        self.job_timeout = job_timeout
+        self.memory_limit = memory_limit
+        self.cache = cache
+        self._pool = None
+        self._lock = threading.Lock()
+        # Worker pids and unfinished futures of every pool that is still alive.
+        self._pids = {}
+        self._futures = {}
+
+    def start(self):
+        """Starts the workers so that the first upload does not wait for them."""
+        with self._lock:
+            if self._pool is None:
+                self._pool = self._new_pool()
+        return self
+
+    def _new_pool(self):
+        before = {p.pid for p in multiprocessing.active_children()}
+        pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.memory_limit,),
+        )
+        # Workers are started on submit, one per task while none is idle,
+        # so this starts all of them now.
+        with _this_module_as_main():
+            warm_ups = [pool.submit(_warm_up) for _ in range(self.workers)]
+        for future in warm_ups:
+            future.result()
+        # Called under self._lock, so the only new children are this pool's workers.
+        self._pids[pool] = {p.pid for p in multiprocessing.active_children()} - before
+        self._futures[pool] = set()
+        return pool
+
+    def _detach_pool(self, pool):
+        """
+        New jobs start a new pool from now on. Returns the unfinished futures
+        of the pool, or None if it was detached already. Call with self._lock.
+        """
+        if self._pool is pool:
+            self._pool = None
+        return self._futures.pop(pool, None)
+
+    def _kill_pool(self, pool):
+        """Kills the workers of a pool that hung or crashed."""
+        with self._lock:
+            self._detach_pool(pool)
+            pids = self._pids.pop(pool, ())
+        for pid in pids:
+            try:
+                os.kill(pid, getattr(signal, "SIGKILL", signal.SIGTERM))
+            except OSError:
+                pass
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _retire_pool(self, pool, stuck):
+        """
+        A job timed out. Its stuck tasks still hold workers, but the other
+        documents in the pool are fine: they get up to job_timeout to finish
+        before the pool is killed. New jobs go to a new pool meanwhile.
+        """
+        with self._lock:
+            futures = self._detach_pool(pool)
+        if futures is None:
+            return
+        others = set(futures) - set(stuck)
+
+        def reap():
+            wait_futures(others, timeout=self.job_timeout)
+            self._kill_pool(pool)
+
+        threading.Thread(target=reap, name="pdf-pool-reaper", daemon=True).start()
+
+    def submit(self, fn, *args):
+        with self._lock:
+            pool = self._pool
+            if pool is None:
+                pool = self._pool = self._new_pool()
+            future = pool.submit(fn, *args)
+            futures = self._futures[pool]
+            futures.add(future)
+        future.add_done_callback(futures.discard)
+        return pool, future
+
+    def result(self, pool, future, deadline, job_futures=()):
+        """
+        Waits for a task until the deadline of its document. job_futures are
+        all tasks of that document, they are abandoned together on a timeout.
+        """
+        try:
+            return future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except FutureTimeoutError:
+            self._retire_pool(pool, list(job_futures) or [future])
+            raise PdfTimeoutError(f"The pdf took longer than {self.job_timeout} seconds to render.")
+        except BrokenProcessPool:
+            self._kill_pool(pool)
+            raise PdfWorkerError("The pdf renderer crashed or ran out of memory.")
+        except MemoryError:
+            raise PdfWorkerError("The pdf renderer ran out of memory.")
+
+    def job(self, pdf, doc_hash=None, delete_file=False):
+        """pdf is the pdf bytes or the path of a pdf file. See PdfJob."""
+        return PdfJob(self, pdf, doc_hash, delete_file)
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+            self._pids.pop(pool, None)
+            self._futures.pop(pool, None)
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+class PdfJob:
+    """
+    One pdf document being rendered. Use it as a context manager:
+
+        with engine.job(pdf_bytes) as job:
+            for page in job.render_pages(range(job.page_count()), 1.5, 90):
+                ...
+
+    All work for the document must finish within the engine's job_timeout.
+    Pdf bytes are only copied to shared memory once a page is not in the cache.
+    With delete_file=True a pdf file is deleted when the job is closed.
+    doc_hash (the sha256 of the pdf) is computed if it is not given.
+    """
+
+    def __init__(self, engine, pdf, doc_hash=None, delete_file=False):
+        self.engine = engine
+        self.deadline = time.monotonic() + engine.job_timeout
+        self._pdf_bytes = None
+        self._path = None
+        if isinstance(pdf, (bytes, bytearray)):
+            self._pdf_bytes = pdf
+            self.doc_hash = doc_hash or hashlib.sha256(pdf).hexdigest()
+        else:
+            self._path = pdf
+            self.doc_hash = doc_hash or _file_hash(pdf)
+        self._delete_file = delete_file and self._path is not None
+        self._shm = None
+        self._source = None
+
+    @property
+    def source(self):
+        if self._source is None and self._path is not None:
+            self._source = {"key": uuid.uuid4().hex, "path": self._path}
+        elif self._source is None:
+            size = len(self._pdf_bytes)
+            self._shm = shared_memory.SharedMemory(create=True, size=max(1, size))
+            self._shm.buf[:size] = self._pdf_bytes
+            self._source = {"key": uuid.uuid4().hex, "shm": self._shm.name, "size": size}
+            # The workers read the shared copy, so the caller's buffer can go
+            self._pdf_bytes = None
+        return self._source
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+            self._source = None
+        if self._delete_file:
+            self._delete_file = False
+            try:
+                os.remove(self._path)
+            except OSError:
+                pass
+
+    def page_count(self):
+        return next(self._run([(_page_count, (), ("pages",))]))
+
+    def _run(self, tasks):
+        """
+        Runs (fn, args, cache_key) tasks in the workers and yields their
+        results in order. Results found in the cache are not computed again.
+        """
+        cache = self.engine.cache
+        submitted = []
+        for fn, args, cache_key in tasks:
+            key = RenderCache.key(self.doc_hash, *cache_key) if cache else None
+            cached = cache.get(key) if cache else None
+            if cached is not None:
+                submitted.append((None, None, fn, args, key, cached))
+            else:
+                pool, future = self.engine.submit(fn, self.source, *args)
+                submitted.append((pool, future, fn, args, key, None))
+        futures = [future for _, future, *_ in submitted if future is not None]
+        try:
+            for pool, future, fn, args, key, cached in submitted:
+                if cached is not None:
+                    yield _from_cache(fn, args, cached)
+                    continue
+                result = self.engine.result(pool, future, self.deadline, futures)
+                if cache:
+                    cache.put(key, _to_cache(fn, result))
+                yield result
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def analyze_pages(self, page_indexes, min_chars, figure_min_area):
+        """
+        Classifies the pages in parallel and yields them in page order.
+        Each result is a dict with the keys page, kind and text.
+        See _analyze_page() for the kinds.
+        """
+        return self._run([
+            (_analyze_page, (i, min_chars, figure_min_area), ("analysis", i, min_chars, figure_min_area))
+            for i in page_indexes
+        ])
+
+    def render_pages(self, page_indexes, scale, quality, codec="JPEG", long_edge=None,
+                     preview_scale=None, preview_quality=None):
+        """
+        Renders the pages in parallel and yields them in page order as soon
+        as each one is ready. Each result is a dict with the keys page,
+        data (image bytes), mimetype, render_seconds, encode_seconds, cached
+        and preview. See _render_page() for scale and long_edge.
+
+        If preview_scale is set, a quick low resolution render of the first
+        page is yielded before everything else, with preview set to True.
+        """
+        page_indexes = list(page_indexes)
+        tasks = [_render_task(i, scale, quality, codec, long_edge) for i in page_indexes]
+        if preview_scale and page_indexes:
+            tasks.insert(0, _render_task(page_indexes[0], preview_scale, preview_quality or quality))
+
+        for n, page in enumerate(self._run(tasks)):
+            page["preview"] = bool(preview_scale and page_indexes) and n == 0
+            yield page
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _render_task(page_index, scale, quality, codec="JPEG", long_edge=None):
+    size = f"{long_edge}px" if long_edge else f"{round(scale * 72)}dpi"
+    args = (page_index, scale, quality, codec, long_edge)
+    return _render_page, args, ("render", page_index, size, codec, quality)
+
+
+def _to_cache(fn, result):
+    """Converts a task result into the bytes that are cached."""
+    if fn is _render_page:
+        return result["data"]
+    return json.dumps(result).encode("utf-8")
+
+
+def _from_cache(fn, args, cached):
+    if fn is _render_page:
+        return {
+            "page": args[0], "data": cached, "mimetype": IMAGE_MIMETYPES[args[3]],
+            "render_seconds": 0.0, "encode_seconds": 0.0, "cached": True,
+        }
+    return json.loads(cached)
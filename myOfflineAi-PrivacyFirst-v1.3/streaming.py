@@ -0,0 +1,44 @@
+#----------------------
+# Token coalescing for streamed replies
+#
+# Groups streamed tokens into fewer, larger SSE frames. The first token is
+# sent right away, and slow streams are not delayed because a frame is sent
+# whenever the flush interval has already passed when a token arrives.
+# Used by stream_chat() in app.py and by benchmarks/bench_streaming.py.
+#----------------------
+
+import json
+import time
+
+
+class ChunkCoalescer:
+    """Buffers streamed text and emits it as SSE frames every interval or max_tokens."""
+
+    def __init__(self, interval=0.05, max_tokens=32):
+        self.interval = interval
+        self.max_tokens = max_tokens
+        self.frames_sent = 0
+        self._parts = []
+        self._field = None
+        self._last_flush = 0.0
+
+    def add(self, text, field="chunk"):
+        """Buffers text for the given SSE field and returns a list of frames that are ready to send."""
+        frames = []
+        if self._parts and field != self._field:
+            frames.append(self.flush())
+        self._field = field
+        self._parts.append(text)
+        if len(self._parts) >= self.max_tokens or time.perf_counter() - self._last_flush >= self.interval:
+            frames.append(self.flush())
+        return frames
+
+    def flush(self):
+        """Returns the buffered text as one SSE frame, or None if nothing is buffered."""
+        self._last_flush = time.perf_counter()
+        if not self._parts:
+            return None
+        frame = f"data: {json.dumps({self._field: ''.join(self._parts)})}\n\n"
+        self._parts = []
+        self.frames_sent += 1
+        return frame
@@ -0,0 +1,72 @@
+import base64
+import hashlib
+import os
+
+import pytest
+
+from conversation_store import ConversationStore
+
+
+PREFIX = "/attachments/"
+IMAGE = b"\x89PNG not really"
+IMAGE_HASH = hashlib.sha256(IMAGE).hexdigest()
+IMAGE_URL = "data:image/png;base64," + base64.b64encode(IMAGE).decode()
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ConversationStore(str(tmp_path / "chats.db"), url_prefix=PREFIX)
+
+
+def text_message(text):
+    return {"role": "user", "parts": [{"text": text}]}
+
+
+def image_message():
+    return {"role": "user", "parts": [{"text": "look", "images": [IMAGE_URL]}]}
+
+
+def blob_file(store):
+    return os.path.join(store.blob_dir, IMAGE_HASH[:2], IMAGE_HASH)
+
+
+@pytest.mark.parametrize("text", [
+    "blob:" + "0" * 64,
+    "blob:" + IMAGE_HASH,
+    "blob:blob:" + IMAGE_HASH,
+    'he said "blob:' + IMAGE_HASH,
+])
+def test_text_that_looks_like_a_blob_reference(store, text):
+    store.create_chat("a", {"id": "c", "timestamp": "1", "title": "t", "history": [image_message()]})
+    store.append_messages("a", "c", [text_message(text)], "2")
+
+    messages = store.get_messages("a", "c")["messages"]
+    assert messages[1]["parts"][0]["text"] == text
+    assert messages[0]["parts"][0]["images"] == [PREFIX + IMAGE_HASH]
+
+    # Dropping the text message must not release the image
+    store.replace_history("a", "c", messages[:1], "3")
+    assert os.path.exists(blob_file(store))
+    store.delete_chat("a", "c")
+    assert not os.path.exists(blob_file(store))
+
+
+def test_text_that_is_a_data_url_is_kept(store):
+    text = "data:text/plain;base64,aGVsbG8="
+    document = {"url": IMAGE_URL, "name": "a.pdf"}
+    message = {"role": "user", "parts": [{"text": text, "documents": [document]}]}
+    store.create_chat("a", {"id": "c", "timestamp": "1", "title": text, "history": [message]})
+
+    (saved,) = store.get_messages("a", "c")["messages"]
+    assert saved["parts"][0]["text"] == text
+    assert saved["parts"][0]["documents"] == [{"url": PREFIX + IMAGE_HASH, "name": "a.pdf"}]
+    assert os.path.exists(blob_file(store))
+
+
+def test_rolled_back_save_removes_its_blob_files(store):
+    unserializable = {"role": "user", "parts": [{"text": object()}]}
+    with pytest.raises(TypeError):
+        store.create_chat("a", {"id": "c", "timestamp": "1", "title": "t", "history": [image_message(), unserializable]})
+
+    assert store.get_messages("a", "c") is None
+    assert not os.path.exists(blob_file(store))
@@ -0,0 +1,60 @@
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import fitz
+import pytest
+
+from pdf_engine import PdfEngine, PdfTimeoutError, RenderCache
+
+
+def make_pdf(pages=1):
+    doc = fitz.open()
+    for i in range(pages):
+        page = doc.new_page(width=200, height=300)
+        page.insert_text((20, 40), f"Page {i + 1}")
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+@pytest.fixture(scope="module")
+def engine():
+    engine = PdfEngine(1, 60, cache=RenderCache(16 * 1024 * 1024))
+    yield engine
+    engine.shutdown()
+
+
+@pytest.mark.parametrize("codec, mimetype", [("JPEG", "image/jpeg"), ("WEBP", "image/webp")])
+def test_same_page_twice_is_served_from_cache(engine, codec, mimetype):
+    pdf = make_pdf()
+    with engine.job(pdf) as job:
+        (first,) = job.render_pages([0], 1.0, 80, codec=codec)
+    with engine.job(pdf) as job:
+        (second,) = job.render_pages([0], 1.0, 80, codec=codec)
+
+    assert not first["cached"]
+    assert second["cached"]
+    assert first["mimetype"] == second["mimetype"] == mimetype
+    assert second["data"] == first["data"]
+
+
+def test_timeout_does_not_break_other_documents():
+    engine = PdfEngine(2, 1)
+    try:
+        hung_pool, hung = engine.submit(time.sleep, 30)
+        other_pool, other = engine.submit(time.sleep, 0.8)
+        assert hung_pool is other_pool
+
+        with pytest.raises(PdfTimeoutError):
+            engine.result(hung_pool, hung, time.monotonic() + 0.5, [hung])
+        # New work goes to a new pool while the old one finishes its other tasks.
+        new_pool, future = engine.submit(time.sleep, 0)
+        assert new_pool is not hung_pool
+        assert engine.result(new_pool, future, time.monotonic() + 30) is None
+        assert engine.result(other_pool, other, time.monotonic() + 30) is None
+
+        # Once the other tasks are done the hung worker is killed.
+        with pytest.raises(BrokenProcessPool):
+            hung.result(timeout=10)
+    finally:
+        engine.shutdown()
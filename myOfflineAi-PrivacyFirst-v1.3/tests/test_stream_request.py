@@ -0,0 +1,70 @@
+import json
+import os
+import re
+import shutil
+import subprocess
+
+import pytest
+
+
+APP_PY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+
+pytestmark = pytest.mark.skipif(shutil.which("node") is None, reason="needs node")
+
+
+def js_function(source, name):
+    """The source of a top level function of the page script (ends at its closing brace)."""
+    match = re.search(rf"^( *)(async )?function {name}\(.*?^\1}}$", source, re.M | re.S)
+    assert match, name
+    return match.group(0)
+
+
+def post_requests(chat, history, statuses):
+    """Runs postStreamRequest() with a fake fetch and returns the request bodies."""
+    with open(APP_PY, encoding="utf-8") as f:
+        source = f.read()
+    script = "\n".join([
+        "const currentModel = 'm';",
+        "const toApiMessage = (m) => m;",
+        js_function(source, "buildStreamRequest"),
+        js_function(source, "postStreamRequest"),
+        f"const statuses = {json.dumps(statuses)};",
+        "const bodies = [];",
+        "globalThis.fetch = async (url, options) => {",
+        "    bodies.push(JSON.parse(options.body));",
+        "    return { status: statuses.shift(), ok: true };",
+        "};",
+        f"const chat = {json.dumps(chat)};",
+        f"postStreamRequest(chat, {json.dumps(history)}, 'sys', null)",
+        "    .then(() => console.log(JSON.stringify({ bodies, synced: chat.syncedCount })));",
+    ])
+    out = subprocess.run(["node", "-e", script], capture_output=True, text=True, check=True).stdout
+    return json.loads(out)
+
+
+CHAT = {"agent": {"id": "a"}, "sessionId": "s", "syncedCount": 2}
+
+
+def test_second_turn_sends_only_the_new_message():
+    result = post_requests(CHAT, [1, 2, 3], [200])
+    (body,) = result["bodies"]
+    assert body["messages"] == [3]
+    assert body["base_len"] == 2
+    assert "reset" not in body
+    assert result["synced"] == 2
+
+
+def test_lost_session_resends_the_full_history():
+    result = post_requests(CHAT, [1, 2, 3], [409, 200])
+    first, second = result["bodies"]
+    assert first["messages"] == [3]
+    assert second["reset"] is True
+    assert second["messages"] == [1, 2, 3]
+    assert result["synced"] == 0
+
+
+def test_first_turn_sends_the_full_history():
+    result = post_requests(dict(CHAT, syncedCount=0), [1], [200])
+    (body,) = result["bodies"]
+    assert body["reset"] is True
+    assert body["messages"] == [1]
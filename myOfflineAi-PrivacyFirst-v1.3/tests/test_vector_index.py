@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from vector_index import VectorIndex
+
+
+def unit_vectors(rng, count, dim):
+    vectors = rng.standard_normal((count, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@pytest.mark.parametrize("dtype", ["int8", "float16"])
+def test_interrupted_append_is_cut_off(tmp_path, dtype):
+    rng = np.random.default_rng(0)
+    index = VectorIndex(str(tmp_path), 16, dtype)
+    index.append(unit_vectors(rng, 10, 16), [{"row": i} for i in range(10)])
+    index.close()
+
+    # An append that stopped after the vectors were written, before the metadata
+    values, scales = index._quantize(unit_vectors(rng, 1, 16))
+    with open(tmp_path / "vectors.bin", "ab") as f:
+        f.write(values.tobytes())
+    if scales is not None:
+        with open(tmp_path / "scales.bin", "ab") as f:
+            f.write(scales.tobytes())
+
+    index = VectorIndex(str(tmp_path))
+    assert len(index) == 10
+    new = unit_vectors(rng, 1, 16)
+    (row,) = index.append(new, [{"row": "new"}])
+    assert row == 10
+    assert index.search(new[0], 1)[0][0] == row
+    index.close()
+
+    # Still lined up after opening again
+    index = VectorIndex(str(tmp_path))
+    assert index.search(new[0], 1)[0][0] == 10
+    assert index.metadata[10] == {"row": "new"}
+    index.close()
+
+
+def test_torn_metadata_line_is_dropped(tmp_path):
+    rng = np.random.default_rng(1)
+    index = VectorIndex(str(tmp_path), 8)
+    index.append(unit_vectors(rng, 3, 8), [0, 1, 2])
+    index.delete([1])
+    index.close()
+    with open(tmp_path / "meta.jsonl", "a", encoding="utf-8") as f:
+        f.write('{"meta": ')
+
+    index = VectorIndex(str(tmp_path))
+    assert index.metadata == [0, 1, 2]
+    assert index.deleted_count == 1
+    index.append(unit_vectors(rng, 1, 8), [3])
+    index.close()
+
+    index = VectorIndex(str(tmp_path))
+    assert index.metadata == [0, 1, 2, 3]
+    assert index.deleted_count == 1
+
+
+def test_ram_index_writes_nothing(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(2)
+    vectors = unit_vectors(rng, 50, 16)
+    index = VectorIndex(None, 16)
+    rows = index.append(vectors, list(range(50)))
+    index.delete(rows[:30])
+    assert [row for row, _ in index.search(vectors[40], 1)] == [40]
+    mapping = index.compact()
+    assert len(index) == 20 and mapping[40] == 10
+    assert index.search(vectors[40], 1)[0][0] == 10
+    index.close()
+    assert index.search(vectors[45], 1)[0][0] == 15
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,300 @@
+#----------------------
+# On-disk vector index for document chunks
+#
+# Vectors are stored quantized (int8 with one scale per vector, or
+# float16) in a flat file that is read through a NumPy memmap, so an
+# index is not loaded into RAM when it is opened. A metadata sidecar
+# (one JSON line per vector) holds what the caller wants back with each
+# hit, such as the document and page of a chunk.
+#
+# All files are append-only:
+# - index.json     dim and dtype
+# - vectors.bin    count x dim values (int8 or float16)
+# - scales.bin     count float32 values (int8 only)
+# - meta.jsonl     one line per vector, plus {"deleted": [rows]} lines
+#
+# With directory=None nothing is written: the quantized vectors are kept
+# in NumPy arrays in RAM.
+#
+# Deleted vectors are only marked (tombstones) until compact() rewrites
+# the files. Search is a brute-force scan in blocks of rows, with one
+# matrix product per block for all the queries in a batch.
+#----------------------
+
+import json
+import os
+import threading
+
+import numpy as np
+
+
+DTYPES = {"int8": np.int8, "float16": np.float16}
+SEARCH_BLOCK_ROWS = 4096
+
+
+class VectorIndex:
+    """Append-only, memory-mapped (or in-RAM) store of quantized vectors with tombstone deletes."""
+
+    def __init__(self, directory, dim=None, dtype="int8"):
+        """
+        Opens the index in directory, or creates it if it does not exist yet.
+        dim and dtype are only needed to create a new index.
+        directory=None creates an index that is only kept in RAM.
+        """
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._vectors = None
+        self._scales = None
+        if directory is None:
+            if dim is None:
+                raise ValueError("dim is needed to create an index.")
+            if dtype not in DTYPES:
+                raise ValueError(f"dtype must be one of {', '.join(DTYPES)}.")
+            self.dim, self.dtype = int(dim), dtype
+            self._np_dtype = DTYPES[self.dtype]
+            self.metadata = []
+            self._deleted = np.zeros(0, dtype=bool)
+            self._vectors = np.empty((0, self.dim), dtype=self._np_dtype)
+            self._scales = np.empty(0, dtype=np.float32) if self.dtype == "int8" else None
+            return
+        os.makedirs(directory, exist_ok=True)
+
+        header_path = self._path("index.json")
+        if os.path.exists(header_path):
+            with open(header_path, encoding="utf-8") as f:
+                header = json.load(f)
+            if dim is not None and dim != header["dim"]:
+                raise ValueError(f"Index has {header['dim']} dimensions, not {dim}.")
+            self.dim, self.dtype = header["dim"], header["dtype"]
+        else:
+            if dim is None:
+                raise ValueError("dim is needed to create an index.")
+            if dtype not in DTYPES:
+                raise ValueError(f"dtype must be one of {', '.join(DTYPES)}.")
+            self.dim, self.dtype = int(dim), dtype
+            with open(header_path, "w", encoding="utf-8") as f:
+                json.dump({"dim": self.dim, "dtype": self.dtype}, f)
+        self._np_dtype = DTYPES[self.dtype]
+        self._row_bytes = self.dim * np.dtype(self._np_dtype).itemsize
+        self._load()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _load(self):
+        """Reads the metadata and tombstones. A torn last append is cut off."""
+        self.metadata = []
+        deleted = []
+        torn = False
+        if os.path.exists(self._path("meta.jsonl")):
+            with open(self._path("meta.jsonl"), encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        torn = True
+                        break
+                    if "deleted" in record:
+                        deleted.extend(record["deleted"])
+                    else:
+                        self.metadata.append(record["meta"])
+
+        count = len(self.metadata)
+        if os.path.exists(self._path("vectors.bin")):
+            count = min(count, os.path.getsize(self._path("vectors.bin")) // self._row_bytes)
+        else:
+            count = 0
+        if self.dtype == "int8":
+            scales_size = os.path.getsize(self._path("scales.bin")) if os.path.exists(self._path("scales.bin")) else 0
+            count = min(count, scales_size // 4)
+        # An interrupted append can leave rows in vectors.bin and scales.bin
+        # (written first) that have no metadata, or the reverse. Both are
+        # cut back to the rows that are complete.
+        deleted = [row for row in deleted if row < count]
+        self._truncate(count, torn or count < len(self.metadata), deleted)
+        self.metadata = self.metadata[:count]
+
+        self._deleted = np.zeros(count, dtype=bool)
+        self._deleted[deleted] = True
+
+    def _truncate(self, count, rewrite_metadata, deleted):
+        """Cuts the files back to count rows after an interrupted append."""
+        for name, row_bytes in (("vectors.bin", self._row_bytes), ("scales.bin", 4)):
+            path = self._path(name)
+            if os.path.exists(path) and os.path.getsize(path) > count * row_bytes:
+                with open(path, "r+b") as f:
+                    f.truncate(count * row_bytes)
+        if rewrite_metadata:
+            self._write_metadata(self.metadata[:count], deleted)
+
+    def _write_metadata(self, metadata, deleted):
+        tmp_path = self._path("meta.jsonl.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for meta in metadata:
+                f.write(json.dumps({"meta": meta}) + "\n")
+            if deleted:
+                f.write(json.dumps({"deleted": deleted}) + "\n")
+        os.replace(tmp_path, self._path("meta.jsonl"))
+
+    def __len__(self):
+        """Number of vectors that are not deleted."""
+        return int(len(self._deleted) - self._deleted.sum())
+
+    @property
+    def deleted_count(self):
+        return int(self._deleted.sum())
+
+    def _quantize(self, vectors):
+        """Returns (values, scales). Scales are None for float16."""
+        if self.dtype == "float16":
+            return vectors.astype(np.float16), None
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        values = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+        return values, scales.astype(np.float32)
+
+    def append(self, vectors, metadata):
+        """Adds vectors with one metadata value (anything JSON can store) each. Returns their rows."""
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        if len(vectors) != len(metadata):
+            raise ValueError("Need one metadata value per vector.")
+        values, scales = self._quantize(vectors)
+
+        with self._lock:
+            start = len(self.metadata)
+            if self.directory is None:
+                self._vectors = np.concatenate([self._vectors, values])
+                if scales is not None:
+                    self._scales = np.concatenate([self._scales, scales])
+                self.metadata.extend(metadata)
+                self._deleted = np.concatenate([self._deleted, np.zeros(len(vectors), dtype=bool)])
+                return np.arange(start, start + len(vectors))
+            # The vectors are written before the metadata, so that an
+            # interrupted append is dropped by _load().
+            with open(self._path("vectors.bin"), "ab") as f:
+                f.write(values.tobytes())
+            if scales is not None:
+                with open(self._path("scales.bin"), "ab") as f:
+                    f.write(scales.tobytes())
+            with open(self._path("meta.jsonl"), "a", encoding="utf-8") as f:
+                f.writelines(json.dumps({"meta": meta}) + "\n" for meta in metadata)
+
+            self.metadata.extend(metadata)
+            self._deleted = np.concatenate([self._deleted, np.zeros(len(vectors), dtype=bool)])
+            self._vectors = None  # map again with the new size
+            self._scales = None
+        return np.arange(start, start + len(vectors))
+
+    def delete(self, rows):
+        """Marks rows as deleted. They are skipped by search() and dropped by compact()."""
+        rows = [int(row) for row in rows if 0 <= row < len(self._deleted) and not self._deleted[row]]
+        if not rows:
+            return
+        with self._lock:
+            if self.directory is not None:
+                with open(self._path("meta.jsonl"), "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"deleted": rows}) + "\n")
+            self._deleted[rows] = True
+
+    def _mapped(self):
+        """Returns (vectors, scales) of the current rows (memmaps, or the arrays in RAM)."""
+        count = len(self.metadata)
+        if self._vectors is None and count:
+            self._vectors = np.memmap(self._path("vectors.bin"), dtype=self._np_dtype, mode="r", shape=(count, self.dim))
+            if self.dtype == "int8":
+                self._scales = np.memmap(self._path("scales.bin"), dtype=np.float32, mode="r", shape=(count,))
+        return self._vectors, self._scales
+
+    def search(self, queries, k, rows=None):
+        """
+        Returns the k best (row, score) pairs by dot product for each query.
+        queries is one vector or a (n, dim) batch; a single query gets a
+        single list back. rows limits the search to those rows.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        single = queries.ndim == 1
+        queries = queries.reshape(-1, self.dim)
+
+        with self._lock:
+            vectors, scales = self._mapped()
+            deleted = self._deleted
+            total = len(self.metadata) if rows is None else len(rows)
+            if rows is not None:
+                rows = np.asarray(rows, dtype=np.int64)
+
+            best_scores = np.empty((len(queries), 0), dtype=np.float32)
+            best_rows = np.empty((len(queries), 0), dtype=np.int64)
+            for start in range(0, total, SEARCH_BLOCK_ROWS):
+                if rows is None:
+                    block_rows = np.arange(start, min(start + SEARCH_BLOCK_ROWS, total))
+                    block = vectors[start:start + SEARCH_BLOCK_ROWS]
+                else:
+                    block_rows = np.sort(rows[start:start + SEARCH_BLOCK_ROWS])
+                    block = vectors[block_rows]
+                scores = queries @ block.astype(np.float32).T
+                if scales is not None:
+                    scores *= scales[block_rows]
+                scores[:, deleted[block_rows]] = -np.inf
+
+                # Keep the k best of the block plus the best so far
+                best_scores = np.concatenate([best_scores, scores], axis=1)
+                best_rows = np.concatenate([best_rows, np.broadcast_to(block_rows, scores.shape)], axis=1)
+                if best_scores.shape[1] > k:
+                    top = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                    best_scores = np.take_along_axis(best_scores, top, axis=1)
+                    best_rows = np.take_along_axis(best_rows, top, axis=1)
+
+        order = np.argsort(-best_scores, axis=1)
+        results = []
+        for query_scores, query_rows, query_order in zip(best_scores, best_rows, order):
+            results.append([
+                (int(query_rows[i]), float(query_scores[i]))
+                for i in query_order if query_scores[i] != -np.inf
+            ])
+        return results[0] if single else results
+
+    def compact(self):
+        """
+        Rewrites the files without the deleted rows. Returns an array that
+        maps each old row to its new row (-1 for deleted rows).
+        """
+        with self._lock:
+            vectors, scales = self._mapped()
+            keep = np.flatnonzero(~self._deleted)
+            mapping = np.full(len(self._deleted), -1, dtype=np.int64)
+            mapping[keep] = np.arange(len(keep))
+
+            if self.directory is None:
+                self._vectors = vectors[keep]
+                if scales is not None:
+                    self._scales = scales[keep]
+                self.metadata = [self.metadata[row] for row in keep]
+                self._deleted = np.zeros(len(keep), dtype=bool)
+                return mapping
+
+            tmp_path = self._path("vectors.bin.tmp")
+            with open(tmp_path, "wb") as f:
+                for start in range(0, len(keep), SEARCH_BLOCK_ROWS):
+                    f.write(np.ascontiguousarray(vectors[keep[start:start + SEARCH_BLOCK_ROWS]]).tobytes())
+            if self.dtype == "int8":
+                with open(self._path("scales.bin.tmp"), "wb") as f:
+                    if len(keep):
+                        f.write(np.ascontiguousarray(scales[keep]).tobytes())
+
+            # Drop the maps before replacing the files (needed on Windows)
+            self._vectors = self._scales = vectors = scales = None
+            os.replace(tmp_path, self._path("vectors.bin"))
+            if self.dtype == "int8":
+                os.replace(self._path("scales.bin.tmp"), self._path("scales.bin"))
+            self.metadata = [self.metadata[row] for row in keep]
+            self._write_metadata(self.metadata, [])
+            self._deleted = np.zeros(len(keep), dtype=bool)
+        return mapping
+
+    def close(self):
+        """Releases the memory maps, so that the files can be deleted."""
+        if self.directory is None:
+            return
+        with self._lock:
+            self._vectors = None
+            self._scales = None